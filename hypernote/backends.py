@@ -0,0 +1,334 @@
+"""Implement pluggable storage backends for notebooks.
+
+Eager backends (the file formats) are read in full when a notebook is
+loaded. Lazy backends answer get/search/relation/time queries directly from
+storage, so only the notes actually asked for are ever decoded."""
+from hypernote import blockio
+from hypernote import fileio
+from hypernote import fulltext
+from hypernote import relations
+from hypernote import shards
+from hypernote import utils
+from collections import OrderedDict
+import os
+import sqlite3
+
+# dictionary (format name -> Backend subclass) of all backends,
+# in the order they are tried when detecting a notebook's format
+formats = OrderedDict()
+
+def backend(cls):
+    """Wrapper for Backend subclasses; registers them by format name."""
+    global formats
+    formats[cls.name] = cls
+    return cls
+
+def detect(path):
+    """Get the backend class matching the notebook at the given path.
+
+    Paths that no backend recognises (including nonexistent ones) are in the
+    plain stream format."""
+    for cls in formats.values():
+        if cls.detect(path):
+            return cls
+    return formats['stream']
+
+def open_backend(path):
+    """Open the notebook at the given path with the backend matching it."""
+    return detect(path)(path)
+
+def stamp(path):
+    """Get the stamp of the notebook at the given path (see Backend.stamp)
+    without opening it."""
+    return detect(path).stamp_of(path)
+
+class Backend:
+    """Storage for the notes and relations of one notebook."""
+    name = None
+    lazy = False
+    # whether get and has are implemented (they always are by lazy backends)
+    random_access = False
+
+    def __init__(self, path):
+        self.path = path
+
+    @classmethod
+    def detect(cls, path):
+        """Return whether the notebook at the given path uses this backend."""
+        return False
+
+    def files(self):
+        """Get the paths of all files/directories making up the notebook."""
+        return [self.path, utils.sidecar_path(self.path, 'rel')]
+
+    @classmethod
+    def stamped_files(cls, path):
+        """Get the paths of the files holding the notes and relations of the
+        notebook at the given path."""
+        return [path, utils.sidecar_path(path, 'rel')]
+
+    @classmethod
+    def stamp_of(cls, path):
+        """Get the stamp of the notebook at the given path (see stamp)."""
+        return max([os.stat(p).st_mtime_ns for p in cls.stamped_files(path)
+                    if os.path.exists(p)] or [0])
+
+    def stamp(self):
+        """Get the latest modification time (ns) of the files holding the
+        notes and relations; it changes whenever they are saved."""
+        return self.stamp_of(self.path)
+
+    def load(self):
+        """Generate every note in the notebook."""
+        raise NotImplementedError
+
+    def save(self, notes, dirty):
+        """Save the notes.
+
+        notes: dictionary (uid -> note) of the notes held in memory.
+        dirty: UIDs changed since loading; None means save everything."""
+        raise NotImplementedError
+
+    def load_relations(self):
+        """Generate every relation in the notebook."""
+        path = utils.sidecar_path(self.path, 'rel')
+        if os.path.isfile(path):
+            yield from relations.read(path)
+
+    def save_relations(self, reldb, new):
+        """Save the relations.
+
+        reldb: every relation held in memory.
+        new: relations added since loading; None means save everything."""
+        path = utils.sidecar_path(self.path, 'rel')
+        if new or (new is None and reldb) or os.path.isfile(path):
+            relations.write(path, reldb)
+
+    # indexed queries; only lazy backends implement these (and get and has
+    # those with random_access)
+    def get(self, uid):
+        """Get the note with the given UID; raise KeyError if missing."""
+        raise NotImplementedError
+
+    def has(self, uid):
+        """Return whether a note with the given UID exists."""
+        raise NotImplementedError
+
+    def search(self, query):
+        """Get the UIDs of notes with a searchable equal to the query."""
+        raise NotImplementedError
+
+    def relations(self, query):
+        """Generate the relations matching a query (see relations.get)."""
+        raise NotImplementedError
+
+    def time_range(self, start, end):
+        """Get the UIDs of ActionNotes with start <= time < end, in order."""
+        raise NotImplementedError
+
+@backend
+class SQLiteBackend(Backend):
+    """Notebook stored in an SQLite database with indexed queries."""
+    name = 'sqlite'
+    lazy = True
+    random_access = True
+    MAGIC = b'SQLite format 3\x00'
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS notes (
+            uid INTEGER PRIMARY KEY,
+            type TEXT NOT NULL,
+            time INTEGER,
+            data BLOB NOT NULL);
+        CREATE INDEX IF NOT EXISTS notes_time ON notes (time);
+        CREATE TABLE IF NOT EXISTS search_terms (
+            term TEXT NOT NULL,
+            uid INTEGER NOT NULL);
+        CREATE INDEX IF NOT EXISTS search_terms_term ON search_terms (term);
+        CREATE INDEX IF NOT EXISTS search_terms_uid ON search_terms (uid);
+        CREATE TABLE IF NOT EXISTS relations (
+            uidA INTEGER NOT NULL,
+            uidB INTEGER NOT NULL,
+            typeA INTEGER NOT NULL,
+            typeB INTEGER NOT NULL);
+        CREATE INDEX IF NOT EXISTS relations_a ON relations (uidA);
+        CREATE INDEX IF NOT EXISTS relations_b ON relations (uidB);
+        '''
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.db = sqlite3.connect(path)
+        self.db.executescript(self.SCHEMA)
+        if fulltext.create_tables(self.db):
+            # notebook saved before its text was indexed; the index replaces
+            # the FTS5 table of descriptions, so that every format ranks
+            # notes the same way (and SQLite need not be built with FTS5)
+            with self.db:
+                self.db.execute('DROP TABLE IF EXISTS descriptions')
+                fulltext.build(self.db, ((n.uid, fulltext.note_text(n))
+                                         for n in self.load()))
+
+    @classmethod
+    def detect(cls, path):
+        if not os.path.isfile(path):
+            return False
+        with open(path, 'rb') as fin:
+            return fin.read(len(cls.MAGIC)) == cls.MAGIC
+
+    def files(self):
+        return [self.path]
+
+    @classmethod
+    def stamped_files(cls, path):
+        return [path]
+
+    def decode(self, data):
+        """Decode a note stored in the database."""
+        return fileio.load_object(bytearray(data))
+
+    def load(self):
+        for (data,) in self.db.execute('SELECT data FROM notes'):
+            yield self.decode(data)
+
+    def save(self, notes, dirty):
+        uids = notes if dirty is None else [u for u in dirty if u in notes]
+        with self.db:
+            for uid in uids:
+                self.save_note(notes[uid])
+            fulltext.maybe_merge(self.db)
+
+    def save_note(self, n):
+        """Insert or replace a single note and its index entries."""
+        time = getattr(n, 'time', None)
+        if time is not None:
+            time = utils.to_micros(time)
+        data = bytes(fileio.dump_objects((n,)))
+        self.db.execute('INSERT OR REPLACE INTO notes VALUES (?, ?, ?, ?)',
+                        (n.uid, type(n).__name__, time, data))
+        self.db.execute('DELETE FROM search_terms WHERE uid = ?', (n.uid,))
+        self.db.executemany(
+            'INSERT INTO search_terms VALUES (?, ?)',
+            [(str(getattr(n, attr)).lower(), n.uid) for attr in n.searchable])
+        fulltext.index_note(self.db, n.uid, fulltext.note_text(n))
+
+    def load_relations(self):
+        for row in self.db.execute('SELECT * FROM relations'):
+            yield relations.Relation(*row)
+
+    def save_relations(self, reldb, new):
+        with self.db:
+            if new is None:
+                self.db.execute('DELETE FROM relations')
+            self.db.executemany('INSERT INTO relations VALUES (?, ?, ?, ?)',
+                                reldb if new is None else new)
+
+    def get(self, uid):
+        row = self.db.execute('SELECT data FROM notes WHERE uid = ?',
+                              (uid,)).fetchone()
+        if row is None:
+            raise KeyError(uid)
+        return self.decode(row[0])
+
+    def has(self, uid):
+        return self.db.execute('SELECT 1 FROM notes WHERE uid = ?',
+                               (uid,)).fetchone() is not None
+
+    def search(self, query):
+        return [row[0] for row in self.db.execute(
+            'SELECT uid FROM search_terms WHERE term = ? GROUP BY uid'
+            ' ORDER BY min(rowid)', (query.lower(),))]
+
+    def search_text(self, query, limit=10):
+        """Rank notes against a plain-text query (see fulltext.search)."""
+        return fulltext.search_db(self.db, query, limit)
+
+    def relations(self, query):
+        if len(query) > 1:
+            rows = self.db.execute(
+                'SELECT * FROM relations'
+                ' WHERE (uidA = ?1 OR uidB = ?1) AND (uidA = ?2 OR uidB = ?2)',
+                (query[0], query[1]))
+        else:
+            rows = self.db.execute(
+                'SELECT * FROM relations WHERE uidA = ?1'
+                ' UNION ALL SELECT * FROM relations'
+                ' WHERE uidB = ?1 AND uidA != ?1', (query[0],))
+        for row in rows:
+            yield relations.Relation(*row)
+
+    def time_range(self, start, end):
+        return [row[0] for row in self.db.execute(
+            'SELECT uid FROM notes WHERE time >= ? AND time < ? ORDER BY time',
+            (utils.to_micros(start), utils.to_micros(end)))]
+
+@backend
+class ShardedBackend(Backend):
+    """Notebook stored as a directory of shard files (see shards)."""
+    name = 'sharded'
+
+    def __init__(self, path, num_shards=shards.DEFAULT_SHARDS):
+        super().__init__(path)
+        self.num_shards = num_shards
+
+    @classmethod
+    def detect(cls, path):
+        return shards.is_sharded(path)
+
+    def files(self):
+        # relations live inside the notebook directory
+        return [self.path]
+
+    @classmethod
+    def stamped_files(cls, path):
+        # the directory also holds other sidecars; only look at the shards
+        paths = [os.path.join(path, shards.MANIFEST),
+                 utils.sidecar_path(path, 'rel')]
+        return paths + [shards.shard_path(path, i)
+                        for i in range(shards.read_manifest(path)['shards'])]
+
+    def load(self):
+        return shards.load_all(self.path)
+
+    def save(self, notes, dirty):
+        shards.save(self.path, notes, self.num_shards, dirty)
+
+@backend
+class BlockBackend(Backend):
+    """Notebook stored as a block-compressed file (see blockio)."""
+    name = 'block'
+    random_access = True
+
+    @classmethod
+    def detect(cls, path):
+        return blockio.is_blockfile(path)
+
+    def load(self):
+        return blockio.load_all(self.path)
+
+    def save(self, notes, dirty):
+        blockio.write(self.path, notes.values())
+
+    def get(self, uid):
+        return blockio.load_note(self.path, uid)
+
+    def has(self, uid):
+        return uid in blockio.load_notes(self.path, (uid,))
+
+@backend
+class StreamBackend(Backend):
+    """Notebook stored as a single file of encoded notes."""
+    name = 'stream'
+
+    @classmethod
+    def detect(cls, path):
+        return os.path.isfile(path)
+
+    def load(self):
+        data_all = None
+        with open(self.path, 'rb') as fin:
+            data_all = bytearray(fin.read())
+        while data_all:
+            yield fileio.load_object(data_all)
+
+    def save(self, notes, dirty):
+        with open(self.path, 'wb') as fout:
+            fout.write(fileio.dump_objects(notes.values()))
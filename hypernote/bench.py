@@ -0,0 +1,216 @@
+"""Benchmark the hot paths on synthetic notebooks.
+
+Usage:
+  python -m hypernote.bench run [-s 1k,100k,1m] [-f format] [-o results.json]
+  python -m hypernote.bench compare old.json new.json [-t threshold]
+
+run times each benchmark (best of several repeats) on generated notebooks of
+each size and writes the results as JSON. compare flags benchmarks that got
+slower than the threshold (a fraction, default 0.1) between two runs, and
+exits with status 1 if any did."""
+from hypernote import note
+from hypernote import registry
+from hypernote import relations
+from hypernote import synth
+from hypernote.output import hyperpage
+from collections import OrderedDict
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import sys
+
+SIZES = OrderedDict((('1k', 1000), ('100k', 100000), ('1m', 1000000)))
+
+# number of queries/texts/pages sampled by the per-item benchmarks
+SAMPLES = 1000
+
+# name -> function(context) returning the number of operations timed
+benchmarks = OrderedDict()
+
+def benchmark(name):
+    """Wrapper that registers a benchmark under the given name."""
+    def benchmark_wrapper(inner):
+        benchmarks[name] = inner
+        return inner
+    return benchmark_wrapper
+
+@benchmark('load')
+def bench_load(ctx):
+    registry.clear()
+    registry.load(ctx['path'])
+    return ctx['count']
+
+@benchmark('save')
+def bench_save(ctx):
+    """Rewrite every note held in memory (only the sampled ones if lazy).
+
+    Only the backend is timed, not the sidecars kept alongside it."""
+    if registry.lazy:
+        for n in ctx['pages']:
+            registry.notes[n.uid] = n
+    registry.dirty.update(registry.notes)
+    registry.store.save(registry.notes, registry.dirty)
+    registry.store.save_relations(registry.relations.reldb,
+                                  registry.relations.new)
+    registry.dirty.clear()
+    return len(registry.notes)
+
+@benchmark('search')
+def bench_search(ctx):
+    for query in ctx['queries']:
+        registry.search(query)
+    return len(ctx['queries'])
+
+@benchmark('autolink')
+def bench_autolink(ctx):
+    holder = ctx['holder']
+    for text in ctx['texts']:
+        note.autolink_text(text, holder)
+    return len(ctx['texts'])
+
+@benchmark('relations.get')
+def bench_relations(ctx):
+    for uid in ctx['rel_queries']:
+        for rel in relations.get((uid,)):
+            pass
+    return len(ctx['rel_queries'])
+
+@benchmark('render')
+def bench_render(ctx):
+    for n in ctx['pages']:
+        hyperpage.genpage_general(n)
+    return len(ctx['pages'])
+
+def make_context(path, notes, seed, samples):
+    """Sample the queries, texts and pages used by the benchmarks."""
+    rng = random.Random(seed)
+    sample = rng.sample(list(notes.values()), min(samples, len(notes)))
+    queries = [str(n) for n in sample[:samples//2]]
+    queries += ['missing{}'.format(i) for i in range(samples - len(queries))]
+    holder = note.ToolNote.__new__(note.ToolNote)
+    holder.cstatus = note.CreationStatus()
+    return dict(
+        path=path,
+        count=len(notes),
+        queries=queries,
+        texts=[n.desc.text for n in sample],
+        holder=holder,
+        rel_queries=[n.uid for n in sample[:max(1, samples//10)]],
+        pages=sample)
+
+def time_benchmark(fun, ctx, repeats):
+    """Run a benchmark repeatedly; return (best seconds, operations)."""
+    best = None
+    for _ in range(repeats):
+        t = perf_counter()
+        ops = fun(ctx)
+        t = perf_counter() - t
+        best = t if best is None else min(best, t)
+    return best, ops
+
+def run(sizes, fmt='stream', repeats=3, seed=0, samples=SAMPLES,
+        only=None, log=sys.stderr):
+    """Run the benchmarks on a generated notebook of each size.
+
+    Return the results as a JSON-serializable dictionary."""
+    results = OrderedDict()
+    for size in sizes:
+        total = SIZES[size] if size in SIZES else int(size)
+        with TemporaryDirectory() as workdir:
+            log.write('[{}] generating {} notes\n'.format(size, total))
+            notes, rels = synth.generate(seed=seed, **synth.split_counts(total))
+            path = os.path.join(workdir, 'bench.hnote')
+            synth.write(path, notes, rels, fmt)
+            ctx = make_context(path, notes, seed, samples)
+            del notes, rels
+            registry.clear()
+            registry.load(path)
+            hyperpage.TEMP_DIR = os.path.join(workdir, 'pages')
+            os.mkdir(hyperpage.TEMP_DIR)
+            size_results = results[size] = OrderedDict()
+            for name, fun in benchmarks.items():
+                if only and name not in only:
+                    continue
+                seconds, ops = time_benchmark(fun, ctx, repeats)
+                size_results[name] = dict(seconds=seconds, ops=ops,
+                                          us_per_op=seconds/ops*1e6)
+                log.write('[{}] {:<16} {:10.4f} s {:12.2f} us/op\n'.format(
+                    size, name, seconds, seconds/ops*1e6))
+            registry.clear()
+    return dict(
+        meta=dict(date=datetime.datetime.now().isoformat(),
+                  python=platform.python_version(),
+                  platform=platform.platform(),
+                  format=fmt, repeats=repeats, seed=seed, samples=samples),
+        results=results)
+
+def compare(old, new, threshold=0.1):
+    """Compare two runs' results.
+
+    Return a list of (size, benchmark, old seconds, new seconds, ratio,
+    regressed) tuples for the benchmarks present in both."""
+    rows = []
+    for size, benches in new['results'].items():
+        for name, res in benches.items():
+            if name not in old['results'].get(size, {}):
+                continue
+            before = old['results'][size][name]['seconds']
+            after = res['seconds']
+            ratio = after/before if before else float('inf')
+            rows.append((size, name, before, after, ratio,
+                         ratio > 1 + threshold))
+    return rows
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='python -m hypernote.bench')
+    commands = parser.add_subparsers(dest='command')
+    p_run = commands.add_parser('run')
+    p_run.add_argument('-s', '--sizes', default='1k,100k',
+                       help='comma-separated sizes (1k, 100k, 1m or counts)')
+    p_run.add_argument('-f', '--format', default='stream')
+    p_run.add_argument('-r', '--repeats', type=int, default=3)
+    p_run.add_argument('-n', '--samples', type=int, default=SAMPLES)
+    p_run.add_argument('-b', '--benchmarks',
+                       help='comma-separated benchmarks to run (default all)')
+    p_run.add_argument('--seed', type=int, default=0)
+    p_run.add_argument('-o', '--output')
+    p_cmp = commands.add_parser('compare')
+    p_cmp.add_argument('old')
+    p_cmp.add_argument('new')
+    p_cmp.add_argument('-t', '--threshold', type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        only = args.benchmarks.split(',') if args.benchmarks else None
+        results = run(args.sizes.split(','), args.format, args.repeats,
+                      args.seed, args.samples, only)
+        text = json.dumps(results, indent=2)
+        if args.output:
+            with open(args.output, 'w') as fout:
+                fout.write(text + '\n')
+        else:
+            print(text)
+        return 0
+    elif args.command == 'compare':
+        with open(args.old) as fin:
+            old = json.load(fin)
+        with open(args.new) as fin:
+            new = json.load(fin)
+        rows = compare(old, new, args.threshold)
+        print('{:<6} {:<16} {:>11} {:>11} {:>7}'.format(
+            'size', 'benchmark', 'old s', 'new s', 'ratio'))
+        for size, name, before, after, ratio, regressed in rows:
+            print('{:<6} {:<16} {:>11.4f} {:>11.4f} {:>7.2f}{}'.format(
+                size, name, before, after, ratio,
+                '  REGRESSION' if regressed else ''))
+        return 1 if any(row[-1] for row in rows) else 0
+    parser.print_help()
+    return 2
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,139 @@
+"""Read and write block-compressed notebooks with random access by UID.
+
+A block file groups encoded notes (sorted by UID) into fixed-size blocks and
+compresses each block on its own. An index at the end of the file maps the
+UID range of every block to its offset, so a single note can be loaded by
+decompressing only the block that holds it."""
+from hypernote import fileio
+from concurrent.futures import ThreadPoolExecutor
+import bisect
+import lzma
+import os
+import struct
+import zlib
+
+MAGIC = b'HNBK'
+FORMAT_VERSION = 1
+DEFAULT_BLOCK_SIZE = 256 # notes per block
+
+# magic, format version, compression code, notes per block
+HEADER = struct.Struct('<4siBi')
+# first uid, last uid, offset, compressed length, number of notes
+INDEX_ENTRY = struct.Struct('<iiqii')
+# index offset, number of blocks, magic
+FOOTER = struct.Struct('<qi4s')
+
+# name -> (code, compress, decompress)
+compressors = {
+    'zlib': (1, zlib.compress, zlib.decompress),
+    'lzma': (2, lzma.compress, lzma.decompress)}
+# code -> decompress
+decompressors = {c[0]: c[2] for c in compressors.values()}
+
+def is_blockfile(path):
+    """Return whether the file at the given path is a block file."""
+    if not os.path.isfile(path):
+        return False
+    with open(path, 'rb') as fin:
+        return fin.read(len(MAGIC)) == MAGIC
+
+def write(path, notes, compression='zlib', block_size=DEFAULT_BLOCK_SIZE):
+    """Write the given notes to a block file at the given path."""
+    if compression not in compressors:
+        raise RuntimeError(
+            "Unknown compression '{}'!".format(compression))
+    code, compress, _ = compressors[compression]
+    notes = sorted(notes, key=lambda n: n.uid)
+    index = []
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fout:
+        fout.write(HEADER.pack(MAGIC, FORMAT_VERSION, code, block_size))
+        for i in range(0, len(notes), block_size):
+            block = notes[i:i+block_size]
+            comp = compress(fileio.dump_objects(block))
+            index.append(INDEX_ENTRY.pack(
+                block[0].uid, block[-1].uid, fout.tell(), len(comp),
+                len(block)))
+            fout.write(comp)
+        index_offset = fout.tell()
+        for entry in index:
+            fout.write(entry)
+        fout.write(FOOTER.pack(index_offset, len(index), MAGIC))
+    os.replace(tmp_path, path)
+
+def read_index(fin):
+    """Read the header and block index of an open block file.
+
+    Return (compression code, list of index entries); each entry is a tuple
+    (first uid, last uid, offset, compressed length, number of notes)."""
+    fin.seek(0)
+    magic, ver, code, _ = HEADER.unpack(fin.read(HEADER.size))
+    if magic != MAGIC:
+        raise RuntimeError('Not a block-compressed notebook!')
+    if ver != FORMAT_VERSION:
+        raise RuntimeError(
+            'Unsupported block file version {}!'.format(ver))
+    fin.seek(-FOOTER.size, os.SEEK_END)
+    index_offset, num_blocks, magic = FOOTER.unpack(fin.read(FOOTER.size))
+    if magic != MAGIC:
+        raise RuntimeError('Block-compressed notebook is truncated!')
+    fin.seek(index_offset)
+    raw = fin.read(num_blocks*INDEX_ENTRY.size)
+    return code, list(INDEX_ENTRY.iter_unpack(raw))
+
+def read_block(fin, code, entry):
+    """Read and decompress one block; return its raw encoded notes."""
+    fin.seek(entry[2])
+    return decompressors[code](fin.read(entry[3]))
+
+def decode_block(data):
+    """Generate the notes encoded in a decompressed block."""
+    data = bytearray(data)
+    while data:
+        yield fileio.load_object(data)
+
+def load_notes(path, uids):
+    """Load the notes with the given UIDs, decompressing only the blocks
+    that hold them.
+
+    Return a dictionary (uid -> note) of the notes found."""
+    found = {}
+    with open(path, 'rb') as fin:
+        code, index = read_index(fin)
+        firsts = [e[0] for e in index]
+        wanted = {} # block number -> uids
+        for uid in uids:
+            i = bisect.bisect_right(firsts, uid) - 1
+            if i >= 0 and uid <= index[i][1]:
+                wanted.setdefault(i, set()).add(uid)
+        for i in sorted(wanted):
+            for n in decode_block(read_block(fin, code, index[i])):
+                if n.uid in wanted[i]:
+                    found[n.uid] = n
+    return found
+
+def load_note(path, uid):
+    """Load a single note, decompressing only the block that holds it.
+
+    Raise a KeyError if no note has the given UID."""
+    return load_notes(path, (uid,))[uid]
+
+def load_all(path, workers=None):
+    """Load every note in the block file, in UID order.
+
+    Blocks are decompressed in parallel by a pool of worker threads (zlib and
+    lzma release the GIL while decompressing); decoding stays serial."""
+    with open(path, 'rb') as fin:
+        code, index = read_index(fin)
+        raw = []
+        for entry in index:
+            fin.seek(entry[2])
+            raw.append(fin.read(entry[3]))
+    decompress = decompressors[code]
+    if len(raw) < 2:
+        blocks = map(decompress, raw)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            blocks = list(pool.map(decompress, raw))
+    for data in blocks:
+        yield from decode_block(data)
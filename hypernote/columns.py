@@ -0,0 +1,89 @@
+"""Export the registry as NumPy columns for vectorized analysis.
+
+NumPy is an optional dependency; it is only needed by this module."""
+from hypernote import note
+from hypernote import utils
+
+# note class -> type code
+TYPE_CODES = {note.ToolNote: 0, note.ActionNote: 1, note.DataNote: 2}
+
+# text attributes exported as packed utf8 buffers
+TEXT_FIELDS = ('name', 'cmd', 'ver', 'shellcmd', 'toolcmd', 'path', 'src',
+               'desc')
+
+# stored for the times of notes that have none
+NAT = -2**63
+
+def import_numpy(feature='Columnar export'):
+    """Import NumPy, or fail with a helpful message."""
+    try:
+        import numpy
+    except ImportError:
+        raise RuntimeError('{} requires NumPy to be installed (pip install'
+                           ' HyperNote[numpy]).'.format(feature))
+    return numpy
+
+def field_text(n, attr):
+    """Get the plain text of a note attribute ('' if it has none)."""
+    val = getattr(n, attr, '')
+    return val.text if isinstance(val, note.LinkedText) else val
+
+def to_columns(notes):
+    """Build columns from a dictionary (uid -> note) in a single pass.
+
+    Return a dictionary (column name -> NumPy array):
+    uid: int32 UIDs.
+    type: int8 codes (see TYPE_CODES); type_names: names indexed by code.
+    time: datetime64[us] times (NaT for notes without one).
+    tool_id: int32 index into tools (the tool of an action or the command
+        of a tool), -1 if none.
+    path_id: int32 index into paths (the path of a data note), -1 if none.
+    <field>_text, <field>_offsets: for each text field, a packed uint8 buffer
+        of utf8 text and int64 offsets; note i's text is
+        text[offsets[i]:offsets[i+1]]."""
+    np = import_numpy()
+    uids = []
+    types = []
+    times = []
+    tool_ids = []
+    path_ids = []
+    tools = {} # tool -> id
+    paths = {} # path -> id
+    texts = {f: bytearray() for f in TEXT_FIELDS}
+    offsets = {f: [0] for f in TEXT_FIELDS}
+    for n in notes.values():
+        uids.append(n.uid)
+        types.append(TYPE_CODES[type(n)])
+        time = getattr(n, 'time', None)
+        times.append(NAT if time is None else utils.to_micros(time))
+        tool = None
+        if type(n) == note.ActionNote:
+            tool = n.toolcmd.text
+        elif type(n) == note.ToolNote:
+            tool = n.cmd
+        tool_ids.append(-1 if tool is None else tools.setdefault(
+            tool, len(tools)))
+        path = getattr(n, 'path', None)
+        path_ids.append(-1 if path is None else paths.setdefault(
+            path, len(paths)))
+        for f in TEXT_FIELDS:
+            texts[f] += field_text(n, f).encode('utf8')
+            offsets[f].append(len(texts[f]))
+    columns = dict(
+        uid=np.array(uids, dtype=np.int32),
+        type=np.array(types, dtype=np.int8),
+        type_names=np.array([c.__name__ for c in TYPE_CODES], dtype=str),
+        time=np.array(times, dtype=np.int64).view('datetime64[us]'),
+        tool_id=np.array(tool_ids, dtype=np.int32),
+        tools=np.array(list(tools), dtype=str),
+        path_id=np.array(path_ids, dtype=np.int32),
+        paths=np.array(list(paths), dtype=str))
+    for f in TEXT_FIELDS:
+        columns[f + '_text'] = np.frombuffer(bytes(texts[f]), dtype=np.uint8)
+        columns[f + '_offsets'] = np.array(offsets[f], dtype=np.int64)
+    return columns
+
+def save_npz(path, columns):
+    """Save columns to a compressed .npz file."""
+    np = import_numpy()
+    np.savez_compressed(path, **columns)
@@ -0,0 +1,186 @@
+"""Find clusters of near-identical ActionNotes with MinHash and LSH.
+
+The shell command and description of each action are split into a set of
+shingles (terms, the pieces of terms such as paths, and pairs of adjacent
+command terms). A MinHash signature of NUM_HASHES minimums estimates the
+Jaccard similarity of two such sets; signatures are computed for many notes
+at once with NumPy and cached per UID, so only new or changed notes are
+hashed again. Signatures are then cut into BANDS bands, and only notes
+sharing a band are compared, so clusters are found in near-linear time.
+
+NumPy is an optional dependency; it is only needed by this module and
+columns."""
+from hypernote import columns
+from hypernote import fulltext
+from hypernote import note
+from hypernote import utils
+import hashlib
+import os
+import pickle
+import re
+import zlib
+
+NUM_HASHES = 128
+BANDS = 32 # NUM_HASHES must be a multiple of this
+SEED = 0
+
+# prime modulus of the hash functions (a*x + b) % PRIME
+PRIME = 2**31 - 1
+
+# notes with at least this estimated similarity are clustered
+THRESHOLD = 0.7
+
+# maximum shingles hashed at once (bounds memory to about
+# NUM_HASHES*BATCH_SHINGLES*8 bytes)
+BATCH_SHINGLES = 1 << 16
+
+PIECE = re.compile(r'[^\W_]+')
+
+def shingles(n):
+    """Get the set of shingles of an action's command and description."""
+    found = set()
+    cmd = [t[2] for t in fulltext.tokenize(n.shellcmd.text)]
+    for terms in (cmd, [t[2] for t in fulltext.tokenize(n.desc.text)]):
+        for term in terms:
+            found.add(term)
+            found.update(PIECE.findall(term))
+    found.update(a + ' ' + b for a, b in zip(cmd, cmd[1:]))
+    return found
+
+def digest(n):
+    """Hash the text a signature is computed from (to detect changes)."""
+    return hashlib.blake2b('{}\0{}'.format(
+        n.shellcmd.text, n.desc.text).encode('utf8'), digest_size=8).digest()
+
+def hash_params(np):
+    """Get the (a, b) coefficients of the hash functions."""
+    rng = np.random.RandomState(SEED)
+    a = rng.randint(1, PRIME, NUM_HASHES).astype(np.uint64)
+    b = rng.randint(0, PRIME, NUM_HASHES).astype(np.uint64)
+    return a[:, None], b[:, None]
+
+def signatures(shingle_sets):
+    """Compute the MinHash signatures of non-empty sets of shingles.
+
+    Return a (len(shingle_sets), NUM_HASHES) uint32 array."""
+    np = columns.import_numpy('Deduplication')
+    a, b = hash_params(np)
+    sigs = np.empty((len(shingle_sets), NUM_HASHES), dtype=np.uint32)
+    i = 0
+    while i < len(shingle_sets):
+        # take sets until the batch is full (at least one)
+        j = i
+        values = []
+        starts = []
+        while j < len(shingle_sets) and (
+                j == i or len(values) + len(shingle_sets[j]) <= BATCH_SHINGLES):
+            starts.append(len(values))
+            values += [zlib.crc32(s.encode('utf8')) for s in shingle_sets[j]]
+            j += 1
+        x = np.array(values, dtype=np.uint64) % PRIME
+        hashed = (a*x[None, :] + b) % PRIME
+        sigs[i:j] = np.minimum.reduceat(hashed, starts, axis=1).T
+        i = j
+    return sigs
+
+def cache_path(notebook_path):
+    """Get the path of the signature cache for the given notebook."""
+    return utils.sidecar_path(notebook_path, 'minhash')
+
+def load_cache(notebook_path):
+    """Load the signature cache; return a dictionary (uid -> (digest, sig)).
+
+    A cache made with other hash parameters is ignored."""
+    path = cache_path(notebook_path)
+    if not os.path.isfile(path):
+        return {}
+    with open(path, 'rb') as fin:
+        params, cache = pickle.load(fin)
+    return cache if params == (NUM_HASHES, SEED) else {}
+
+def save_cache(notebook_path, cache):
+    """Save the signature cache."""
+    with open(cache_path(notebook_path), 'wb') as fout:
+        pickle.dump(((NUM_HASHES, SEED), cache), fout,
+                    pickle.HIGHEST_PROTOCOL)
+
+def note_signatures(notebook_path, notes):
+    """Get the signatures of the given ActionNotes, hashing only those not
+    cached.
+
+    Notes without shingles are left out. Return (list of uids, signature
+    array)."""
+    np = columns.import_numpy('Deduplication')
+    cache = load_cache(notebook_path)
+    new_cache = {}
+    todo = [] # (uid, digest, shingles)
+    for n in notes:
+        d = digest(n)
+        if n.uid in cache and cache[n.uid][0] == d:
+            new_cache[n.uid] = cache[n.uid]
+        else:
+            found = shingles(n)
+            if found:
+                todo.append((n.uid, d, list(found)))
+    if todo:
+        for (uid, d, _), sig in zip(todo,
+                                    signatures([t[2] for t in todo])):
+            new_cache[uid] = (d, sig.tobytes())
+    if new_cache != cache:
+        save_cache(notebook_path, new_cache)
+    uids = sorted(new_cache)
+    sigs = np.frombuffer(b''.join(new_cache[uid][1] for uid in uids),
+                         dtype=np.uint32).reshape(len(uids), NUM_HASHES)
+    return uids, sigs
+
+def find(parent, i):
+    """Find the root of i's set in a union-find forest."""
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+def cluster(sigs, threshold=THRESHOLD):
+    """Cluster signatures by locality-sensitive hashing.
+
+    Rows sharing a band are candidates; each candidate is joined to the
+    first row of the band's bucket if their estimated similarity reaches the
+    threshold. Return a list of clusters (lists of row indices) of two or
+    more rows, largest first."""
+    np = columns.import_numpy('Deduplication')
+    parent = list(range(len(sigs)))
+    rows = NUM_HASHES//BANDS
+    for band in range(BANDS):
+        keys = np.ascontiguousarray(sigs[:, band*rows:(band+1)*rows])
+        keys = keys.view(np.dtype((np.void, keys.dtype.itemsize*rows)))[:, 0]
+        _, inverse, counts = np.unique(keys, return_inverse=True,
+                                       return_counts=True)
+        shared = np.flatnonzero(counts[inverse] > 1)
+        if not len(shared):
+            continue
+        order = shared[np.argsort(inverse[shared], kind='stable')]
+        buckets = np.split(order, np.flatnonzero(
+            np.diff(inverse[order])) + 1)
+        for bucket in buckets:
+            first = bucket[0]
+            similar = (sigs[bucket[1:]] == sigs[first]).mean(axis=1)
+            root = find(parent, first)
+            for i in bucket[1:][similar >= threshold]:
+                other = find(parent, i)
+                if other != root:
+                    parent[other] = root
+    clusters = {}
+    for i in range(len(sigs)):
+        clusters.setdefault(find(parent, i), []).append(i)
+    return sorted((c for c in clusters.values() if len(c) > 1),
+                  key=lambda c: (-len(c), c[0]))
+
+def near_duplicates(notebook_path, notes, threshold=THRESHOLD):
+    """Find clusters of similar ActionNotes among a dictionary (uid -> note).
+
+    Return a list of clusters (lists of notes in time order), largest
+    first."""
+    actions = [n for n in notes.values() if type(n) == note.ActionNote]
+    uids, sigs = note_signatures(notebook_path, actions)
+    return [sorted((notes[uids[i]] for i in c), key=lambda n: n.time)
+            for c in cluster(sigs, threshold)]
@@ -1,5 +1,7 @@
 """Handle registry input/output, including multiversion compatibility."""
 from hypernote import note
+from hypernote import utils
+from hypernote import profiling
 from collections import OrderedDict
 import struct
 import string
@@ -53,6 +55,7 @@ def get_decoder(typecode, version):
     """Get the decoder corresponding to the given typecode and version."""
     return decoders[typecode, version]
 
+@profiling.timed('fileio.load_object')
 def load_object(b):
     """Load the next object present in the given bytearray."""
     tc = extract_typecode(b)
@@ -75,9 +78,9 @@ def encode_from_datascheme(n, scheme):
 @encoder(str)
 def e_s_1(s):
     """Encode a string."""
-    b = get_encoder(int)(len(s))
-    b += bytes(s, 'utf8')
-    return b
+    data = bytes(s, 'utf8')
+    # the length is in bytes (d_s_1 reads that many)
+    return get_encoder(int)(len(data)) + data
 
 @encoder(int)
 def e_i_1(i):
@@ -94,6 +97,11 @@ def e_t_1(ts):
     """Encode a timestamp."""
     return get_encoder(float)(ts.timestamp())
 
+@encoder(datetime)
+def e_t_2(ts):
+    """Encode a timestamp as int64 microseconds (see utils.to_micros)."""
+    return struct.pack('<q', utils.to_micros(ts))
+
 @encoder(note.LinkedText)
 def e_L_1(lt):
     """Encode LinkedText."""
@@ -140,10 +148,7 @@ def extract_version(data):
 def decode_from_datascheme(data, dtype, scheme):
     """Encode a note from a datascheme."""
     # bypass calling the Note() constructor
-    class EmptyClass:
-        pass
-    obj = EmptyClass()
-    obj.__class__ = dtype
+    obj = dtype.__new__(dtype)
     for attr in scheme:
         try:
             setattr(obj, attr,
@@ -180,6 +185,13 @@ def e_t_1(b):
     ts = load_object(b) # float
     return datetime.fromtimestamp(ts)
 
+@decoder
+def d_t_2(b):
+    """Decode a timestamp stored as int64 microseconds."""
+    ret = struct.unpack('<q', b[:8])[0]
+    del b[:8]
+    return utils.from_micros(ret)
+
 @decoder
 def d_L_1(b):
     """Decode LinkedText."""
@@ -214,3 +226,189 @@ def d_D_1(d):
     return decode_from_datascheme(
         d, note.DataNote,
         ('uid', 'name', 'path', 'src', 'desc'))
+
+# ----------------------
+# --- COMPILED CODECS --
+# ----------------------
+# Note encodings from version 2 on (version 3 for ActionNote, which stores
+# its time as int64 microseconds, and 4, which adds what is recorded of its
+# runs) are produced by codecs compiled from each note class's schema. All
+# fixed-width values (the uid, timestamps, and the lengths of every
+# variable-width field) are packed up front with one precompiled struct,
+# followed by the raw utf8 text and link arrays. Fields carry no per-value
+# typecode or version.
+
+# dictionary (type -> NoteCodec) of the current compiled note codecs
+codecs = {}
+
+# dictionary ((typecode, version) -> NoteCodec) of every compiled codec
+codec_versions = {}
+
+# part loader -> field kind
+# kinds: 'i' int, 'q' int64, 't' timestamp (int64 microseconds),
+#        's' string, 'L' LinkedText, 'd' legacy timestamp (double seconds)
+loader_kinds = {
+    note.raw_string: 's',
+    note.normalize_path: 's',
+    note.autolink_text: 'L',
+    note.parse_timestamp: 't'}
+
+# link start, link end, link dest
+LINK = struct.Struct('<iii')
+
+def note_schema(dtype, replace={}, extras=True):
+    """Get the (attribute, kind) pairs stored for the given note class.
+
+    replace: dictionary (kind -> kind) of substitutions, and extras: whether
+    to include the class's extra attributes; both for describing older
+    encoding versions."""
+    schema = (('uid', 'i'),) + tuple(
+        (part.name, loader_kinds[part.loader]) for part in dtype.parts)
+    if extras:
+        schema += dtype.extras
+    return tuple((attr, replace.get(kind, kind)) for attr, kind in schema)
+
+def links_from_bytes(text, raw):
+    """Build LinkedText from its text and packed link array."""
+    return note.LinkedText.from_spans(text, LINK.iter_unpack(raw))
+
+class NoteCodec:
+    """A specialised encoder/decoder for one note class."""
+    # field kind -> (struct format, encode expression, decode expression)
+    fixed_kinds = {
+        'i': ('i', '{}', '{}'),
+        'q': ('q', '{}', '{}'),
+        't': ('q', '_to_micros({})', '_from_micros({})'),
+        'd': ('d', '{}.timestamp()', '_fromtimestamp({})')}
+
+    def __init__(self, dtype, typecode, version, schema=None):
+        """Compile a codec for the given note class.
+
+        schema defaults to the class's current schema (uid + parts)."""
+        self.dtype = dtype
+        self.typecode = typecode
+        self.version = version
+        self.schema = note_schema(dtype) if schema is None else schema
+        self.prefix = bytes(typecode, 'utf8') + struct.pack('<i', version)
+        self.source = self.generate()
+        namespace = dict(
+            _cls=dtype, _new=object.__new__, _link=LINK,
+            _links=links_from_bytes,
+            _fromtimestamp=datetime.fromtimestamp,
+            _to_micros=utils.to_micros, _from_micros=utils.from_micros)
+        exec(self.source, namespace)
+        self.head = namespace['_head']
+        self.encode_into = namespace['encode_into']
+        self.decode = namespace['decode']
+
+    def generate(self):
+        """Generate the source code of the specialised functions."""
+        head_fmt = '<'
+        head_enc = [] # expressions packed into the head
+        head_dec = [] # names unpacked from the head
+        enc = [] # encode_into body
+        tail_enc = [] # statements appending variable-width data
+        dec = [] # decode body
+        sizes = [] # expressions summing to the variable-width data's size
+        for i, (attr, kind) in enumerate(self.schema):
+            if kind in self.fixed_kinds:
+                fmt, e, d = self.fixed_kinds[kind]
+                head_fmt += fmt
+                head_enc.append(e.format('n.'+attr))
+                head_dec.append('h{}'.format(i))
+                dec.append("d['{}'] = {}".format(attr, d.format(head_dec[-1])))
+            elif kind == 's':
+                enc.append("v{} = n.{}.encode('utf8')".format(i, attr))
+                head_fmt += 'I'
+                head_enc.append('len(v{})'.format(i))
+                head_dec.append('h{}'.format(i))
+                tail_enc.append('out += v{}'.format(i))
+                sizes.append('h{}'.format(i))
+                dec.append("e = o + h{0}; d['{1}'] = b[o:e].decode('utf8');"
+                           " o = e".format(i, attr))
+            elif kind == 'L':
+                enc.append("v{0} = n.{1}.text.encode('utf8');"
+                           " k{0} = n.{1}.links".format(i, attr))
+                head_fmt += 'II'
+                head_enc += ['len(v{})'.format(i), 'len(k{})'.format(i)]
+                head_dec += ['h{}'.format(i), 'c{}'.format(i)]
+                sizes += ['h{}'.format(i), '{}*c{}'.format(LINK.size, i)]
+                tail_enc.append('out += v{}'.format(i))
+                tail_enc.append(
+                    'for l in k{}: out += _link.pack('
+                    'l.pos.start, l.pos.end, l.dest)'.format(i))
+                dec.append("e = o + h{0}; t = b[o:e].decode('utf8'); o = e"
+                           .format(i))
+                dec.append("e = o + {0}*c{1}; d['{2}'] = _links(t, b[o:e]);"
+                           " o = e".format(LINK.size, i, attr))
+            else:
+                raise RuntimeError(
+                    "Unknown field kind '{}' for '{}'!".format(kind, attr))
+        lines = ['_head = struct.Struct({!r})'.format(head_fmt)]
+        lines.append('def encode_into(n, out):')
+        lines += ['    ' + l for l in enc]
+        lines.append('    out += _head.pack({})'.format(', '.join(head_enc)))
+        lines += ['    ' + l for l in tail_enc]
+        truncated = "        raise ValueError('Truncated {} encoding!')" \
+            .format(self.dtype.__name__)
+        lines.append('def decode(b):')
+        lines.append('    if len(b) < _head.size:')
+        lines.append(truncated)
+        lines.append('    {}, = _head.unpack_from(b)'.format(
+            ', '.join(head_dec)))
+        lines.append('    o = _head.size')
+        if sizes:
+            lines.append('    if len(b) < o + {}:'.format(' + '.join(sizes)))
+            lines.append(truncated)
+        lines.append('    obj = _new(_cls)')
+        lines.append('    d = obj.__dict__')
+        lines += ['    ' + l for l in dec]
+        lines.append('    del b[:o]')
+        lines.append('    return obj')
+        return 'import struct\n' + '\n'.join(lines) + '\n'
+
+    def dump(self, n, out):
+        """Append the full encoding (with typecode and version) to out."""
+        out += self.prefix
+        self.encode_into(n, out)
+
+    def encode(self, n):
+        """Return the full encoding (with typecode and version) as bytes."""
+        out = bytearray()
+        self.dump(n, out)
+        return bytes(out)
+
+def compile_codec(dtype, typecode, version, schema=None):
+    """Compile a note codec and register it as an encoder and decoder."""
+    codec = NoteCodec(dtype, typecode, version, schema)
+    codecs[dtype] = codec
+    codec_versions[typecode, version] = codec
+    encoders[dtype] = codec.encode
+    decoders[typecode, version] = codec.decode
+    return codec
+
+def dump_object(obj, out):
+    """Append the encoding of the given object to the bytearray out."""
+    codec = codecs.get(type(obj))
+    if codec is not None:
+        codec.dump(obj, out)
+    else:
+        out += get_encoder(type(obj))(obj)
+
+@profiling.timed('fileio.dump_objects')
+def dump_objects(objs):
+    """Encode all the given objects into a single bytearray."""
+    out = bytearray()
+    for obj in objs:
+        dump_object(obj, out)
+    return out
+
+compile_codec(note.ToolNote, 'T', 2)
+compile_codec(note.ActionNote, 'A', 2,
+              note_schema(note.ActionNote, {'t': 'd'}, extras=False))
+compile_codec(note.ActionNote, 'A', 3,
+              note_schema(note.ActionNote, extras=False))
+compile_codec(note.ActionNote, 'A', 4)
+compile_codec(note.DataNote, 'D', 2,
+              note_schema(note.DataNote, extras=False))
+compile_codec(note.DataNote, 'D', 3)
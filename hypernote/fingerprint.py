@@ -0,0 +1,100 @@
+"""Fingerprint the data files that DataNotes point to.
+
+Files are hashed through mmap in fixed-size chunks, several files at a time
+on a thread pool (hashlib releases the GIL while hashing). Digests are cached
+by (device, inode, size, mtime_ns), so a file that has not changed since it
+was last hashed is never read again."""
+from hypernote import utils
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import mmap
+import os
+import pickle
+
+ALGORITHM = 'sha256'
+CHUNK_SIZE = 16 << 20
+
+# verification statuses
+OK = 'ok'
+STALE = 'stale' # no fingerprint had been recorded for the file
+CHANGED = 'changed'
+MISSING = 'missing'
+
+def stat_key(st):
+    """Get the cache key of a file from its stat result."""
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+def hash_file(path):
+    """Hash a file's contents; return the fingerprint string."""
+    h = hashlib.new(ALGORITHM)
+    with open(path, 'rb') as fin:
+        if os.fstat(fin.fileno()).st_size > 0:
+            with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                view = memoryview(mm)
+                for i in range(0, len(view), CHUNK_SIZE):
+                    h.update(view[i:i+CHUNK_SIZE])
+                view.release()
+    return '{}:{}'.format(ALGORITHM, h.hexdigest())
+
+def cache_path(notebook_path):
+    """Get the path of the fingerprint cache for the given notebook."""
+    return utils.sidecar_path(notebook_path, 'fpcache')
+
+def load_cache(notebook_path):
+    """Load the fingerprint cache; return a dictionary (stat key -> digest)."""
+    path = cache_path(notebook_path)
+    if not os.path.isfile(path):
+        return {}
+    with open(path, 'rb') as fin:
+        return pickle.load(fin)
+
+def save_cache(notebook_path, cache):
+    """Save the fingerprint cache."""
+    with open(cache_path(notebook_path), 'wb') as fout:
+        pickle.dump(cache, fout, pickle.HIGHEST_PROTOCOL)
+
+def fingerprint_files(paths, cache, workers=None):
+    """Fingerprint many files, hashing only those not in the cache.
+
+    Return (dictionary (path -> fingerprint, or None if the file is missing),
+    new cache holding only the entries for the given files)."""
+    results = {}
+    new_cache = {}
+    to_hash = {} # path -> stat key
+    for path in paths:
+        try:
+            key = stat_key(os.stat(path))
+        except FileNotFoundError:
+            results[path] = None
+            continue
+        if key in cache:
+            results[path] = new_cache[key] = cache[key]
+        else:
+            to_hash[path] = key
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for path, fp in zip(to_hash, pool.map(hash_file, to_hash)):
+            results[path] = new_cache[to_hash[path]] = fp
+    return results, new_cache
+
+def verify(notebook_path, data_notes, root, workers=None):
+    """Check the files of the given DataNotes against their fingerprints.
+
+    root is the directory relative paths are resolved against. Return a list
+    of (note, status, current fingerprint) tuples."""
+    full_paths = [os.path.join(root, n.path) for n in data_notes]
+    cache = load_cache(notebook_path)
+    fps, cache = fingerprint_files(set(full_paths), cache, workers)
+    save_cache(notebook_path, cache)
+    report = []
+    for n, path in zip(data_notes, full_paths):
+        fp = fps[path]
+        if fp is None:
+            status = MISSING
+        elif not n.fingerprint:
+            status = STALE
+        elif fp != n.fingerprint:
+            status = CHANGED
+        else:
+            status = OK
+        report.append((n, status, fp))
+    return report
@@ -4,13 +4,31 @@ from hypernote.input.editor import input_note
 from hypernote import note
 from hypernote import registry
 from hypernote import utils
+from hypernote import fulltext
+from hypernote import fingerprint
+from hypernote import columns
+from hypernote import dedupe
+from hypernote import profiling
+from hypernote import sync
+from hypernote import fsck
+from hypernote import runlog
 import hypernote.output.hyperpage
-import subprocess
+import hypernote.output.htmlsite
+import os
+import tempfile
+
+# sidecars carried over by migrate (see utils.sidecar_path)
+MIGRATED_SIDECARS = ('history', 'logs', 'minhash', 'fpcache')
+# sidecars keyed by the stamp of the notebook's files, which migrate drops
+# (they are rebuilt when next needed, and 'tools' by init)
+STAMPED_SIDECARS = ('fts', 'fts-log', 'merkle', 'merkle-log', 'tools')
 
 def main():
     """Entry point; handles exceptions thrown by main_internal()."""
+    profiling.configure(sys.argv)
     try:
-        main_internal()
+        with profiling.session():
+            main_internal()
     except RuntimeError as err:
         sys.stderr.write(str(err) + '\n')
         return -1
@@ -82,7 +100,8 @@ def public_cmd_help(args):
             name = '_'.join(token.split('_')[2:])
             cmds[name] = globals()[token].__doc__
 
-    msg = 'hnote <cmd> [args...]\nCommands:\n\n'
+    msg = ('hnote [--profile[=output]] <cmd> [args...]\n'
+           'Commands:\n\n')
     for cmd in cmds:
         if cmds[cmd].__doc__ is not None:
             desc_lines = [l.strip() for l in cmds[cmd].split('\n')]
@@ -100,6 +119,30 @@ def parse_prefilled_standard(args, trans):
         prefilled[trans[arg[1]]] = arg[2:]
     return prefilled
 
+def parse_long_options(args, valued=(), flags=()):
+    """Parse '--name value', '--name=value' and '--flag' arguments.
+
+    Return (dictionary of options, remaining args); flags map to True."""
+    opts = {}
+    rest = []
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        name, eq, val = arg[2:].partition('=')
+        if not arg.startswith('--'):
+            rest.append(arg)
+        elif name in flags and not eq:
+            opts[name] = True
+        elif name in valued:
+            if not eq:
+                if not args:
+                    raise RuntimeError("Missing value for '{}'".format(arg))
+                val = args.pop(0)
+            opts[name] = val
+        else:
+            raise RuntimeError("Invalid argument: '{}'".format(arg))
+    return opts, rest
+
 def create_note_standard(note_type, vals):
     """Create and register a new note; handle the creation Signal."""
     new_note = None
@@ -140,25 +183,306 @@ public_cmd_action = standard_note_registration_command(
     note.ActionNote,
     dict(s='shellcmd', t='toolcmd', w='time', d='desc'))
 
-@use_reg
 def public_cmd_run(args):
     """run -s"shell command" [-t"tool"] [-w"time"] [-d"description"]
-    Run and record a shell command."""
+    Run and record a shell command.
+    Its output is also logged (gzipped) alongside the notebook, and the
+    start and end of it are added to the description."""
     uid = public_cmd_action(args)
+    path = utils.find_registry()
     shellcmd = registry.get(uid).shellcmd.text
-    subprocess.run(shellcmd, shell=True)
+    result = runlog.run(shellcmd, runlog.log_dir(path, uid))
+    desc = registry.get(uid).desc + note.LinkedText.from_spans(
+        result.excerpt(), ())
+    registry.update(uid, desc=desc, stdout_bytes=result.stdout.size,
+                    stderr_bytes=result.stderr.size, runtime=result.runtime,
+                    returncode=result.returncode)
+    registry.save(path)
     return uid
 
+def parse_format_options(args):
+    """Parse the -f"format" and -n"shards" arguments of init/migrate."""
+    opts = parse_prefilled_standard(args, dict(f='format', n='shards'))
+    fmt = opts.get('format', 'stream')
+    options = {}
+    if 'shards' in opts:
+        if fmt != 'sharded':
+            raise RuntimeError('A shard count requires the sharded format.')
+        try:
+            options['num_shards'] = int(opts['shards'])
+        except ValueError:
+            raise RuntimeError(
+                "Invalid shard count '{}'!".format(opts['shards']))
+    return fmt, options
+
 def public_cmd_init(args):
-    """init
-    Create an (empty) notebook in this directory."""
-    registry.save('./.hnote')
+    """init [-f"format"] [-n"shards"]
+    Create an (empty) notebook in this directory.
+    Formats: stream (default), block (block-compressed),
+    sharded (a directory of shard files), sqlite."""
+    fmt, options = parse_format_options(args)
+    registry.init('./.hnote', fmt, **options)
+
+def public_cmd_migrate(args):
+    """migrate -f"format" [-n"shards"]
+    Convert the notebook to another storage format.
+    The old notebook is kept alongside it with a '.bak' suffix; its history,
+    run logs and caches move to the new one."""
+    fmt, options = parse_format_options(args)
+    path = utils.find_registry()
+    if path is None:
+        raise RuntimeError(
+            "Registry not found! Use 'hnote init' to create one.")
+    registry.load(path)
+    registry.load_all()
+    old_files = [f for f in registry.store.files() if os.path.exists(f)]
+    for f in old_files:
+        if os.path.exists(f + '.bak'):
+            raise RuntimeError("Backup '{}' already exists!".format(f + '.bak'))
+    # set the sidecars aside, since they may live inside the notebook
+    # directory; the stamped ones are rebuilt from the new notebook
+    for name in STAMPED_SIDECARS:
+        stale = utils.sidecar_path(path, name)
+        if os.path.isfile(stale):
+            os.remove(stale)
+    kept = tempfile.mkdtemp(prefix='.hnote-migrate-',
+                            dir=os.path.dirname(os.path.abspath(path)))
+    for name in MIGRATED_SIDECARS:
+        if os.path.exists(utils.sidecar_path(path, name)):
+            os.replace(utils.sidecar_path(path, name),
+                       os.path.join(kept, name))
+    for f in old_files:
+        os.replace(f, f + '.bak')
+    try:
+        registry.init(path, fmt, **options)
+        for name in os.listdir(kept):
+            dest = utils.sidecar_path(path, name)
+            if os.path.exists(dest):
+                raise RuntimeError("'{}' already exists!".format(dest))
+            os.replace(os.path.join(kept, name), dest)
+    except (OSError, RuntimeError) as err:
+        raise RuntimeError(
+            "Migration failed: {} The old notebook is kept with a '.bak' "
+            "suffix, and its history and logs in '{}'.".format(err, kept))
+    os.rmdir(kept)
+
+@use_reg
+def public_cmd_grep(args):
+    """grep <query> [-l"limit"]
+    Search note descriptions; print the best matches first."""
+    words = [a for a in args if not a.startswith('-')]
+    opts = parse_prefilled_standard(
+        [a for a in args if a.startswith('-')], dict(l='limit'))
+    if not words:
+        raise RuntimeError('No search query given!')
+    try:
+        limit = int(opts.get('limit', 10))
+    except ValueError:
+        raise RuntimeError("Invalid limit '{}'!".format(opts['limit']))
+    query = ' '.join(words)
+    hits = fulltext.search(utils.find_registry(), registry.store, query, limit)
+    highlight = ('\033[1m', '\033[0m') if sys.stdout.isatty() else ('*', '*')
+    w = sys.stdout.write
+    for uid, score in hits:
+        n = registry.get(uid)
+        w('{} [{}] ({:.2f})\n'.format(str(n), uid, score))
+        w('    {}\n'.format(
+            fulltext.snippet(fulltext.note_text(n), query,
+                             highlight=highlight)))
+
+@use_reg
+def public_cmd_dedupe(args):
+    """dedupe [-t"threshold"]
+    List clusters of near-identical actions (similar shell commands and
+    descriptions). threshold is the similarity (0-1, default 0.7) at which
+    two actions count as near-identical."""
+    opts = parse_prefilled_standard(args, dict(t='threshold'))
+    try:
+        threshold = float(opts.get('threshold', dedupe.THRESHOLD))
+    except ValueError:
+        raise RuntimeError("Invalid threshold '{}'!".format(opts['threshold']))
+    registry.load_all()
+    clusters = dedupe.near_duplicates(utils.find_registry(), registry.notes,
+                                      threshold)
+    w = sys.stdout.write
+    for found in clusters:
+        w('{} similar actions:\n'.format(len(found)))
+        for n in found:
+            w('    [{}] {}: {}\n'.format(n.uid, n.time, n.shellcmd.text))
+    w('{} clusters of {} actions found\n'.format(
+        len(clusters), sum(len(found) for found in clusters)))
+
+@use_reg
+def public_cmd_verify(args):
+    """verify [-u]
+    Check the files of all data notes against their recorded fingerprints.
+    Fingerprints are recorded for files that have none; -u also accepts the
+    new contents of changed files."""
+    if args not in ([], ['-u']):
+        raise RuntimeError("Invalid arguments: '{}'".format(' '.join(args)))
+    accept_changes = args == ['-u']
+    registry.load_all()
+    data_notes = [n for n in registry.notes.values()
+                  if type(n) == note.DataNote]
+    report = fingerprint.verify(utils.find_registry(), data_notes,
+                                note.notebook_root())
+    w = sys.stdout.write
+    counts = {}
+    for n, status, fp in report:
+        counts[status] = counts.get(status, 0) + 1
+        if status == fingerprint.STALE or (
+                status == fingerprint.CHANGED and accept_changes):
+            registry.update(n.uid, fingerprint=fp)
+        if status != fingerprint.OK:
+            w('{:8} {} ({})\n'.format(status, str(n), n.path))
+    w('{} files checked: {}\n'.format(len(report), ', '.join(
+        '{} {}'.format(counts[s], s) for s in sorted(counts))))
+
+def public_cmd_fsck(args):
+    """fsck [-r]
+    Check the notebook's encoding, and look for links and relations that
+    point to notes which do not exist. -r removes such dangling references.
+    Exits with an error status if any problems remain."""
+    if args not in ([], ['-r']):
+        raise RuntimeError("Invalid arguments: '{}'".format(' '.join(args)))
+    path = utils.find_registry()
+    if path is None:
+        raise RuntimeError(
+            "Registry not found! Use 'hnote init' to create one.")
+    report = fsck.check(path)
+    w = sys.stdout.write
+    for where, message in report.errors:
+        w('damaged: {}: {}\n'.format(where, message))
+    for uid in report.duplicates:
+        w('duplicate uid: {}\n'.format(uid))
+    for src, dest in report.dangling_links:
+        w('dangling link: note {} links to missing note {}\n'.format(
+            src, dest))
+    for rel in report.dangling_relations:
+        w('dangling relation: {} - {}\n'.format(rel.uidA, rel.uidB))
+    w('{} notes, {} links, {} relations checked: {}\n'.format(
+        report.notes, report.links, report.relations,
+        'ok' if report.ok() else 'problems found'))
+    if args == ['-r'] and (report.dangling_links or report.dangling_relations):
+        if report.errors:
+            raise RuntimeError('Cannot repair a damaged notebook!')
+        registry.load(path)
+        fsck.repair(report)
+        registry.save(path)
+        w('dangling references removed\n')
+        unfixed = report.errors or report.duplicates
+    else:
+        unfixed = not report.ok()
+    if unfixed:
+        raise RuntimeError('Notebook check failed!')
+
+@use_reg
+def public_cmd_export(args):
+    """export --format npz|html [-o"output"]
+    Export the notebook.
+    npz: NumPy columns for analysis (default output notebook.npz).
+    html (or --html): a static site with search (default output
+    notebook-html/); open index.html in a browser."""
+    opts, rest = parse_long_options(args, valued=('format',), flags=('html',))
+    opts.update(parse_prefilled_standard(rest, dict(o='output')))
+    fmt = 'html' if opts.get('html') else opts.get('format')
+    if fmt == 'npz':
+        columns.save_npz(opts.get('output', 'notebook.npz'),
+                         registry.to_columns())
+    elif fmt == 'html':
+        hypernote.output.htmlsite.export(opts.get('output', 'notebook-html'))
+    else:
+        raise RuntimeError("Unknown export format '{}'!".format(fmt))
+
+@use_reg
+def public_cmd_sync(args):
+    """sync <path> [--ours | --theirs]
+    Merge this notebook with the one at path (a notebook or a directory
+    holding one), copying notes and relations both ways. Notes that differ
+    between the two are reported and left alone, unless --ours or --theirs
+    says which version wins."""
+    opts, rest = parse_long_options(args, flags=('ours', 'theirs'))
+    if len(rest) != 1:
+        raise RuntimeError('Give the path of one notebook to sync with!')
+    if len(opts) > 1:
+        raise RuntimeError('Give only one of --ours and --theirs!')
+    other = rest[0]
+    if os.path.basename(os.path.normpath(other)) != '.hnote':
+        other = os.path.join(other, '.hnote')
+    if not os.path.exists(other):
+        raise RuntimeError("No notebook found at '{}'!".format(rest[0]))
+    if os.path.samefile(other, utils.find_registry()):
+        raise RuntimeError('Cannot sync a notebook with itself!')
+    prefer = 'local' if 'ours' in opts else 'remote' if opts else None
+    remote = sync.LocalTransport(other)
+    result = sync.sync(sync.RegistryPeer(), remote, prefer)
+    remote.close()
+    w = sys.stdout.write
+    for uid, kind in result.conflicts:
+        w('conflict ({}): {}\n'.format(kind, uid))
+    w('{} differing buckets; pulled {} notes and {} relations, '
+      'pushed {} notes and {} relations; {} conflicts\n'.format(
+          result.buckets, len(result.pulled), result.pulled_relations,
+          len(result.pushed), result.pushed_relations,
+          len(result.conflicts)))
+
+@use_reg
+def public_cmd_tools(args):
+    """tools
+    Summarize the use of each tool: how many actions used it, when they ran,
+    how many data files they link to and their total recorded runtime."""
+    if args:
+        raise RuntimeError("Invalid arguments: '{}'".format(' '.join(args)))
+    table = registry.tool_rollups()
+    w = sys.stdout.write
+    for uid in sorted(table, key=lambda uid: (-table[uid].count, uid)):
+        r = table[uid]
+        w('{} [{}]: {} actions'.format(str(registry.get(uid)), uid, r.count))
+        if r.count:
+            w(', {} to {}'.format(utils.from_micros(r.first),
+                                  utils.from_micros(r.last)))
+        if r.data:
+            w(', {} data files'.format(len(r.data)))
+        if r.timed:
+            w(', {:.2f} s runtime'.format(r.runtime/1e6))
+        w('\n')
+
+@use_reg
+def public_cmd_show(args):
+    """show <uid> [--at <time>]
+    Print a note; with --at, the version of it current at that time."""
+    opts, rest = parse_long_options(args, valued=('at',))
+    if len(rest) != 1:
+        raise RuntimeError('Give the UID of one note to show!')
+    try:
+        uid = int(rest[0])
+    except ValueError:
+        raise RuntimeError("Invalid UID '{}'!".format(rest[0]))
+    if not registry.exists(uid):
+        raise RuntimeError('No note has the UID {}!'.format(uid))
+    if 'at' in opts:
+        view = registry.as_of(note.parse_timestamp(opts['at'], None))
+        if not view.exists(uid):
+            raise RuntimeError('Note {} did not exist yet at {}.'.format(
+                uid, opts['at']))
+        n = view.get(uid)
+    else:
+        n = registry.get(uid)
+    w = sys.stdout.write
+    w('{} [{}]\n'.format(str(n), uid))
+    for part in n.parts:
+        w('{}: {}\n'.format(part.display_name, str(getattr(n, part.name))))
+    if type(n) == note.ActionNote and n.runtime:
+        w('Run: exit status {}, {:.2f} s; output logged in {}\n'.format(
+            n.returncode, n.runtime/1e6,
+            runlog.log_dir(utils.find_registry(), uid)))
 
 @use_reg
 def public_cmd_view(args):
     """view
     View a the notebook contents using HyperNote."""
+    registry.load_all()
     hypernote.output.hyperpage.run()
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -0,0 +1,308 @@
+"""Check the integrity of a notebook without decoding its notes.
+
+The encoded notes are walked in a single pass that validates the framing
+(typecodes, versions and field lengths) and collects the UID of every note
+and the destination of every link into compact int arrays; no note objects
+are built. References to UIDs that no note defines are then reported, and
+can be repaired by removing them. Notebooks stored in several pieces
+(blocks or shards) are scanned in parallel, one piece per task."""
+from hypernote import backends
+from hypernote import blockio
+from hypernote import fileio
+from hypernote import note
+from hypernote import registry
+from hypernote import relations
+from hypernote import shards
+from concurrent.futures import ProcessPoolExecutor
+from array import array
+import bisect
+import os
+import struct
+import sys
+
+PREFIX = struct.Struct('<ci') # typecode, version
+INT = struct.Struct('<i')
+
+# typecodes of the fields of version 1 notes, which encode every field as a
+# nested object with its own typecode and version
+V1_FIELDS = {'T': 'isssL', 'A': 'iLLtL', 'D': 'issLL'}
+
+class FramingError(Exception):
+    """Raised when encoded data cannot be walked."""
+
+class Scan:
+    """The UIDs found by scanning some encoded notes."""
+    def __init__(self):
+        self.defined = array('i') # UIDs of the notes found
+        self.sources = array('i') # UID of the note holding each link
+        self.targets = array('i') # UID each link points to
+        self.errors = [] # (location, message)
+
+    def merge(self, other):
+        """Add the findings of another scan to this one."""
+        self.defined.extend(other.defined)
+        self.sources.extend(other.sources)
+        self.targets.extend(other.targets)
+        self.errors += other.errors
+
+def need(buf, off, size):
+    """Raise a FramingError unless buf holds size bytes from off."""
+    if off + size > len(buf):
+        raise FramingError('truncated data')
+
+def read_prefix(buf, off):
+    """Read a typecode and version; return (typecode, version, offset)."""
+    need(buf, off, PREFIX.size)
+    tc, ver = PREFIX.unpack_from(buf, off)
+    try:
+        tc = tc.decode('ascii')
+    except UnicodeDecodeError:
+        raise FramingError('invalid typecode {!r}'.format(tc))
+    return tc, ver, off + PREFIX.size
+
+def link_dests(buf, off, count):
+    """Get the destinations of count packed (start, end, dest) links."""
+    need(buf, off, count*fileio.LINK.size)
+    links = array('i', buf[off:off + count*fileio.LINK.size])
+    if sys.byteorder == 'big':
+        links.byteswap()
+    starts, ends = links[0::3], links[1::3]
+    if any(s < 0 or s > e for s, e in zip(starts, ends)):
+        raise FramingError('invalid link span')
+    return links[2::3]
+
+# (typecode, version) -> list of (kind, index into the unpacked head)
+layouts = {}
+
+def layout(codec):
+    """Get where each field of a compiled codec's encoding is described."""
+    key = codec.typecode, codec.version
+    if key not in layouts:
+        fields = []
+        j = 0
+        for attr, kind in codec.schema:
+            fields.append((kind, j))
+            j += 2 if kind == 'L' else 1
+        layouts[key] = fields
+    return layouts[key]
+
+def scan_compiled(buf, off, codec, scan):
+    """Walk one note encoded by a compiled codec; return the next offset."""
+    need(buf, off, codec.head.size)
+    head = codec.head.unpack_from(buf, off)
+    off += codec.head.size
+    uid = head[0]
+    for kind, j in layout(codec):
+        if kind == 's':
+            off += head[j]
+        elif kind == 'L':
+            off += head[j]
+            dests = link_dests(buf, off, head[j+1])
+            off += head[j+1]*fileio.LINK.size
+            scan.sources.extend([uid]*len(dests))
+            scan.targets.extend(dests)
+    need(buf, off, 0)
+    scan.defined.append(uid)
+    return off
+
+def scan_v1_value(buf, off, expected, dests):
+    """Walk one version 1 value of the expected typecode.
+
+    Link destinations are added to dests. Return (value, next offset); the
+    value is only given for ints."""
+    tc, ver, off = read_prefix(buf, off)
+    if tc != expected:
+        raise FramingError("expected typecode '{}', found '{}'".format(
+            expected, tc))
+    if tc in 'if' and ver == 1:
+        need(buf, off, 4)
+        return INT.unpack_from(buf, off)[0], off + 4
+    if tc == 't' and ver == 1:
+        return None, scan_v1_value(buf, off, 'f', dests)[1]
+    if tc == 't' and ver == 2:
+        need(buf, off, 8)
+        return None, off + 8
+    if tc == 's' and ver == 1:
+        length, off = scan_v1_value(buf, off, 'i', dests)
+        if length < 0:
+            raise FramingError('negative string length')
+        need(buf, off, length)
+        return None, off + length
+    if tc == 'L' and ver == 1:
+        off = scan_v1_value(buf, off, 's', dests)[1]
+        count, off = scan_v1_value(buf, off, 'i', dests)
+        for _ in range(count):
+            start, off = scan_v1_value(buf, off, 'i', dests)
+            end, off = scan_v1_value(buf, off, 'i', dests)
+            dest, off = scan_v1_value(buf, off, 'i', dests)
+            if start < 0 or start > end:
+                raise FramingError('invalid link span')
+            dests.append(dest)
+        return None, off
+    raise FramingError("unknown version {} of typecode '{}'".format(ver, tc))
+
+def scan_v1(buf, off, fields, scan):
+    """Walk one version 1 note; return the next offset."""
+    dests = []
+    uid, off = scan_v1_value(buf, off, fields[0], dests)
+    for tc in fields[1:]:
+        off = scan_v1_value(buf, off, tc, dests)[1]
+    scan.defined.append(uid)
+    scan.sources.extend([uid]*len(dests))
+    scan.targets.extend(dests)
+    return off
+
+def scan_object(buf, off, scan):
+    """Walk one encoded note; return the next offset."""
+    tc, ver, off = read_prefix(buf, off)
+    codec = fileio.codec_versions.get((tc, ver))
+    if codec is not None:
+        return scan_compiled(buf, off, codec, scan)
+    if ver == 1 and tc in V1_FIELDS:
+        return scan_v1(buf, off, V1_FIELDS[tc], scan)
+    raise FramingError("unknown note typecode/version '{}' {}".format(tc, ver))
+
+def scan_buffer(buf, where, scan):
+    """Walk all the notes encoded in a buffer.
+
+    Framing errors are recorded in the scan; the rest of the buffer cannot
+    be walked after one."""
+    off = 0
+    while off < len(buf):
+        try:
+            off = scan_object(buf, off, scan)
+        except (FramingError, struct.error) as err:
+            scan.errors.append(('{} at byte {}'.format(where, off), str(err)))
+            return scan
+    return scan
+
+def scan_file(path):
+    """Scan a file of encoded notes."""
+    with open(path, 'rb') as fin:
+        data = fin.read()
+    return scan_buffer(data, path, Scan())
+
+def scan_block(path, code, entry):
+    """Scan one block of a block-compressed notebook."""
+    scan = Scan()
+    where = '{} block at byte {}'.format(path, entry[2])
+    try:
+        with open(path, 'rb') as fin:
+            data = blockio.read_block(fin, code, entry)
+    except Exception as err:
+        scan.errors.append((where, 'cannot decompress: {}'.format(err)))
+        return scan
+    scan_buffer(data, where, scan)
+    found = scan.defined
+    if not scan.errors and (len(found) != entry[4] or (found and (
+            min(found) < entry[0] or max(found) > entry[1]))):
+        scan.errors.append((where, 'notes do not match the block index'))
+    return scan
+
+def tasks(store):
+    """Split the scan of a notebook into (function, args) tasks."""
+    if store.name == 'block':
+        with open(store.path, 'rb') as fin:
+            code, index = blockio.read_index(fin)
+        return [(scan_block, (store.path, code, entry)) for entry in index]
+    if store.name == 'sharded':
+        manifest = shards.read_manifest(store.path)
+        paths = [shards.shard_path(store.path, i)
+                 for i in range(manifest['shards'])]
+        return [(scan_file, (p,)) for p in paths
+                if os.path.isfile(p)]
+    return [(scan_file, (store.path,))]
+
+def run_task(task):
+    """Run one (function, args) scan task."""
+    fun, args = task
+    return fun(*args)
+
+def scan_store(store, workers=None):
+    """Scan every note of an opened notebook."""
+    scan = Scan()
+    if store.name == 'sqlite':
+        for uid, data in store.db.execute('SELECT uid, data FROM notes'):
+            found = scan_buffer(data, 'note {}'.format(uid), Scan())
+            if not found.errors and list(found.defined) != [uid]:
+                found.errors.append(('note {}'.format(uid),
+                                     'stored under the wrong UID'))
+            scan.merge(found)
+        return scan
+    try:
+        work = tasks(store)
+    except (RuntimeError, OSError, ValueError, struct.error) as err:
+        scan.errors.append((store.path, str(err)))
+        return scan
+    if workers == 1 or len(work) < 2 or sum(
+            os.path.getsize(args[0]) for _, args in work
+            if os.path.isfile(args[0])) < shards.PARALLEL_MIN_BYTES:
+        results = map(run_task, work)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(run_task, work))
+    for found in results:
+        scan.merge(found)
+    return scan
+
+class Report:
+    """The problems found in a notebook."""
+    def __init__(self, scan, rels):
+        self.notes = len(scan.defined)
+        self.links = len(scan.targets)
+        self.relations = len(rels)
+        self.errors = scan.errors
+        defined = array('i', sorted(scan.defined))
+        # UIDs defined by more than one note
+        self.duplicates = sorted({a for a, b in zip(defined, defined[1:])
+                                  if a == b})
+        def exists(uid):
+            i = bisect.bisect_left(defined, uid)
+            return i < len(defined) and defined[i] == uid
+        # (uid of the note holding the link, missing destination)
+        self.dangling_links = [(src, dest) for src, dest in
+                               zip(scan.sources, scan.targets)
+                               if not exists(dest)]
+        self.dangling_relations = [rel for rel in rels if not (
+            exists(rel.uidA) and exists(rel.uidB))]
+
+    def ok(self):
+        """Return whether no problems were found."""
+        return not (self.errors or self.duplicates or self.dangling_links
+                    or self.dangling_relations)
+
+def check(path, workers=None):
+    """Check the notebook at the given path; return a Report."""
+    store = backends.open_backend(path)
+    scan = scan_store(store, workers)
+    try:
+        rels = list(store.load_relations())
+    except Exception as err:
+        scan.errors.append(('relations', 'cannot be read: {}'.format(err)))
+        rels = []
+    return Report(scan, rels)
+
+def repair(report):
+    """Remove the dangling links and relations found by a check.
+
+    The notebook must be loaded into the registry; save it afterwards."""
+    if report.errors:
+        raise RuntimeError('Cannot repair a notebook whose encoding is '
+                           'damaged; restore it from a backup.')
+    registry.load_all()
+    missing = {dest for src, dest in report.dangling_links}
+    for uid in sorted({src for src, dest in report.dangling_links}):
+        n = registry.get(uid)
+        fields = {}
+        for attr, val in vars(n).items():
+            if isinstance(val, note.LinkedText) and any(
+                    link.dest in missing for link in val):
+                fields[attr] = note.LinkedText.from_spans(
+                    val.text, [(link.pos.start, link.pos.end, link.dest)
+                               for link in val if link.dest not in missing])
+        registry.update(uid, **fields)
+    if report.dangling_relations:
+        bad = set(report.dangling_relations)
+        relations.reldb[:] = [rel for rel in relations.reldb if rel not in bad]
+        registry.store.save_relations(relations.reldb, None)
+        relations.new.clear()
@@ -0,0 +1,425 @@
+"""Implement BM25-ranked full-text search over note descriptions.
+
+The index is kept in SQLite tables: in the notebook's own database for the
+SQLite backend, and otherwise in an 'fts' database alongside the notebook.
+It has two parts. The base holds one row per term with all of its postings
+in blocks of documents sharing a term frequency and length, which therefore
+share the term's BM25 score. A query sorts each term's blocks by score and
+reads them best first with the threshold algorithm: it stops as soon as no
+unseen document can beat the top results, instead of scoring every
+posting. The delta holds the term counts of notes added or
+changed since the base was last merged; they are scored directly (masking
+their older postings), and merged into the base once there are more than
+DELTA_LIMIT of them.
+
+registry.save only appends the notes it wrote to a log next to the 'fts'
+database (if it exists), so saving costs only as much as the new notes; the
+log is moved into the delta the next time the index is opened. The database
+records the notebook's stamp (see backends.Backend.stamp), so changes made
+without registry.save are caught and the index is rebuilt in one pass over
+the notes."""
+from hypernote import tokenizer
+from hypernote import utils
+from array import array
+from bisect import bisect_left
+from collections import Counter
+import heapq
+import math
+import os
+import pickle
+import sqlite3
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+# note attributes whose text is indexed
+FIELDS = ('desc', 'src')
+
+# notes kept in the delta before it is merged into the base
+DELTA_LIMIT = 4096
+
+# slack allowed for rounding when comparing score bounds, so that documents
+# tying with the top results are still scored (ties go to the lower uid)
+SLACK = 1e-9
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS fts_terms (
+        term TEXT PRIMARY KEY,
+        postings BLOB NOT NULL);
+    CREATE TABLE IF NOT EXISTS fts_docs (
+        uid INTEGER PRIMARY KEY,
+        length INTEGER NOT NULL);
+    CREATE TABLE IF NOT EXISTS fts_delta (
+        uid INTEGER PRIMARY KEY,
+        terms BLOB NOT NULL);
+    CREATE TABLE IF NOT EXISTS fts_meta (
+        key TEXT PRIMARY KEY,
+        value);
+    '''
+
+def tokenize(text):
+    """Split text into (start, end, term) triples; terms are lowercased."""
+    return [(start, end, text[start:end].lower())
+            for start, end in tokenizer.find_word_boundaries(text)]
+
+def note_text(n):
+    """Get the indexed text of a note."""
+    return '\n'.join(getattr(n, attr).text for attr in FIELDS
+                     if hasattr(n, attr))
+
+def text_terms(text):
+    """Count the terms of a text."""
+    return Counter(t[2] for t in tokenize(text))
+
+def pack_postings(blocks):
+    """Encode a term's postings.
+
+    blocks: dictionary ((term frequency, length) -> list of uids). The
+    encoding is an int32 array: the number of blocks, (term frequency,
+    length, size) of each block, the uids by block, then the uids sorted
+    along with the index of their block (for looking up the term's score of
+    a given document)."""
+    head = [len(blocks)]
+    uids = []
+    block_of = []
+    for i, key in enumerate(sorted(blocks)):
+        docs = blocks[key]
+        head += (key[0], key[1], len(docs))
+        uids += docs
+        block_of += [i]*len(docs)
+    by_uid = sorted(zip(uids, block_of))
+    return array('i', head + uids + [uid for uid, i in by_uid] +
+                 [i for uid, i in by_uid]).tobytes()
+
+def unpack_postings(data):
+    """Decode a term's postings.
+
+    Return (blocks, uids, block_of): a list of (term frequency, length,
+    uids) blocks, every uid in order, and the index of each one's block."""
+    values = array('i')
+    values.frombytes(data)
+    count = values[0]
+    start = 1 + 3*count
+    total = (len(values) - start)//3
+    blocks = []
+    pos = start
+    for i in range(1, start, 3):
+        tf, length, size = values[i:i+3]
+        blocks.append((tf, length, values[pos:pos + size]))
+        pos += size
+    return blocks, values[start + total:start + 2*total], \
+        values[start + 2*total:]
+
+def create_tables(db):
+    """Create the index tables in a database.
+
+    Return whether they were missing (the index must then be built)."""
+    missing = db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table'"
+                         " AND name = 'fts_terms'").fetchone() is None
+    db.executescript(SCHEMA)
+    return missing
+
+def get_meta(db, key, default=None):
+    """Get a value stored in the index's metadata."""
+    row = db.execute('SELECT value FROM fts_meta WHERE key = ?',
+                     (key,)).fetchone()
+    return default if row is None else row[0]
+
+def set_meta(db, key, value):
+    """Store a value in the index's metadata."""
+    db.execute('INSERT OR REPLACE INTO fts_meta VALUES (?, ?)', (key, value))
+
+def index_note(db, uid, text):
+    """Index (or reindex) the text of a note, adding it to the delta."""
+    db.execute('INSERT OR REPLACE INTO fts_delta VALUES (?, ?)',
+               (uid, pickle.dumps(dict(text_terms(text)),
+                                  pickle.HIGHEST_PROTOCOL)))
+
+def write_base(db, postings):
+    """Replace the base with the given postings (dictionary (term ->
+    blocks, see pack_postings)) and update the totals."""
+    db.execute('DELETE FROM fts_terms')
+    db.executemany('INSERT INTO fts_terms VALUES (?, ?)',
+                   ((term, pack_postings(blocks))
+                    for term, blocks in postings.items() if blocks))
+    docs, length = db.execute(
+        'SELECT count(*), total(length) FROM fts_docs').fetchone()
+    set_meta(db, 'docs', docs)
+    set_meta(db, 'length', int(length))
+
+def add_postings(postings, uid, terms):
+    """Add the postings of a document (dictionary (term -> frequency));
+    return its length."""
+    length = sum(terms.values())
+    for term, tf in terms.items():
+        postings.setdefault(term, {}).setdefault((tf, length), []).append(uid)
+    return length
+
+def build(db, texts):
+    """Build the index from scratch from (uid, text) pairs."""
+    postings = {}
+    db.execute('DELETE FROM fts_delta')
+    db.execute('DELETE FROM fts_docs')
+    db.executemany('INSERT INTO fts_docs VALUES (?, ?)',
+                   ((uid, add_postings(postings, uid, text_terms(text)))
+                    for uid, text in texts))
+    write_base(db, postings)
+
+def load_delta(db):
+    """Get the delta as a dictionary (uid -> dictionary (term ->
+    frequency))."""
+    return {uid: pickle.loads(terms) for uid, terms in db.execute(
+        'SELECT uid, terms FROM fts_delta')}
+
+def merge(db):
+    """Merge the delta into the base."""
+    delta = load_delta(db)
+    if not delta:
+        return
+    masked = set(delta)
+    postings = {}
+    for term, data in db.execute('SELECT term, postings FROM fts_terms'):
+        blocks = {}
+        for tf, length, uids in unpack_postings(data)[0]:
+            if masked.isdisjoint(uids):
+                blocks[tf, length] = uids
+            else:
+                kept = [uid for uid in uids if uid not in masked]
+                if kept:
+                    blocks[tf, length] = kept
+        postings[term] = blocks
+    lengths = [(uid, add_postings(postings, uid, terms))
+               for uid, terms in delta.items()]
+    db.executemany('INSERT OR REPLACE INTO fts_docs VALUES (?, ?)', lengths)
+    write_base(db, postings)
+    db.execute('DELETE FROM fts_delta')
+
+def maybe_merge(db):
+    """Merge the delta into the base if it has grown too large."""
+    count = db.execute('SELECT count(*) FROM fts_delta').fetchone()[0]
+    if count > DELTA_LIMIT:
+        merge(db)
+
+def search_db(db, query, limit=10):
+    """Rank the notes indexed in a database against a plain-text query.
+
+    Return up to limit (uid, score) pairs, best first."""
+    terms = sorted(set(t[2] for t in tokenize(query)))
+    if not terms or limit <= 0:
+        return []
+    delta = load_delta(db)
+    masked = set(delta)
+    num_docs = get_meta(db, 'docs', 0)
+    total_length = get_meta(db, 'length', 0)
+    if masked:
+        # documents in the delta replace their versions in the base
+        for uid, length in db.execute(
+                'SELECT uid, length FROM fts_docs WHERE uid IN ({})'.format(
+                    ','.join('?'*len(masked))), list(masked)):
+            num_docs -= 1
+            total_length -= length
+        num_docs += len(delta)
+        total_length += sum(sum(t.values()) for t in delta.values())
+    if num_docs <= 0:
+        return []
+    avg_length = total_length / num_docs
+
+    # per term: blocks of the base as (score, uids), best first
+    streams = []
+    weights = []
+    lookups = [] # per term: (uids in order, their blocks, block scores)
+    for term in terms:
+        row = db.execute('SELECT postings FROM fts_terms WHERE term = ?',
+                         (term,)).fetchone()
+        blocks, uids, block_of = unpack_postings(row[0]) if row else \
+            ([], array('i'), array('i'))
+        df = len(uids) + sum(1 for t in delta.values() if term in t)
+        if masked:
+            df -= len(masked.intersection(uids))
+            blocks = [(tf, length, docs if masked.isdisjoint(docs) else
+                       [u for u in docs if u not in masked])
+                      for tf, length, docs in blocks]
+        if not df:
+            continue
+        idf = math.log(1 + (num_docs - df + 0.5)/(df + 0.5))
+        weight = lambda tf, length, idf=idf: idf*tf*(K1 + 1)/(
+            tf + K1*(1 - B + B*length/avg_length))
+        weights.append((term, weight))
+        scores = [weight(tf, length) for tf, length, docs in blocks]
+        streams.append(sorted(((score, docs) for score, (tf, length, docs)
+                               in zip(scores, blocks) if docs),
+                              key=lambda block: -block[0]))
+        lookups.append((uids, block_of, scores))
+
+    top = [] # min-heap of (score, -uid)
+    def offer(uid, score):
+        entry = (score, -uid)
+        if len(top) < limit:
+            heapq.heappush(top, entry)
+        elif entry > top[0]:
+            heapq.heapreplace(top, entry)
+
+    for uid, counts in delta.items():
+        length = sum(counts.values())
+        score = sum(weight(counts[term], length)
+                    for term, weight in weights if term in counts)
+        if score:
+            offer(uid, score)
+
+    # Read the streams' blocks in turn (the threshold algorithm), scoring
+    # each new document in full. A document not seen yet scores at most the
+    # streams' next block scores (the frontier) in every term, so:
+    # - the search stops once the top results beat the sum of the frontier;
+    # - streams whose frontiers sum (with those of lower ones) to no more
+    #   than the top results are no longer read (as in MaxScore): documents
+    #   found only through them cannot make it;
+    # - a document is dropped as soon as its score so far plus the frontier
+    #   of the terms not yet looked up cannot lift it into the top results.
+    pos = [0]*len(streams)
+    seen = set(masked)
+    while True:
+        frontier = [stream[p][0] if p < len(stream) else 0
+                    for stream, p in zip(streams, pos)]
+        threshold = top[0][0] - SLACK if len(top) == limit else -math.inf
+        if not any(frontier) or threshold > sum(frontier):
+            break
+        by_frontier = sorted(range(len(streams)), key=frontier.__getitem__)
+        essential = list(by_frontier)
+        lowest = 0
+        while lowest + frontier[essential[0]] < threshold:
+            lowest += frontier[essential.pop(0)]
+        for i in sorted(essential):
+            if pos[i] == len(streams[i]):
+                continue
+            score, uids = streams[i][pos[i]]
+            pos[i] += 1
+            new = set(uids)
+            new.difference_update(seen)
+            seen.update(new)
+            others = [j for j in reversed(by_frontier) if j != i]
+            bound = score + sum(frontier[j] for j in others)
+            for uid in new:
+                threshold = top[0][0] - SLACK if len(top) == limit \
+                    else -math.inf
+                if bound < threshold:
+                    break
+                parts = [0]*len(streams)
+                parts[i] = total = score
+                rest = bound - score
+                for j in others:
+                    uids_j, block_of, block_scores = lookups[j]
+                    k = bisect_left(uids_j, uid)
+                    if k < len(uids_j) and uids_j[k] == uid:
+                        parts[j] = block_scores[block_of[k]]
+                        total += parts[j]
+                    rest -= frontier[j]
+                    if total + rest < threshold:
+                        break
+                else:
+                    # summed in term order, like the delta's scores, so
+                    # that equal scores tie exactly
+                    offer(uid, sum(parts))
+    return [(-neg_uid, score) for score, neg_uid in sorted(top, reverse=True)]
+
+def index_path(notebook_path):
+    """Get the path of the index database for the given notebook."""
+    return utils.sidecar_path(notebook_path, 'fts')
+
+def log_path(notebook_path):
+    """Get the path of the index log for the given notebook."""
+    return utils.sidecar_path(notebook_path, 'fts-log')
+
+def log_notes(notebook_path, before, after, notes):
+    """Log notes just saved to a notebook.
+
+    before, after: the notebook's stamps before and after saving. Nothing
+    is logged until the notebook has been searched (the index is then built
+    from the notes)."""
+    if not os.path.isfile(index_path(notebook_path)):
+        return
+    with open(log_path(notebook_path), 'ab') as fout:
+        pickle.dump((before, after, [(n.uid, note_text(n)) for n in notes]),
+                    fout, pickle.HIGHEST_PROTOCOL)
+
+def connect(path):
+    """Open an index database, replacing an unreadable one (such as an
+    index from older versions)."""
+    db = sqlite3.connect(path)
+    try:
+        create_tables(db)
+    except sqlite3.DatabaseError:
+        db.close()
+        os.remove(path)
+        db = sqlite3.connect(path)
+        create_tables(db)
+    return db
+
+def open_index(notebook_path, store):
+    """Open the index database of a notebook (not a lazy one) for
+    searching.
+
+    store: the notebook's backend. Logged notes are indexed, and the index
+    is rebuilt from the notebook if it is not up to date with it."""
+    db = connect(index_path(notebook_path))
+    stamp = get_meta(db, 'stamp')
+    with db:
+        if os.path.isfile(log_path(notebook_path)):
+            with open(log_path(notebook_path), 'rb') as fin:
+                while True:
+                    try:
+                        before, after, texts = pickle.load(fin)
+                    except EOFError:
+                        break
+                    if before != stamp:
+                        # saved over changes that were not logged
+                        stamp = None
+                    for uid, text in texts:
+                        index_note(db, uid, text)
+                    if stamp is not None:
+                        stamp = after
+        if stamp is None or stamp != store.stamp():
+            build(db, ((n.uid, note_text(n)) for n in store.load()))
+        else:
+            maybe_merge(db)
+        set_meta(db, 'stamp', store.stamp())
+    if os.path.isfile(log_path(notebook_path)):
+        os.remove(log_path(notebook_path))
+    return db
+
+def search(notebook_path, store, query, limit=10):
+    """Rank the notes of a notebook against a plain-text query.
+
+    Lazy backends keep the index in their own database; others keep it
+    alongside the notebook. Return up to limit (uid, score) pairs, best
+    first."""
+    if store.lazy:
+        return store.search_text(query, limit)
+    db = open_index(notebook_path, store)
+    try:
+        return search_db(db, query, limit)
+    finally:
+        db.close()
+
+def snippet(text, query, width=80, highlight=('*', '*')):
+    """Get an excerpt of text around the first query term it contains.
+
+    Query terms in the excerpt are wrapped in the highlight markers."""
+    wanted = set(t[2] for t in tokenize(query))
+    hits = [(start, end) for start, end, term in tokenize(text)
+            if term in wanted]
+    if not hits:
+        return text[:width].replace('\n', ' ')
+    lo = max(0, hits[0][0] - width//4)
+    hi = min(len(text), lo + width)
+    out = '...' if lo > 0 else ''
+    last = lo
+    for start, end in hits:
+        if start < lo or end > hi:
+            continue
+        out += text[last:start] + highlight[0] + text[start:end] + highlight[1]
+        last = end
+    out += text[last:hi]
+    if hi < len(text):
+        out += '...'
+    return out.replace('\n', ' ')
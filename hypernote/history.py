@@ -0,0 +1,253 @@
+"""Keep the past versions of notes.
+
+Every change to a note appends a record to the notebook's history file: an
+empty marker when the note is created, a full snapshot (the note's encoding)
+of its original version when it is first changed, a snapshot when it is
+replaced or every SNAPSHOT_EVERY records, and otherwise a delta holding just
+the changed fields, encoded by a codec compiled for those fields. Rebuilding
+any version therefore decodes one snapshot and fewer than SNAPSHOT_EVERY
+deltas. Records name the encoding version whose fields their mask selects,
+so they stay readable when the fields change.
+
+Notes that were never changed have no more than their creation marker, and
+notes recorded before history was kept count as unchanged since the
+epoch."""
+from hypernote import fileio
+from hypernote import utils
+from bisect import bisect_right
+from datetime import datetime
+import copy
+import os
+import struct
+
+SNAPSHOT_EVERY = 16
+
+# time (microseconds), uid, kind, note typecode, codec version, field mask,
+# payload length
+RECORD = struct.Struct('<qiccBII')
+
+# record kinds
+CREATED = b'C'
+SNAPSHOT = b'S'
+DELTA = b'D'
+
+# (typecode, version, field mask) -> NoteCodec of the fields in the mask
+delta_codecs = {}
+
+def delta_codec(typecode, version, mask):
+    """Get the codec encoding the fields selected by mask.
+
+    Bit i of the mask selects field i of the schema of the given encoding
+    version, so deltas stay readable when a newer version changes the
+    fields."""
+    key = typecode, version, mask
+    if key not in delta_codecs:
+        codec = fileio.codec_versions[typecode, version]
+        fields = tuple(f for i, f in enumerate(codec.schema) if mask >> i & 1)
+        delta_codecs[key] = fileio.NoteCodec(codec.dtype, typecode, 0, fields)
+    return delta_codecs[key]
+
+def field_mask(dtype, fields):
+    """Get the mask selecting the given fields in the current schema, or
+    None if one is not stored."""
+    attrs = [attr for attr, kind in fileio.codecs[dtype].schema]
+    if not all(f in attrs for f in fields):
+        return None
+    return sum(1 << attrs.index(f) for f in fields)
+
+def now():
+    """Get the current time in microseconds (see utils.to_micros)."""
+    return utils.to_micros(datetime.now())
+
+class Record:
+    """One version of a note in its history."""
+    __slots__ = ('time', 'kind', 'typecode', 'version', 'mask', 'offset',
+                 'data')
+
+    def __init__(self, time, kind, typecode, version, mask, offset, data):
+        self.time = time
+        self.kind = kind
+        self.typecode = typecode
+        self.version = version # of the codec the mask refers to
+        self.mask = mask
+        self.offset = offset # of the payload in the file (None if pending)
+        self.data = data # payload (for pending records), or its length
+
+class History:
+    """The history of the notes of a notebook."""
+    def __init__(self, notebook_path=None):
+        self.notebook_path = notebook_path
+        self.index = None # uid -> list of Records in time order
+        self.pending = [] # (uid, Record) not yet written
+
+    def path(self):
+        """Get the path of the history file."""
+        return utils.sidecar_path(self.notebook_path, 'history')
+
+    def load_index(self):
+        """Read the record headers of the history file (once)."""
+        if self.index is not None:
+            return self.index
+        self.index = {}
+        if self.notebook_path is None or not os.path.isfile(self.path()):
+            return self.index
+        with open(self.path(), 'rb') as fin:
+            while True:
+                head = fin.read(RECORD.size)
+                if len(head) < RECORD.size:
+                    break
+                time, uid, kind, tc, version, mask, length = \
+                    RECORD.unpack(head)
+                self.index.setdefault(uid, []).append(Record(
+                    time, kind, tc.decode('ascii'), version, mask,
+                    fin.tell(), length))
+                fin.seek(length, os.SEEK_CUR)
+        return self.index
+
+    def chain(self, uid):
+        """Get the Records of a note, oldest first."""
+        return self.load_index().get(uid, [])
+
+    def append(self, uid, kind, n, mask, data, time=None):
+        """Add a pending record of a note."""
+        codec = fileio.codecs[type(n)]
+        rec = Record(now() if time is None else time, kind, codec.typecode,
+                     codec.version, mask, None, bytes(data))
+        self.load_index().setdefault(uid, []).append(rec)
+        self.pending.append((uid, rec))
+
+    def snapshot(self, n, time=None):
+        """Record the full current state of a note."""
+        out = bytearray()
+        fileio.dump_object(n, out)
+        self.append(n.uid, SNAPSHOT, n, 0, out, time)
+
+    def add(self, n):
+        """Record the creation of a note (its contents are only recorded
+        once it changes)."""
+        self.append(n.uid, CREATED, n, 0, b'')
+
+    def snapshot_original(self, n):
+        """Record the current state of a note as its original version, if
+        there is no snapshot of it yet.
+
+        The original dates from the note's creation (or the epoch, if that
+        was not recorded)."""
+        chain = self.chain(n.uid)
+        if SNAPSHOT not in [rec.kind for rec in chain]:
+            self.snapshot(n, chain[0].time if chain else 0)
+
+    def update(self, n, fields):
+        """Record a change of the given fields (dictionary) of a note.
+
+        Must be called before the fields are changed."""
+        self.snapshot_original(n)
+        chain = self.chain(n.uid)
+        changed = copy.copy(n)
+        vars(changed).update(fields)
+        mask = field_mask(type(n), fields)
+        if mask is None or SNAPSHOT not in [
+                rec.kind for rec in chain[-(SNAPSHOT_EVERY - 1):]]:
+            self.snapshot(changed)
+        else:
+            out = bytearray()
+            codec = fileio.codecs[type(n)]
+            delta_codec(codec.typecode, codec.version, mask).encode_into(
+                changed, out)
+            self.append(n.uid, DELTA, n, mask, out)
+
+    def replace(self, old, new):
+        """Record the replacement of a note by another version of it."""
+        self.snapshot_original(old)
+        self.snapshot(new)
+
+    def save(self, notebook_path):
+        """Write the pending records to the history file of a notebook."""
+        if notebook_path != self.notebook_path:
+            # read that notebook's history (with these records) when needed
+            self.notebook_path = notebook_path
+            self.index = None
+        if not self.pending:
+            return
+        with open(self.path(), 'ab') as fout:
+            for uid, rec in self.pending:
+                fout.write(RECORD.pack(rec.time, uid, rec.kind,
+                                       rec.typecode.encode('ascii'),
+                                       rec.version, rec.mask, len(rec.data)))
+                rec.offset = fout.tell()
+                fout.write(rec.data)
+                rec.data = len(rec.data)
+        self.pending = []
+
+    def payload(self, rec, fin):
+        """Get the payload of a record."""
+        if rec.offset is None:
+            return bytearray(rec.data)
+        fin.seek(rec.offset)
+        return bytearray(fin.read(rec.data))
+
+    def version(self, uid, time, current):
+        """Get a note as it was at a time (microseconds).
+
+        current is a function returning the note's current version, which
+        is used if the note has not changed since. Return None if the note
+        did not exist yet."""
+        chain = self.chain(uid)
+        if not chain:
+            return current()
+        i = bisect_right([rec.time for rec in chain], time) - 1
+        if i < 0:
+            return None
+        if i == len(chain) - 1:
+            return current()
+        start = i
+        while chain[start].kind != SNAPSHOT:
+            start -= 1
+        fin = None
+        if any(rec.offset is not None for rec in chain[start:i+1]):
+            fin = open(self.path(), 'rb')
+        try:
+            n = fileio.load_object(self.payload(chain[start], fin))
+            for rec in chain[start+1:i+1]:
+                codec = delta_codec(rec.typecode, rec.version, rec.mask)
+                vars(n).update(vars(codec.decode(self.payload(rec, fin))))
+        finally:
+            if fin is not None:
+                fin.close()
+        return n
+
+    def existed(self, uid, time):
+        """Return whether a note existed at a time (microseconds)."""
+        chain = self.chain(uid)
+        return not chain or chain[0].time <= time
+
+class View:
+    """The notes of a notebook as they were at some time.
+
+    Past versions are rebuilt when they are first asked for."""
+    def __init__(self, notebook, time):
+        """time: datetime."""
+        self.notebook = notebook
+        self.time = utils.to_micros(time)
+        self.versions = {} # uid -> note (or None if it did not exist)
+
+    def get(self, uid):
+        """Get the version of a note; raise KeyError if it did not exist."""
+        if uid not in self.versions:
+            nb = self.notebook
+            self.versions[uid] = nb.history.version(
+                uid, self.time, lambda: nb.get(uid)) \
+                if nb.exists(uid) else None
+        if self.versions[uid] is None:
+            raise KeyError(uid)
+        return self.versions[uid]
+
+    def exists(self, uid):
+        """Return whether a note existed at the time."""
+        return self.notebook.exists(uid) and \
+            self.notebook.history.existed(uid, self.time)
+
+    def __iter__(self):
+        """Iterate over the UIDs of the notes in memory that existed."""
+        return (uid for uid in list(self.notebook.notes)
+                if self.notebook.history.existed(uid, self.time))
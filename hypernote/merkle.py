@@ -0,0 +1,162 @@
+"""Merkle trees of the contents of notebooks (see sync).
+
+Every note is hashed from its encoded form and every relation from its four
+fields; both are put in one of BUCKETS buckets by UID (the first UID, for a
+relation). A bucket's hash covers its sorted contents, and each tree node
+above hashes its FANOUT children.
+
+The tree of a notebook is kept in its 'merkle' sidecar with the stamp of the
+notebook's files. Saves append the hashes of the saved notes and relations
+to the 'merkle-log' sidecar, which is folded in when the tree is next
+opened; the notes are only loaded and hashed again if the notebook changed
+in some other way."""
+from hypernote import fileio
+from hypernote import utils
+import hashlib
+import os
+import pickle
+import struct
+
+FANOUT = 16
+DEPTH = 3
+BUCKETS = FANOUT**DEPTH
+
+HASH_SIZE = 16
+ENTRY = struct.Struct('<i{}s'.format(HASH_SIZE))
+RELATION = struct.Struct('<iiii')
+
+def digest(data):
+    """Hash some bytes."""
+    return hashlib.blake2b(data, digest_size=HASH_SIZE).digest()
+
+def note_hash(n):
+    """Hash the encoded contents of a note."""
+    return digest(bytes(fileio.dump_objects((n,))))
+
+def bucket_of(uid):
+    """Get the bucket a UID belongs in."""
+    return uid % BUCKETS
+
+class Tree:
+    """Merkle tree over the notes and relations of a notebook."""
+    def __init__(self, notes=(), rels=()):
+        """Hash the given notes (iterable) and relations (iterable)."""
+        # per bucket: dictionary (uid -> note hash), set of relations
+        self.notes = [{} for _ in range(BUCKETS)]
+        self.rels = [set() for _ in range(BUCKETS)]
+        for n in notes:
+            self.notes[bucket_of(n.uid)][n.uid] = note_hash(n)
+        for rel in rels:
+            self.rels[bucket_of(rel.uidA)].add(tuple(rel))
+        self.levels = None
+        self.changed = set(range(BUCKETS)) # buckets to hash again
+        self.stamp = None # modification time of the notebook when saved
+
+    def bucket_hash(self, i):
+        """Hash the sorted contents of a bucket."""
+        h = hashlib.blake2b(digest_size=HASH_SIZE)
+        for uid in sorted(self.notes[i]):
+            h.update(ENTRY.pack(uid, self.notes[i][uid]))
+        for rel in sorted(self.rels[i]):
+            h.update(RELATION.pack(*rel))
+        return h.digest()
+
+    def build(self):
+        """Compute the node hashes; levels[0] holds the root.
+
+        Only the buckets changed since the last build are hashed again."""
+        if self.levels is not None and not self.changed:
+            return self
+        level = list(self.levels[-1]) if self.levels else [None]*BUCKETS
+        for i in self.changed:
+            level[i] = self.bucket_hash(i)
+        self.changed = set()
+        self.levels = [level]
+        while len(level) > 1:
+            level = [digest(b''.join(level[i:i+FANOUT]))
+                     for i in range(0, len(level), FANOUT)]
+            self.levels.insert(0, level)
+        return self
+
+    def set_hash(self, uid, h):
+        """Add or replace the hash of a note; the tree must be built again
+        afterwards."""
+        self.notes[bucket_of(uid)][uid] = h
+        self.changed.add(bucket_of(uid))
+
+    def add_note(self, n):
+        """Add or replace a note; the tree must be built again afterwards."""
+        self.set_hash(n.uid, note_hash(n))
+
+    def add_relation(self, rel):
+        """Add a relation; the tree must be built again afterwards."""
+        self.rels[bucket_of(rel[0])].add(tuple(rel))
+        self.changed.add(bucket_of(rel[0]))
+
+def path(notebook_path):
+    """Get the path of the saved tree of the given notebook."""
+    return utils.sidecar_path(notebook_path, 'merkle')
+
+def log_path(notebook_path):
+    """Get the path of the log of notes saved since the tree was."""
+    return utils.sidecar_path(notebook_path, 'merkle-log')
+
+def log_changes(notebook_path, before, after, notes, rels):
+    """Log the hashes of notes and relations just saved to a notebook.
+
+    before, after: the notebook's stamps before and after saving. Nothing
+    is logged until the notebook has been synced (the tree is then saved)."""
+    if not os.path.isfile(path(notebook_path)):
+        return
+    with open(log_path(notebook_path), 'ab') as fout:
+        pickle.dump((before, after, [(n.uid, note_hash(n)) for n in notes],
+                     [tuple(rel) for rel in rels]),
+                    fout, pickle.HIGHEST_PROTOCOL)
+
+def load(notebook_path, store):
+    """Load the saved tree of a notebook, with the logged changes.
+
+    Return None if there is none, or it is out of date."""
+    if not os.path.isfile(path(notebook_path)):
+        return None
+    with open(path(notebook_path), 'rb') as fin:
+        tree = pickle.load(fin)
+    if os.path.isfile(log_path(notebook_path)):
+        with open(log_path(notebook_path), 'rb') as fin:
+            while True:
+                try:
+                    before, after, hashes, rels = pickle.load(fin)
+                except EOFError:
+                    break
+                if before != tree.stamp:
+                    # saved over changes that were not logged
+                    return None
+                for uid, h in hashes:
+                    tree.set_hash(uid, h)
+                for rel in rels:
+                    tree.add_relation(rel)
+                tree.stamp = after
+    if tree.stamp != store.stamp():
+        return None
+    return tree
+
+def save(notebook_path, store, tree):
+    """Save the tree of a notebook, after its notes were saved."""
+    tree.build()
+    tree.stamp = store.stamp()
+    with open(path(notebook_path), 'wb') as fout:
+        pickle.dump(tree, fout, pickle.HIGHEST_PROTOCOL)
+    if os.path.isfile(log_path(notebook_path)):
+        os.remove(log_path(notebook_path))
+
+def open_tree(notebook_path, store):
+    """Get the up-to-date tree of a notebook, hashing its notes only if the
+    saved tree is missing or out of date.
+
+    store: the notebook's backend."""
+    tree = load(notebook_path, store)
+    if tree is None:
+        tree = Tree(store.load(), store.load_relations())
+    if tree.changed or os.path.isfile(log_path(notebook_path)):
+        save(notebook_path, store, tree)
+    return tree
@@ -3,6 +3,8 @@ from collections import namedtuple
 import copy
 import os.path
 from hypernote import utils
+from hypernote import profiling
+from hypernote import rope
 from datetime import datetime
 import dateutil.parser
 
@@ -10,52 +12,128 @@ Pos = namedtuple('Pos', ('start', 'end')) # start, end are ints
 Link = namedtuple('Link', ('pos', 'dest')) # pos is Pos; dest is UID
 
 class LinkedText:
-    """Represents text with links in it."""
+    """Represents text with links in it.
+
+    The text and links are kept in a rope (see hypernote.rope), so
+    concatenation, slicing and finding the links in a range take
+    logarithmic time."""
     def __init__(self, text=''):
-        """Initialize an empty LinkedText."""
-        self.text = text
-        self.links = []
+        """Initialize a LinkedText without links."""
+        self.rope = rope.from_text(text)
+        self.flat = text # the whole text, or None until asked for
+        self.link_list = [] # every link, or None until asked for
+
+    @classmethod
+    def from_spans(cls, text, spans):
+        """Build LinkedText from its text and (start, end, dest) links."""
+        lt = cls.__new__(cls)
+        lt.rope = rope.from_text(text, spans)
+        lt.flat = text
+        lt.link_list = None
+        return lt
+
+    @classmethod
+    def from_rope(cls, node):
+        """Wrap a rope in a LinkedText."""
+        lt = cls.__new__(cls)
+        lt.rope = node
+        lt.flat = None
+        lt.link_list = None
+        return lt
+
+    @property
+    def text(self):
+        """The plain text."""
+        if self.flat is None:
+            self.flat = rope.text(self.rope)
+        return self.flat
+
+    @text.setter
+    def text(self, text):
+        """Replace the text, keeping the links where they are."""
+        self.rope = rope.from_text(text, rope.links(self.rope))
+        self.flat = text
+
+    @property
+    def links(self):
+        """A list of every link, in order of position."""
+        return list(self.all_links())
+
+    @links.setter
+    def links(self, links):
+        """Replace all the links."""
+        self.rope = rope.from_text(
+            self.text, [(l.pos.start, l.pos.end, l.dest) for l in links])
+        self.link_list = None
 
     def __str__(self):
         return self.text
 
+    def __len__(self):
+        return self.rope.length
+
     def link(self, pos, uid):
         """Add a link at the given position."""
-        self.links.append(Link(pos, uid))
+        self.rope = rope.add_link(self.rope, pos.start, pos.end, uid)
+        self.link_list = None
 
     def __add__(self, other):
         """Add two LinkedText instances together."""
-        off = len(self.text)
-        c_text = self.text + other.text
-        c_links = copy.copy(self.links)
-        for link in other:
-            c_links.append(Link(Pos(link.pos.start+off,
-                                    link.pos.end+off),
-                                link.dest))
-        ret = LinkedText()
-        ret.text = c_text
-        ret.links = c_links
-        return ret
+        return LinkedText.from_rope(rope.join(self.rope, other.rope))
+
+    def all_links(self):
+        """Get the (cached) list of every link."""
+        if self.link_list is None:
+            self.link_list = [Link(Pos(start, end), dest)
+                              for start, end, dest in rope.links(self.rope)]
+        return self.link_list
 
     def __iter__(self):
         """Iterate over all our links."""
-        yield from self.links
+        yield from self.all_links()
 
     def __getitem__(self, pos):
-        """Get the string corresponding to the given link pos."""
-        return self.text[pos.start:pos.end]
+        """Get the string corresponding to the given link pos.
+
+        A slice instead gets the LinkedText in that range, keeping the links
+        lying entirely inside it."""
+        if isinstance(pos, slice):
+            start, end, step = pos.indices(len(self))
+            if step != 1:
+                raise ValueError('LinkedText slices cannot have a step.')
+            return LinkedText.from_rope(rope.substring(self.rope, start, end))
+        if self.flat is None:
+            return rope.text(rope.substring(self.rope, pos.start, pos.end))
+        return self.flat[pos.start:pos.end]
+
+    def links_in(self, start, end):
+        """Get the links lying entirely within [start, end)."""
+        return [Link(Pos(s, e), dest)
+                for s, e, dest in rope.links_in(self.rope, start, end)]
+
+    def links_at(self, offset):
+        """Get the links covering the given offset."""
+        return [Link(Pos(s, e), dest)
+                for s, e, dest in rope.links_at(self.rope, offset)]
 
     def __getstate__(self):
         """Get the pickling state."""
         return dict(
             text=self.text,
-            links=self.links)
+            spans=list(rope.links(self.rope)))
 
     def __setstate__(self, state):
         """Set the state from pickled info."""
-        self.text = state['text']
-        self.links = state['links']
-
+        if 'spans' in state:
+            spans = state['spans']
+        else:
+            # pickled before LinkedText kept its links in a rope
+            spans = [(l.pos.start, l.pos.end, l.dest) for l in state['links']]
+        self.rope = rope.from_text(state['text'], spans)
+        self.flat = state['text']
+        self.link_list = None
+
+@profiling.timed('note.autolink')
 def autolink_text(text, note):
     """Return autolinked LinkedText."""
     lt = LinkedText(text)
@@ -76,22 +154,61 @@ def raw_string(text, note):
     return text
 
 def parse_timestamp(text, note):
-    """Parse a timestamp string; return datetime object."""
+    """Parse a timestamp string; return datetime object.
+
+    ISO-8601 strings (like those from utils.get_timestamp) are parsed by the
+    much faster datetime.fromisoformat; dateutil handles everything else."""
+    try:
+        return datetime.fromisoformat(text)
+    except ValueError:
+        pass
     try:
         return dateutil.parser.parse(text)
     except:
         raise RuntimeError("Failed to parse timestamp '{}'!".format(text))
 
+def notebook_root():
+    """Get the absolute path of the directory holding the notebook."""
+    path = utils.find_registry()
+    if path is None:
+        raise RuntimeError(
+            "Registry not found! Use 'hnote init' to create one.")
+    return os.path.abspath(os.path.dirname(path))
+
+# (notebook root, absolute directory) -> how paths in it are stored
+normalized_dirs = {}
+
+def normalize_dir(root, directory):
+    """Store a directory relative to the root if inside it; else absolute."""
+    key = (root, directory)
+    if key not in normalized_dirs:
+        if os.path.commonpath((root, directory)) == root:
+            normalized_dirs[key] = os.path.relpath(directory, start=root)
+        else:
+            normalized_dirs[key] = directory
+    return normalized_dirs[key]
+
 def normalize_path(path, note):
     """If the path is relative, make it relative to the Notebook file."""
-    notebook_dir = os.path.abspath(os.path.dirname(utils.find_registry()))
-    if notebook_dir in os.path.dirname(os.path.abspath(path)):
-        # path is in the base directory or a child directory; store as relative
-        return os.path.relpath(path, start=notebook_dir)
-    else:
-        # path is outside of the base directory; store as absolute
-        return os.path.abspath(path)
-    
+    return normalize_paths((path,))[0]
+
+def normalize_paths(paths):
+    """Normalize many paths at once (see normalize_path).
+
+    The notebook root and working directory are looked up once, and each
+    distinct directory is only normalized once."""
+    root = notebook_root()
+    cwd = os.getcwd()
+    normalized = []
+    for path in paths:
+        full = os.path.normpath(os.path.join(cwd, path))
+        directory, name = os.path.split(full)
+        stored = normalize_dir(root, directory)
+        if stored == '.':
+            normalized.append(name)
+        else:
+            normalized.append(os.path.join(stored, name))
+    return normalized
 
 Part = namedtuple('Part', (
     'name', # str
@@ -143,6 +260,10 @@ class CreationFailure(Exception):
 
 class Note:
     """Represents a generalized pickleable note."""
+    # stored attributes that are not parts (never entered by the user);
+    # (name, kind) pairs, with kinds as in fileio
+    extras = ()
+
     def __init__(self, uid, vals):
         """Initialize from plain text values."""
         self.uid = uid
@@ -165,6 +286,8 @@ class Note:
         state = {}
         for part in self.parts:
             state[part.name] = getattr(self, part.name)
+        for name, kind in self.extras:
+            state[name] = getattr(self, name)
         state['uid'] = self.uid
         return state
     def __setstate__(self, state):
@@ -181,6 +304,7 @@ class Note:
             processed = part.loader(val, self)
             setattr(self, part.name, processed)
 
+    @profiling.timed('note.autolink')
     def autolink(self, text):
         """Return autolinked LinkedText."""
         lt = LinkedText(text)
@@ -240,6 +364,16 @@ class ActionNote(Note):
     searchable = tuple()
     unsafe = tuple()
     # custom __str__ function; no strify
+    extras = (('stdout_bytes', 'q'), ('stderr_bytes', 'q'), ('runtime', 'q'),
+              ('returncode', 'i'))
+
+    # bytes the run printed to stdout and stderr
+    stdout_bytes = 0
+    stderr_bytes = 0
+    # duration of the run in microseconds
+    runtime = 0
+    # exit status of the run (its logs are found by UID; see runlog.log_dir)
+    returncode = 0
 
     def autofill(self, vals):
         """Attempt to autofill empty values."""
@@ -252,6 +386,7 @@ class ActionNote(Note):
         """Overrides base Note __str__()."""
         s = "Action using '{}' at time '{}'".format(
             self.toolcmd.text, str(self.time))
+        return s
 
 class DataNote(Note):
     """Represents a note about a data file."""
@@ -265,6 +400,10 @@ class DataNote(Note):
     required = ('path',)
     unsafe = tuple()
     strify = ('Data', 'name')
+    extras = (('fingerprint', 's'),)
+
+    # content fingerprint of the file, or '' if never taken; see fingerprint
+    fingerprint = ''
 
     def autofill(self, vals):
         """Attempt to autofill empty values."""
@@ -0,0 +1,274 @@
+"""Export a notebook as a static HTML site with client-side search.
+
+Pages are rendered by hyperpage and converted from its markdown. The home
+page (index.html) lists the actions HOME_PAGE_SIZE at a time, followed by
+further numbered pages. The search index maps lowercased terms (names,
+commands and paths, whole and split into words, plus the words of
+descriptions) to UIDs, and is split into shards by the first PREFIX_LENGTH
+characters (code points, in Python and JavaScript alike) of each term; note
+titles are sharded by UID. A browser loads only the shards a query touches,
+or, for words shorter than a shard key, the shards listed in the prefix list
+that start with them, so the site opens instantly however large the notebook
+is. Shards are JSON wrapped in a script call, so the site also works when
+opened straight from the filesystem."""
+from hypernote import fulltext
+from hypernote import note
+from hypernote import registry
+from hypernote.output import hyperpage
+import html
+import json
+import os
+import re
+
+# characters of a term that choose its search shard
+PREFIX_LENGTH = 2
+
+# actions listed per home page
+HOME_PAGE_SIZE = 100
+
+# notes per title shard (on average; titles are sharded by UID modulo the
+# number of shards)
+TITLES_PER_SHARD = 2000
+
+# note attributes indexed whole as well as word by word
+NAME_FIELDS = ('name', 'cmd', 'path')
+
+LINK = re.compile(r'\[([^\]]*)\]\(([^)\s]*)\)')
+BOLD = re.compile(r'\*\*(.+?)\*\*')
+ITALIC = re.compile(r'\*(.+?)\*')
+LIST_ITEM = re.compile(r'\d+\. ')
+
+PAGE = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<link rel="stylesheet" href="style.css">
+</head>
+<body>
+{body}
+</body>
+</html>
+'''
+
+SEARCH_BOX = '''<input id="search" type="search" placeholder="Search notes"
+       autofocus oninput="hnote.query(this.value)">
+<ol id="results"></ol>
+<script src="search.js"></script>
+'''
+
+STYLE = '''body { font-family: sans-serif; max-width: 50em; margin: 2em auto;
+       padding: 0 1em; line-height: 1.5; }
+#search { width: 100%; font-size: 1.2em; padding: 0.3em; }
+a { color: #1a5fb4; }
+'''
+
+SEARCH_JS = '''var hnote = (function () {
+  var TITLE_SHARDS = %d, PREFIX_LENGTH = %d, LIMIT = 50;
+  var shards = {}, waiting = {}, latest = '';
+  var PUNCT = /^[!-\\/:-@\\[-`{-~]+|[!-\\/:-@\\[-`{-~]+$/g;
+  function hex(s) {
+    return Array.from(new TextEncoder().encode(s), function (b) {
+      return b.toString(16).padStart(2, '0');
+    }).join('');
+  }
+  function loaded(key, data) {
+    shards[key] = data;
+    (waiting[key] || []).forEach(function (cb) { cb(data); });
+    delete waiting[key];
+  }
+  function load(key, src, cb) {
+    if (key in shards) return cb(shards[key]);
+    (waiting[key] = waiting[key] || []).push(cb);
+    if (waiting[key].length > 1) return;
+    var s = document.createElement('script');
+    s.src = src;
+    s.onerror = function () { loaded(key, {}); };
+    document.head.appendChild(s);
+  }
+  function shardKeys(word, cb) {
+    // code points, as in Python (slice() would count UTF-16 units)
+    var chars = Array.from(word);
+    if (chars.length >= PREFIX_LENGTH) {
+      return cb([chars.slice(0, PREFIX_LENGTH).join('')]);
+    }
+    // shorter than a shard key: every shard whose key starts with it
+    load('prefixes', 'terms/prefixes.js', function (prefixes) {
+      cb(Object.keys(prefixes).filter(function (p) {
+        return p.startsWith(word);
+      }));
+    });
+  }
+  function lookup(word, cb) {
+    shardKeys(word, function (keys) {
+      var uids = new Set(), pending = keys.length;
+      if (!pending) return cb(uids);
+      keys.forEach(function (key) {
+        load('terms/' + key, 'terms/' + hex(key) + '.js', function (shard) {
+          for (var term in shard) {
+            if (term.startsWith(word)) shard[term].forEach(function (u) {
+              uids.add(u);
+            });
+          }
+          if (!--pending) cb(uids);
+        });
+      });
+    });
+  }
+  function show(uids) {
+    var list = document.getElementById('results');
+    list.innerHTML = '';
+    uids.slice(0, LIMIT).forEach(function (uid) {
+      var item = document.createElement('li');
+      var a = document.createElement('a');
+      a.href = uid + '.html';
+      a.textContent = uid;
+      item.appendChild(a);
+      list.appendChild(item);
+      var n = uid %% TITLE_SHARDS;
+      load('titles/' + n, 'titles/' + n + '.js', function (titles) {
+        if (uid in titles) a.textContent = titles[uid];
+      });
+    });
+  }
+  function query(text) {
+    latest = text;
+    var words = text.toLowerCase().split(/\\s+/).map(function (w) {
+      return w.replace(PUNCT, '');
+    }).filter(function (w) { return w.length > 0; });
+    if (!words.length) return show([]);
+    var sets = [], pending = words.length;
+    words.forEach(function (word, i) {
+      lookup(word, function (uids) {
+        sets[i] = uids;
+        if (--pending || text !== latest) return;
+        var found = Array.from(sets[0]).filter(function (u) {
+          return sets.every(function (s) { return s.has(u); });
+        });
+        show(found.sort(function (a, b) { return a - b; }));
+      });
+    });
+  }
+  return {loaded: loaded, query: query};
+})();
+'''
+
+def inline_html(text):
+    """Convert the inline markdown emitted by hyperpage to HTML."""
+    text = html.escape(text, quote=False)
+    text = LINK.sub(lambda m: '<a href="{}">{}</a>'.format(
+        m.group(2).replace('"', '&quot;'), m.group(1)), text)
+    text = BOLD.sub(r'<strong>\1</strong>', text)
+    return ITALIC.sub(r'<em>\1</em>', text)
+
+def markdown_html(text):
+    """Convert a page of the markdown emitted by hyperpage to HTML."""
+    blocks = []
+    for block in re.split(r'\n\s*\n', text.strip()):
+        lines = block.split('\n')
+        if all(LIST_ITEM.match(line) for line in lines):
+            start = int(lines[0].split('.')[0])
+            items = '\n'.join(
+                '<li>{}</li>'.format(inline_html(LIST_ITEM.sub('', line, 1)))
+                for line in lines)
+            blocks.append('<ol{}>\n{}\n</ol>'.format(
+                ' start="{}"'.format(start) if start != 1 else '', items))
+        else:
+            blocks.append('<p>{}</p>'.format(
+                '<br>\n'.join(inline_html(line) for line in lines)))
+    return '\n'.join(blocks)
+
+def html_page(text):
+    """Convert a markdown page to a complete HTML document."""
+    first = LINK.sub(r'\1', text.strip().split('\n')[0]).strip('*')
+    return PAGE.format(title=html.escape(first), body=markdown_html(text))
+
+def note_terms(n):
+    """Get the search terms of a note."""
+    terms = set()
+    for attr in NAME_FIELDS:
+        val = getattr(n, attr, None)
+        if isinstance(val, str) and val:
+            terms.add(val.lower())
+            terms.update(t[2] for t in fulltext.tokenize(val))
+    terms.update(t[2] for t in fulltext.tokenize(fulltext.note_text(n)))
+    if type(n) == note.ActionNote:
+        terms.update(t[2] for t in fulltext.tokenize(n.shellcmd.text))
+    return terms
+
+def write_shard(path, key, data):
+    """Write a shard as JSON wrapped in a call to hnote.loaded()."""
+    with open(path, 'w') as fout:
+        fout.write('hnote.loaded({}, {});\n'.format(
+            json.dumps(key), json.dumps(data, separators=(',', ':'))))
+
+def title_shards(notes):
+    """Get the number of title shards for the given notes."""
+    return max(1, -(-len(notes)//TITLES_PER_SHARD))
+
+def write_search_index(directory, notes):
+    """Write the term and title shards for the given notes."""
+    terms = {} # prefix -> {term -> [uid]}
+    titles = {} # shard number -> {uid -> title}
+    num_titles = title_shards(notes)
+    for uid in sorted(notes):
+        n = notes[uid]
+        for term in note_terms(n):
+            terms.setdefault(term[:PREFIX_LENGTH], {}).setdefault(
+                term, []).append(uid)
+        titles.setdefault(uid % num_titles, {})[uid] = str(n)
+    os.makedirs(os.path.join(directory, 'terms'), exist_ok=True)
+    os.makedirs(os.path.join(directory, 'titles'), exist_ok=True)
+    for prefix, shard in terms.items():
+        write_shard(os.path.join(directory, 'terms', '{}.js'.format(
+            prefix.encode('utf8').hex())), 'terms/' + prefix, shard)
+    write_shard(os.path.join(directory, 'terms', 'prefixes.js'), 'prefixes',
+                {prefix: len(shard) for prefix, shard in terms.items()})
+    for i, shard in titles.items():
+        write_shard(os.path.join(directory, 'titles', '{}.js'.format(i)),
+                    'titles/{}'.format(i), shard)
+
+def home_page_name(i):
+    """Get the name of the i-th home page (from 0)."""
+    return 'index' if i == 0 else 'index-{}'.format(i + 1)
+
+def write_home_pages(directory, actions):
+    """Write the home pages, listing HOME_PAGE_SIZE actions each."""
+    num_pages = max(1, -(-len(actions)//HOME_PAGE_SIZE))
+    for i in range(num_pages):
+        text = hyperpage.generate_titlepage(
+            actions, i*HOME_PAGE_SIZE, HOME_PAGE_SIZE)
+        links = ['Page {} of {}.'.format(i + 1, num_pages)]
+        if i > 0:
+            links.append('[Previous page]({}.html)'.format(
+                home_page_name(i - 1)))
+        if i < num_pages - 1:
+            links.append('[Next page]({}.html)'.format(
+                home_page_name(i + 1)))
+        body = SEARCH_BOX + markdown_html(text + '\n' + ' '.join(links))
+        hyperpage.dump_file(PAGE.format(title='HyperNote', body=body),
+                            os.path.join(directory,
+                                         home_page_name(i) + '.html'))
+
+def export(directory):
+    """Export the notes in the registry as a site in the given directory."""
+    registry.load_all()
+    os.makedirs(directory, exist_ok=True)
+    saved = (hyperpage.TEMP_DIR, hyperpage.LINK_DIR, hyperpage.PAGE_EXT,
+             hyperpage.convert, hyperpage.HOME_PAGE)
+    hyperpage.TEMP_DIR = directory
+    hyperpage.LINK_DIR = '.'
+    hyperpage.PAGE_EXT = '.html'
+    hyperpage.convert = html_page
+    hyperpage.HOME_PAGE = home_page_name(0)
+    try:
+        for uid in registry.notes:
+            hyperpage.genpage_general(registry.get(uid))
+        write_home_pages(directory, hyperpage.get_action_notes())
+    finally:
+        (hyperpage.TEMP_DIR, hyperpage.LINK_DIR, hyperpage.PAGE_EXT,
+         hyperpage.convert, hyperpage.HOME_PAGE) = saved
+    hyperpage.dump_file(STYLE, os.path.join(directory, 'style.css'))
+    hyperpage.dump_file(SEARCH_JS % (title_shards(registry.notes), PREFIX_LENGTH),
+                        os.path.join(directory, 'search.js'))
+    write_search_index(directory, registry.notes)
@@ -1,11 +1,22 @@
 """Send a hyperlinked notebook to be viewed through HyperPage."""
 from hypernote import registry
 from hypernote import note
+from hypernote import profiling
 from tempfile import TemporaryDirectory
 import subprocess
 
+# directory the pages are written to
 TEMP_DIR = None
+# directory pages link to each other through (TEMP_DIR if None)
+LINK_DIR = None
+# extension of page files
+PAGE_EXT = '.md'
+# function (markdown text -> page text) applied to pages as they are written
+convert = None
+# name of the page that note pages link back to
+HOME_PAGE = 'home'
 
+@profiling.timed('hyperpage.run')
 def run():
     with TemporaryDirectory() as tempdir:
         global TEMP_DIR
@@ -17,8 +28,8 @@ def run():
 
         # generate title page
         action_notes = get_action_notes()
-        dump_file(generate_titlepage(action_notes), tempdir+'/home.md')
-        subprocess.run(['hpage', tempdir+'/home.md'])
+        dump_page(generate_titlepage(action_notes), HOME_PAGE)
+        subprocess.run(['hpage', page_link(HOME_PAGE)])
 
 def get_action_notes():
     """Get all action notes from the registry; sort chronologically."""
@@ -31,29 +42,34 @@ def homelinked(inner):
     """Wrapper that links the page returned by the inner function home."""
     def fun(n):
         t = inner(n)
-        return t + '\n[Return to the homepage.]({}/home.md)\n'.format(TEMP_DIR)
+        return t + '\n[Return to the homepage.]({})\n'.format(
+            page_link(HOME_PAGE))
     return fun
 
 def autodump(inner):
     """Wrapper that automatically dumps to file the inner return value."""
     def fun(n):
         t = inner(n)
-        dump_file(t, '{}/{}.md'.format(TEMP_DIR, n.uid))
+        dump_page(t, n.uid)
     return fun
 
-def generate_titlepage(notes):
-    """Generate a home/landing/title page that links to all the action notes."""
+def generate_titlepage(notes, first=0, count=None):
+    """Generate a home/landing/title page that links to the action notes.
+
+    Only count notes (default: all) starting at index first are listed."""
     # header
     text = '{} total actions have been recorded in this notebook.\n\n'.format(
         len(notes))
     # list of links to each action
-    for i, n in enumerate(notes):
+    end = len(notes) if count is None else first + count
+    for i, n in enumerate(notes[first:end], first):
         text += '{}. [{}]({})\n'.format(
             i+1,
             n.desc.text.split('\n')[0],
-            '{}/{}.md'.format(TEMP_DIR, n.uid))
+            page_link(n.uid))
     return text
 
+@profiling.timed('hyperpage.genpage')
 def genpage_general(any_note):
     """Correctly generate markdown for the given note of any type."""
     f = None
@@ -103,6 +119,7 @@ def genpage_data(data_note):
                 render_links(data_note.src),
                 render_links(data_note.desc))
 
+@profiling.timed('hyperpage.render_links')
 def render_links(ltext):
     """Convert a LinkedText object into markdown."""
     text = ''
@@ -112,14 +129,24 @@ def render_links(ltext):
         # add in plaintext between last link and this one
         text += ltext.text[last_end:link.pos.start]
         # add in link text
-        text += '[{}]({})'.format(ltext[link.pos],
-                                  '{}/{}.md'.format(TEMP_DIR, link.dest))
+        text += '[{}]({})'.format(ltext[link.pos], page_link(link.dest))
         last_link = link
     # add in plaintext between last link and end of string
     last_end = last_link.pos.end if last_link is not None else 0
     text += ltext.text[last_end:]
     return text
 
+def page_link(name):
+    """Get the link to the named page (a note UID or HOME_PAGE)."""
+    return '{}/{}{}'.format(LINK_DIR or TEMP_DIR, name, PAGE_EXT)
+
+def dump_page(text, name):
+    """Write the named page (a note UID or HOME_PAGE) to the page
+    directory."""
+    if convert is not None:
+        text = convert(text)
+    dump_file(text, '{}/{}{}'.format(TEMP_DIR, name, PAGE_EXT))
+
 def dump_file(text, path):
     """Dump the given text to the file at the given path."""
     with open(path, 'w') as fout:
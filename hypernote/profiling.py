@@ -0,0 +1,131 @@
+"""Lightweight timers and counters around the program's hot paths.
+
+Profiling is switched on by the HNOTE_PROFILE environment variable or the
+--profile[=output] command line flag. The output decides what is written
+besides the per-phase breakdown (printed to stderr):
+  '1' or no output: the breakdown only.
+  *.json: a Chrome trace-event file (load it in chrome://tracing).
+  anything else: a cProfile/pstats dump of the whole run.
+When profiling is off, each timed call costs one flag check."""
+from contextlib import contextmanager
+from functools import wraps
+from time import perf_counter
+import json
+import os
+import sys
+
+# cap on recorded trace events, to bound memory on huge runs
+MAX_EVENTS = 1000000
+
+enabled = False
+output = None
+
+# phase -> [calls, inclusive seconds, self seconds]
+timings = {}
+# name -> count
+counters = {}
+# trace events (phase, start, end); only kept when writing a trace
+events = []
+tracing = False
+# [phase, start, seconds spent in timed callees] for each active call
+stack = []
+
+def timed(phase):
+    """Wrapper that times calls to the inner function under the given phase."""
+    def timed_wrapper(inner):
+        @wraps(inner)
+        def fun(*args, **kwargs):
+            if not enabled:
+                return inner(*args, **kwargs)
+            frame = [phase, perf_counter(), 0.0]
+            stack.append(frame)
+            try:
+                return inner(*args, **kwargs)
+            finally:
+                end = perf_counter()
+                stack.pop()
+                record(frame, end)
+        return fun
+    return timed_wrapper
+
+def record(frame, end):
+    """Record the end of a timed call."""
+    phase, start, child = frame
+    elapsed = end - start
+    t = timings.setdefault(phase, [0, 0.0, 0.0])
+    t[0] += 1
+    t[2] += elapsed - child
+    # don't count recursive calls twice in the inclusive time
+    if not any(f[0] == phase for f in stack):
+        t[1] += elapsed
+    if stack:
+        stack[-1][2] += elapsed
+    if tracing and len(events) < MAX_EVENTS:
+        events.append((phase, start, end))
+
+def count(name, n=1):
+    """Add to a named counter."""
+    if enabled:
+        counters[name] = counters.get(name, 0) + n
+
+def configure(argv):
+    """Turn profiling on from HNOTE_PROFILE or --profile[=output] in argv.
+
+    The flag is removed from argv."""
+    global enabled, output
+    setting = os.environ.get('HNOTE_PROFILE')
+    for arg in list(argv[1:]):
+        if arg == '--profile' or arg.startswith('--profile='):
+            argv.remove(arg)
+            setting = arg.partition('=')[2] or '1'
+    if setting and setting != '0':
+        enabled = True
+        output = None if setting == '1' else setting
+
+@contextmanager
+def session():
+    """Profile the enclosed block (if enabled) and write the results."""
+    global tracing
+    if not enabled:
+        yield
+        return
+    profiler = None
+    tracing = output is not None and output.endswith('.json')
+    if output is not None and not tracing:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        wall = perf_counter() - start
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(output)
+        if tracing:
+            write_trace(output, start)
+        sys.stderr.write(report(wall))
+
+def report(wall):
+    """Format the per-phase breakdown."""
+    lines = ['{:<32} {:>9} {:>11} {:>11} {:>6}'.format(
+        'phase', 'calls', 'total ms', 'self ms', '%')]
+    for phase in sorted(timings, key=lambda p: -timings[p][1]):
+        calls, total, own = timings[phase]
+        lines.append('{:<32} {:>9} {:>11.2f} {:>11.2f} {:>6.1f}'.format(
+            phase, calls, total*1e3, own*1e3,
+            100*total/wall if wall else 0))
+    lines.append('{:<32} {:>9} {:>11.2f}'.format('(wall)', '', wall*1e3))
+    for name in sorted(counters):
+        lines.append('{:<32} {:>9}'.format(name, counters[name]))
+    return '\n'.join(lines) + '\n'
+
+def write_trace(path, origin):
+    """Write the recorded events as a Chrome trace-event JSON file."""
+    pid = os.getpid()
+    trace = [dict(name=phase, ph='X', pid=pid, tid=0,
+                  ts=(start - origin)*1e6, dur=(end - start)*1e6)
+             for phase, start, end in events]
+    with open(path, 'w') as fout:
+        json.dump(dict(traceEvents=trace, displayTimeUnit='ms'), fout)
@@ -1,90 +1,357 @@
 """Implements a searchable registry of notes."""
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 import regex
+import os
 import pickle
 import random
-from hypernote import fileio
+from hypernote import backends
+from hypernote import columns
+from hypernote import fulltext
+from hypernote import history
+from hypernote import merkle
+from hypernote import profiling
+from hypernote import relations
+from hypernote import rollups
+from hypernote.note import ActionNote
 
-# one entry in the search table
-STEntry = namedtuple('STEntry', ('text', 'uid'))
-search_table = []
-
-# uid -> note
-notes = {}
+# default number of notebooks kept open by a NotebookPool
+POOL_SIZE = 8
 
 def gen_uid_possibility():
     """Generate a possible ID (unchecked)."""
     return random.getrandbits(31) # 31 bits because we save as SIGNED
-    
-def gen_uid():
-    """Generate a new UID, assuming that the registry is loaded."""
-    uid = gen_uid_possibility()
-    while uid in notes:
+
+class Notebook:
+    """The notes, search table and relations of one open notebook."""
+    def __init__(self, rels=None):
+        """Create an empty notebook.
+
+        rels: RelationDB to use (default: a new one)."""
+        # lowercased searchable text -> list of uids
+        self.search_table = {}
+        # uid -> note
+        self.notes = {}
+        # storage backend of the currently loaded notebook
+        self.store = None
+        # whether notes not yet in memory must be queried from the store
+        self.lazy = False
+        # uids of notes added since the registry was loaded
+        self.dirty = set()
+        # incremented whenever a note is added or changed
+        self.generation = 0
+        # (generation, columns) from the last call to to_columns
+        self.columns_cache = None
+        self.relations = relations.RelationDB() if rels is None else rels
+        # past versions of the notes (None while loading)
+        self.history = history.History()
+        # per-tool rollups of the actions (None while loading)
+        self.rollups = rollups.Rollups()
+
+    def gen_uid(self):
+        """Generate a new UID, assuming that the registry is loaded."""
         uid = gen_uid_possibility()
-    return uid
-
-def load(path):
-    """Load the registry from file."""
-    if path is None:
-        return
-    data_all = None
-    with open(path, 'rb') as fin:
-        data_all = bytearray(fin.read())
-    while data_all:
-        note = fileio.load_object(data_all)
-        add(note)
-
-def save(path):
-    """Save the registry to file."""
-    if path is None:
-        return
-    global notes
-    with open(path, 'wb') as fout:
-        for uid in notes:
-            note = notes[uid]
-            enc = fileio.get_encoder(type(note))
-            data = enc(note)
-            fout.write(data)
-
-def add(note):
-    """Add a note to the registry.
-
-    If another note already exists with one or more identical searchables,
-    raise a RuntimeError."""
-    global notes, search_table
-
-    # check that a note doesn't already exist with these
-    # searchable properties
-    for attr in note.searchable:
-        query = str(getattr(note, attr))
-        if search(query):
-            raise RuntimeError('Another note already exists with a searchable'
-                               " property of '{}'.".format(query))
-
-    # "register" note
-    notes[note.uid] = note
-
-    # register search terms
-    for attr in note.searchable:
-        entry = STEntry(str(getattr(note, attr)), note.uid)
-        search_table.append(entry)
-
-def get(uid):
-    """Get the note identifed by the given UID."""
-    global notes
-    return notes[uid]
-
-def search(query):
-    """Identify matches between the plaintext query and note UIDs.
+        while self.exists(uid):
+            uid = gen_uid_possibility()
+        return uid
 
-    Return a list of matching UIDs."""
-    global search_table
-    matches = [e for e in search_table if e.text.lower() == query.lower()]
-    matches_unique_uids = []
-    for m in matches:
-        if m.uid not in matches_unique_uids:
-            matches_unique_uids.append(m.uid)
-    return matches_unique_uids
+    def init(self, path, fmt='stream', **options):
+        """Save the registry as a new notebook in the given storage format.
+
+        options are passed on to the backend (e.g. num_shards for
+        'sharded')."""
+        if fmt not in backends.formats:
+            raise RuntimeError("Unknown notebook format '{}'!".format(fmt))
+        self.store = backends.formats[fmt](path, **options)
+        self.lazy = False
+        self.store.save(self.notes, None)
+        self.store.save_relations(self.relations.reldb, None)
+        self.history.save(path)
+        rollups.save(path, self.store, self.rollups)
+        self.dirty.clear()
+        self.relations.new.clear()
+
+    @profiling.timed('registry.load')
+    def load(self, path):
+        """Load the registry from file.
+
+        Lazy backends (e.g. sqlite) are only opened; notes are fetched from
+        them as they are asked for."""
+        if path is None:
+            return
+        self.store = backends.open_backend(path)
+        self.lazy = self.store.lazy
+        self.history = None
+        self.rollups = None
+        if self.lazy:
+            self.relations.lazy_store = self.store
+        else:
+            for note in self.store.load():
+                self.add(note)
+                profiling.count('notes loaded')
+            for rel in self.store.load_relations():
+                self.relations.add(rel)
+        self.history = history.History(path)
+        self.rollups = rollups.load(path, self.store)
+        if self.rollups is None:
+            self.rollups = rollups.rebuild(
+                self.store.load() if self.lazy else self.notes.values())
+        self.dirty.clear()
+        self.relations.new.clear()
+
+    def clear(self):
+        """Forget the loaded notebook, leaving an empty registry."""
+        self.notes.clear()
+        self.search_table.clear()
+        self.dirty.clear()
+        self.store = None
+        self.lazy = False
+        self.columns_cache = None
+        self.history = history.History()
+        self.rollups = rollups.Rollups()
+        self.relations.clear()
+
+    def load_all(self):
+        """Bring every note and relation of a lazily loaded notebook into
+        memory."""
+        if not self.lazy:
+            return
+        for note in self.store.load():
+            if note.uid not in self.notes:
+                self.notes[note.uid] = note
+                self.register_search_terms(note)
+        self.relations.reldb[:0] = self.store.load_relations()
+        self.relations.lazy_store = None
+        self.lazy = False
+
+    @profiling.timed('registry.save')
+    def save(self, path):
+        """Save the registry to file."""
+        if path is None:
+            return
+        if self.store is None or self.store.path != path:
+            self.store = backends.open_backend(path)
+        before = self.store.stamp()
+        self.store.save(self.notes, self.dirty)
+        self.store.save_relations(self.relations.reldb, self.relations.new)
+        self.history.save(path)
+        rollups.save(path, self.store, self.rollups)
+        saved = [self.notes[uid] for uid in self.dirty if uid in self.notes]
+        fulltext.log_notes(path, before, self.store.stamp(), saved)
+        merkle.log_changes(path, before, self.store.stamp(), saved,
+                           self.relations.new)
+        self.dirty.clear()
+        if self.lazy:
+            # saved relations are now answered by the store
+            del self.relations.reldb[:]
+        self.relations.new.clear()
+
+    def add(self, note):
+        """Add a note to the registry.
+
+        If another note already exists with one or more identical
+        searchables, raise a RuntimeError."""
+        # check that a note doesn't already exist with these
+        # searchable properties
+        for attr in note.searchable:
+            query = str(getattr(note, attr))
+            if self.search(query):
+                raise RuntimeError('Another note already exists with a '
+                                   "searchable property of '{}'.".format(query))
+
+        # "register" note
+        self.notes[note.uid] = note
+        self.dirty.add(note.uid)
+        self.generation += 1
+        self.register_search_terms(note)
+        if self.history is not None:
+            self.history.add(note)
+        if self.rollups is not None:
+            self.rollups.add(note, self.kind_of)
+
+    def update(self, uid, **fields):
+        """Change the given fields of a registered note in place."""
+        note = self.get(uid)
+        self.history.update(note, fields)
+        if type(note) == ActionNote:
+            use = rollups.usage(note)
+        for attr in fields:
+            setattr(note, attr, fields[attr])
+        if type(note) == ActionNote:
+            self.rollups.change(use, rollups.usage(note), self.kind_of)
+        self.dirty.add(uid)
+        self.generation += 1
+
+    def replace(self, note):
+        """Replace a registered note with another version of it (same UID)."""
+        old = self.get(note.uid)
+        self.history.replace(old, note)
+        if type(old) == ActionNote and type(note) == ActionNote:
+            self.rollups.change(rollups.usage(old), rollups.usage(note),
+                                self.kind_of)
+        for attr in old.searchable:
+            uids = self.search_table.get(str(getattr(old, attr)).lower(), [])
+            if note.uid in uids:
+                uids.remove(note.uid)
+        self.notes[note.uid] = note
+        self.dirty.add(note.uid)
+        self.generation += 1
+        self.register_search_terms(note)
+
+    def register_search_terms(self, note):
+        """Add the searchable properties of a note to the search table."""
+        for attr in note.searchable:
+            text = str(getattr(note, attr)).lower()
+            self.search_table.setdefault(text, []).append(note.uid)
+
+    def kind_of(self, uid):
+        """Get the class of the note with the given UID (None if none)."""
+        if uid in self.notes:
+            return type(self.notes[uid])
+        return type(self.get(uid)) if self.exists(uid) else None
+
+    def tool_rollups(self):
+        """Get the rollups (see rollups.Rollup) of every tool, as a dictionary
+        (uid of the ToolNote -> Rollup)."""
+        if self.rollups.stale:
+            self.load_all()
+            self.rollups = rollups.rebuild(self.notes.values())
+        return self.rollups.tools
+
+    def exists(self, uid):
+        """Return whether a note with the given UID exists."""
+        return uid in self.notes or (self.lazy and self.store.has(uid))
+
+    def get(self, uid):
+        """Get the note identifed by the given UID."""
+        if self.lazy and uid not in self.notes:
+            # cache it; it is not dirty, so it will not be saved again
+            self.notes[uid] = self.store.get(uid)
+        return self.notes[uid]
+
+    @profiling.timed('registry.search')
+    def search(self, query):
+        """Identify matches between the plaintext query and note UIDs.
+
+        Return a list of matching UIDs."""
+        matches = self.search_table.get(query.lower(), [])
+        if self.lazy:
+            matches = self.store.search(query) + matches
+        matches_unique_uids = []
+        for uid in matches:
+            if uid not in matches_unique_uids:
+                matches_unique_uids.append(uid)
+        return matches_unique_uids
+
+    def time_range(self, start, end):
+        """Get the ActionNotes performed at start <= time < end, in time
+        order."""
+        notes = self.notes
+        found = {uid: notes[uid] for uid in notes
+                 if type(notes[uid]) == ActionNote
+                 and start <= notes[uid].time < end}
+        if self.lazy:
+            for uid in self.store.time_range(start, end):
+                if uid not in found:
+                    found[uid] = self.get(uid)
+        return sorted(found.values(), key=lambda n: n.time)
+
+    def as_of(self, time):
+        """Get a view (see history.View) of the notes as they were at the
+        given time (datetime)."""
+        return history.View(self, time)
+
+    def to_columns(self):
+        """Get the registry as NumPy columns (see columns.to_columns).
+
+        The columns are cached until a note is added or changed."""
+        self.load_all()
+        if self.columns_cache is None or \
+                self.columns_cache[0] != self.generation:
+            self.columns_cache = (self.generation,
+                                  columns.to_columns(self.notes))
+        return self.columns_cache[1]
+
+class NotebookPool:
+    """A size-bounded pool of open notebooks.
+
+    Notebooks are keyed by path and modification time, so a notebook that
+    changed on disk is loaded again; the least recently used one is closed
+    when the pool is full."""
+    def __init__(self, size=POOL_SIZE):
+        self.size = size
+        self.open = OrderedDict() # (path, stamp) -> Notebook
+
+    def get(self, path):
+        """Get the notebook at the given path, loading it if needed."""
+        path = os.path.abspath(path)
+        key = (path, backends.stamp(path))
+        nb = self.open.get(key)
+        if nb is not None:
+            self.open.move_to_end(key)
+            return nb
+        self.discard(path)
+        nb = Notebook()
+        nb.load(path)
+        self.open[key] = nb
+        while len(self.open) > self.size:
+            self.open.popitem(last=False)
+        return nb
+
+    def save(self, path):
+        """Save an open notebook, keeping it open under its new stamp."""
+        path = os.path.abspath(path)
+        for key, nb in list(self.open.items()):
+            if key[0] == path:
+                nb.save(path)
+                del self.open[key]
+                self.open[path, nb.store.stamp()] = nb
+
+    def discard(self, path):
+        """Close the notebook at the given path, dropping unsaved changes."""
+        path = os.path.abspath(path)
+        for key in [k for k in self.open if k[0] == path]:
+            del self.open[key]
+
+# the notebook used by the module-level functions
+default = Notebook(relations.default)
+
+# aliases of the default notebook's containers
+search_table = default.search_table
+notes = default.notes
+dirty = default.dirty
+
+def __getattr__(name):
+    """Get the default notebook's rebindable state (store, lazy, ...)."""
+    if name in ('store', 'lazy', 'generation', 'columns_cache'):
+        return getattr(default, name)
+    raise AttributeError(
+        "module '{}' has no attribute '{}'".format(__name__, name))
+
+# the pool used by open_notebook
+pool = NotebookPool()
+
+def open_notebook(path):
+    """Get the notebook at the given path from the shared pool."""
+    return pool.get(path)
+
+gen_uid = default.gen_uid
+init = default.init
+load = default.load
+clear = default.clear
+load_all = default.load_all
+save = default.save
+add = default.add
+update = default.update
+replace = default.replace
+register_search_terms = default.register_search_terms
+kind_of = default.kind_of
+tool_rollups = default.tool_rollups
+exists = default.exists
+get = default.get
+search = default.search
+time_range = default.time_range
+as_of = default.as_of
+to_columns = default.to_columns
 
 def search_depr(query):
     """Identify matches between the plaintext query and note UIDs.
@@ -95,10 +362,10 @@ def search_depr(query):
     # find the top 5 matches?
     Match = namedtuple('Match', 'uid', 'score')
     matches = [] # sorted in order of decreasing score
-    for entry in search_table:
-        score = match(query, entry.text)
+    for text, uid in [(t, u) for t in search_table for u in search_table[t]]:
+        score = match(query, text)
         # this alg is not incredible
-        matches.append((entry.uid, score))
+        matches.append((uid, score))
         matches.sort(key=lambda x: x.score, reverse=True)
         if len(matches) > 5:
             del matches[5] # chop off the end
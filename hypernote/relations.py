@@ -1,4 +1,5 @@
 """Implements a registry of note-note relations."""
+from collections import namedtuple
 import pickle
 
 Relation = namedtuple('Relation', ('uidA', 'uidB', 'typeA', 'typeB'))
@@ -10,47 +11,94 @@ RT_USED, RT_USED_BY, \
     RT_BEFORE, RT_AFTER, \
     *_ = range(100)
 
-# database of relations
-reldb = []
+class RelationDB:
+    """A database of relations."""
+    def __init__(self):
+        # every relation held in memory
+        self.reldb = []
+        # relations added since the database was loaded
+        self.new = []
+        # lazy storage backend answering queries for relations not in reldb
+        self.lazy_store = None
+
+    def load(self, path):
+        """Load the relation registry from file."""
+        for rel in read(path):
+            self.add(rel)
+
+    def save(self, path):
+        """Save the relation registry to file."""
+        write(path, self.reldb)
+
+    def add(self, rel):
+        """Add a Relation to the database."""
+        self.reldb.append(rel)
+        self.new.append(rel)
+
+    def get(self, query):
+        """Query the relation database.
+
+        The query argument is a tuple of UIDs.
+        If query contains one value, find all relations pertaining to the
+        given UID. If query contains two values, find all relations
+        pertaining to both UIDs.
+
+        Is a generator!
+        """
+        for rel in self.reldb:
+            if is_match(query, rel):
+                yield rel
+        if self.lazy_store is not None:
+            yield from self.lazy_store.relations(query)
+
+    def clear(self):
+        """Forget every relation."""
+        del self.reldb[:]
+        del self.new[:]
+        self.lazy_store = None
+
+# the database used by the module-level functions (and the default notebook)
+default = RelationDB()
+
+# aliases of the default database's lists
+reldb = default.reldb
+new = default.new
+
+def read(path):
+    """Generate the relations stored in the given file."""
+    with open(path, 'rb') as fin:
+        while True:
+            try:
+                yield Relation(*pickle.load(fin))
+            except EOFError:
+                break
 
 def load(path):
     """Load the relation registry from file."""
-    fin = open(path, 'rb')
-    while True:
-        try:
-            rel = pickle.load(fin)
-            add(rel)
-        except:
-            # eof
-            break
-    fin.close()
+    default.load(path)
 
 def save(path):
     """Save the relation registry to file."""
+    default.save(path)
+
+def write(path, rels):
+    """Write the given relations to file."""
     fout = open(path, 'wb')
-    for rel in reldb:
+    for rel in rels:
         pickle.dump(rel, fout)
     fout.close()
 
 def add(rel):
     """Add a Relation to the database."""
-    global reldb
-    reldb.append(rel)
+    default.add(rel)
 
 def get(query):
-    """Query the relation database.
-
-    The query argument is a tuple of UIDs.
-    If query contains one value, find all relations pertaining to the given UID.
-    If query contains two values, find all relations pertaining to both UIDs.
+    """Query the relation database (see RelationDB.get).
 
     Is a generator!
     """
-    global reldb
-    for rel in reldb:
-        if is_match(query, rel):
-            yield rel
-    
+    return default.get(query)
+
 def is_match(query, rel):
     """Decides whether the given query matches the relation."""
     if query[0] in (rel.uidA, rel.uidB):
@@ -0,0 +1,123 @@
+"""Per-tool rollups of the actions recorded in a notebook.
+
+For every ToolNote the table keeps the number of actions using the tool
+(those whose tool field links to it), the times of the first and last of
+them, the DataNotes they link to and their total recorded runtime. The
+table is updated as notes are added or changed, saved in the notebook's
+'tools' sidecar along with the modification time of the notebook's files,
+and rebuilt in one pass over the notes when that no longer matches (the
+notebook was written by something else) or when an action's time changed
+(the first/last times of its tools can then not be updated in place)."""
+from hypernote import note
+from hypernote import utils
+import os
+import pickle
+
+class Rollup:
+    """How one tool has been used."""
+    def __init__(self):
+        self.count = 0 # actions
+        self.first = None # time of the first action (microseconds)
+        self.last = None # time of the last action (microseconds)
+        self.data = {} # uid of a DataNote -> number of actions linking to it
+        self.runtime = 0 # total runtime of the timed actions (microseconds)
+        self.timed = 0 # actions with a recorded runtime
+
+def usage(n):
+    """Get what an action contributes to the rollups of its tools.
+
+    Return (tool link destinations, other link destinations, time in
+    microseconds, runtime in microseconds); kinds are not yet checked."""
+    return (frozenset(link.dest for link in n.toolcmd),
+            frozenset(link.dest for attr in ('shellcmd', 'desc')
+                      for link in getattr(n, attr)),
+            utils.to_micros(n.time), n.runtime)
+
+class Rollups:
+    """The rollups of every tool of a notebook."""
+    def __init__(self):
+        self.tools = {} # uid of a ToolNote -> Rollup
+        self.stale = set() # tools whose first/last times may be wrong
+        self.stamp = None # modification time of the notebook when saved
+
+    def add(self, n, kind_of):
+        """Count a new note.
+
+        kind_of is a function (uid -> class of the note, or None)."""
+        if type(n) == note.ToolNote:
+            self.tools.setdefault(n.uid, Rollup())
+        elif type(n) == note.ActionNote:
+            self.count(usage(n), kind_of, 1)
+
+    def change(self, old, new, kind_of):
+        """Replace the usage of an action (see usage) by another."""
+        if old == new:
+            return
+        stale = set(self.stale)
+        self.count(old, kind_of, -1)
+        self.count(new, kind_of, 1)
+        if old[2] == new[2]:
+            # the first/last times of its tools are still right
+            self.stale = stale | (self.stale - (old[0] & new[0]))
+
+    def count(self, use, kind_of, sign):
+        """Add (sign 1) or remove (sign -1) the usage of an action."""
+        tools, others, time, runtime = use
+        data = [uid for uid in others if kind_of(uid) == note.DataNote]
+        for uid in tools:
+            if kind_of(uid) != note.ToolNote:
+                continue
+            r = self.tools.setdefault(uid, Rollup())
+            r.count += sign
+            if runtime:
+                r.runtime += sign*runtime
+                r.timed += sign
+            for d in data:
+                r.data[d] = r.data.get(d, 0) + sign
+                if not r.data[d]:
+                    del r.data[d]
+            if sign > 0:
+                r.first = time if r.first is None else min(r.first, time)
+                r.last = time if r.last is None else max(r.last, time)
+            elif not r.count:
+                r.first = r.last = None
+            elif time in (r.first, r.last):
+                self.stale.add(uid)
+
+def rebuild(notes):
+    """Build the rollups of the notes (any iterable) in one pass."""
+    table = Rollups()
+    kinds = {}
+    uses = []
+    for n in notes:
+        kinds[n.uid] = type(n)
+        if type(n) == note.ToolNote:
+            table.tools.setdefault(n.uid, Rollup())
+        elif type(n) == note.ActionNote:
+            uses.append(usage(n))
+    for use in uses:
+        table.count(use, kinds.get, 1)
+    return table
+
+def path(notebook_path):
+    """Get the path of the rollups of the given notebook."""
+    return utils.sidecar_path(notebook_path, 'tools')
+
+def load(notebook_path, store):
+    """Load the saved rollups of a notebook.
+
+    Return None if there are none, or they are out of date."""
+    p = path(notebook_path)
+    if not os.path.isfile(p):
+        return None
+    with open(p, 'rb') as fin:
+        table = pickle.load(fin)
+    if table.stale or table.stamp is None or table.stamp != store.stamp():
+        return None
+    return table
+
+def save(notebook_path, store, table):
+    """Save the rollups of a notebook, after its notes were saved."""
+    table.stamp = store.stamp()
+    with open(path(notebook_path), 'wb') as fout:
+        pickle.dump(table, fout, pickle.HIGHEST_PROTOCOL)
@@ -0,0 +1,203 @@
+"""A persistent balanced rope of text chunks carrying link spans.
+
+Leaves hold a chunk of text and the links that start in it, as sorted
+(start, end, dest) tuples relative to the chunk. Every node records its
+length, height, number of links and furthest link end, so concatenation,
+splitting and link range queries take logarithmic time. Nodes are never
+changed once built; operations return new trees sharing structure with
+their inputs."""
+from bisect import insort
+
+# maximum length of a leaf's text when building or merging leaves
+CHUNK = 1024
+
+class Leaf:
+    """A chunk of text and the links starting in it."""
+    __slots__ = ('text', 'links', 'length', 'height', 'count', 'max_end')
+
+    def __init__(self, text, links=()):
+        self.text = text
+        self.links = tuple(links)
+        self.length = len(text)
+        self.height = 0
+        self.count = len(self.links)
+        self.max_end = max([l[1] for l in self.links]) if self.links else -1
+
+class Node:
+    """The concatenation of two subtrees."""
+    __slots__ = ('left', 'right', 'length', 'height', 'count', 'max_end')
+
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+        self.length = left.length + right.length
+        self.height = max(left.height, right.height) + 1
+        self.count = left.count + right.count
+        self.max_end = left.max_end
+        if right.max_end >= 0:
+            self.max_end = max(self.max_end, left.length + right.max_end)
+
+EMPTY = Leaf('')
+
+def from_text(text, links=()):
+    """Build a rope from a string and (start, end, dest) links."""
+    if len(text) <= CHUNK:
+        return Leaf(text, sorted(links))
+    links = sorted(links)
+    leaves = []
+    j = 0
+    for i in range(0, len(text), CHUNK):
+        # each leaf takes the links starting in it; the last takes the rest
+        k = j
+        last = i + CHUNK >= len(text)
+        while k < len(links) and (last or links[k][0] < i + CHUNK):
+            k += 1
+        leaves.append(Leaf(text[i:i+CHUNK],
+                           [(s-i, e-i, d) for s, e, d in links[j:k]]))
+        j = k
+    return build(leaves, 0, len(leaves))
+
+def build(leaves, lo, hi):
+    """Build a balanced tree over leaves[lo:hi] (which must not be empty)."""
+    if hi - lo == 1:
+        return leaves[lo]
+    mid = (lo + hi)//2
+    return Node(build(leaves, lo, mid), build(leaves, mid, hi))
+
+def is_empty(node):
+    """Return whether a rope has neither text nor links."""
+    return not node.length and not node.count
+
+def balance(left, right):
+    """Join two trees whose heights differ by at most two."""
+    if left.height > right.height + 1:
+        if left.left.height >= left.right.height:
+            return Node(left.left, Node(left.right, right))
+        mid = left.right
+        return Node(Node(left.left, mid.left), Node(mid.right, right))
+    if right.height > left.height + 1:
+        if right.right.height >= right.left.height:
+            return Node(Node(left, right.left), right.right)
+        mid = right.left
+        return Node(Node(left, mid.left), Node(mid.right, right.right))
+    return Node(left, right)
+
+def join(a, b):
+    """Concatenate two ropes."""
+    if is_empty(a):
+        return b
+    if is_empty(b):
+        return a
+    if a.height > b.height + 1:
+        return balance(a.left, join(a.right, b))
+    if b.height > a.height + 1:
+        return balance(join(a, b.left), b.right)
+    if not a.height and not b.height and a.length + b.length <= CHUNK:
+        # merge small leaves, so ropes built piece by piece stay shallow
+        off = a.length
+        return Leaf(a.text + b.text,
+                    a.links + tuple((s+off, e+off, d) for s, e, d in b.links))
+    return Node(a, b)
+
+def split(node, i):
+    """Split a rope at offset i.
+
+    Return (left, right); links go to the side they start on, so links in
+    left may end past its end (see clip)."""
+    if i <= 0:
+        return EMPTY, node
+    if i >= node.length:
+        return node, EMPTY
+    if not node.height:
+        return (Leaf(node.text[:i], [l for l in node.links if l[0] < i]),
+                Leaf(node.text[i:], [(s-i, e-i, d) for s, e, d in node.links
+                                     if s >= i]))
+    left = node.left
+    if i < left.length:
+        ll, lr = split(left, i)
+        return ll, join(lr, node.right)
+    if i == left.length:
+        return left, node.right
+    rl, rr = split(node.right, i - left.length)
+    return join(left, rl), rr
+
+def clip(node, limit):
+    """Drop the links ending past the given offset."""
+    if node.max_end <= limit:
+        return node
+    if not node.height:
+        return Leaf(node.text, [l for l in node.links if l[1] <= limit])
+    return Node(clip(node.left, limit),
+                clip(node.right, limit - node.left.length))
+
+def substring(node, start, end):
+    """Get the rope of text [start, end), keeping the links inside it."""
+    start = max(0, start)
+    end = min(node.length, end)
+    if end <= start:
+        return EMPTY
+    rest = split(node, start)[1]
+    return clip(split(rest, end - start)[0], end - start)
+
+def add_link(node, start, end, dest):
+    """Add a link; return the new rope."""
+    if not node.height:
+        links = list(node.links)
+        insort(links, (start, end, dest))
+        return Leaf(node.text, links)
+    off = node.left.length
+    if start < off:
+        return Node(add_link(node.left, start, end, dest), node.right)
+    return Node(node.left, add_link(node.right, start-off, end-off, dest))
+
+def chunks(node):
+    """Generate the text chunks of a rope in order."""
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if node.height:
+            stack.append(node.right)
+            stack.append(node.left)
+        elif node.length:
+            yield node.text
+
+def text(node):
+    """Get the whole text of a rope."""
+    if not node.height:
+        return node.text
+    return ''.join(chunks(node))
+
+def links(node, base=0):
+    """Generate every link as absolute (start, end, dest), in start order."""
+    if not node.count:
+        return
+    if not node.height:
+        for s, e, d in node.links:
+            yield s+base, e+base, d
+    else:
+        yield from links(node.left, base)
+        yield from links(node.right, base + node.left.length)
+
+def links_in(node, start, end, base=0):
+    """Generate the links lying within [start, end)."""
+    if not node.count or base >= end or base + node.max_end < start:
+        return
+    if not node.height:
+        for s, e, d in node.links:
+            if s+base >= start and e+base <= end:
+                yield s+base, e+base, d
+    else:
+        yield from links_in(node.left, start, end, base)
+        yield from links_in(node.right, start, end, base + node.left.length)
+
+def links_at(node, offset, base=0):
+    """Generate the links covering the given offset (start <= offset < end)."""
+    if not node.count or base > offset or base + node.max_end <= offset:
+        return
+    if not node.height:
+        for s, e, d in node.links:
+            if s+base <= offset < e+base:
+                yield s+base, e+base, d
+    else:
+        yield from links_at(node.left, offset, base)
+        yield from links_at(node.right, offset, base + node.left.length)
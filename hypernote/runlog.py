@@ -0,0 +1,119 @@
+"""Run shell commands, teeing their output into compressed logs.
+
+The command's stdout and stderr are read with asyncio in fixed-size chunks,
+copied to the terminal as they arrive and at the same time gzipped into one
+log file per stream, in a directory per run kept alongside the notebook.
+Each log stops growing after LOG_LIMIT bytes, and only the first HEAD_SIZE
+and last TAIL_SIZE bytes of a stream stay in memory (for the excerpt added
+to the note), so memory use is fixed however much the command prints."""
+from hypernote import utils
+import asyncio
+import gzip
+import os
+import sys
+import time
+
+CHUNK_SIZE = 64 << 10
+
+# maximum uncompressed bytes written to each log
+LOG_LIMIT = 64 << 20
+
+# bytes of the start and end of each stream kept for the excerpt
+HEAD_SIZE = 1024
+TAIL_SIZE = 1024
+
+STREAMS = ('stdout', 'stderr')
+
+def log_dir(notebook_path, uid):
+    """Get the directory holding the logs of the run recorded by a note."""
+    return os.path.join(utils.sidecar_path(notebook_path, 'logs'), str(uid))
+
+def log_path(directory, stream):
+    """Get the path of the log of one stream of a run."""
+    return os.path.join(directory, stream + '.gz')
+
+class Capture:
+    """The captured output of one stream."""
+    def __init__(self, name, limit=LOG_LIMIT):
+        self.name = name
+        self.limit = limit
+        self.size = 0 # bytes printed
+        self.logged = 0 # bytes written to the log
+        self.head = bytearray()
+        self.tail = bytearray()
+
+    def feed(self, data, log):
+        """Record a chunk of output, writing what fits to the log."""
+        self.size += len(data)
+        if self.logged < self.limit:
+            part = data[:self.limit - self.logged]
+            log.write(part)
+            self.logged += len(part)
+        if len(self.head) < HEAD_SIZE:
+            self.head += data[:HEAD_SIZE - len(self.head)]
+        self.tail += data[-TAIL_SIZE:]
+        del self.tail[:-TAIL_SIZE]
+
+    def excerpt(self):
+        """Get the start and end of the output as text."""
+        if self.size <= HEAD_SIZE:
+            data = bytes(self.head)
+        elif self.size <= HEAD_SIZE + TAIL_SIZE:
+            data = bytes(self.head + self.tail[HEAD_SIZE - self.size:])
+        else:
+            return '{}\n[... {} bytes omitted ...]\n{}'.format(
+                self.head.decode('utf8', 'replace'),
+                self.size - HEAD_SIZE - TAIL_SIZE,
+                self.tail.decode('utf8', 'replace'))
+        return data.decode('utf8', 'replace')
+
+class Result:
+    """What a run printed, and how it ended."""
+    def __init__(self, directory, captures, returncode, runtime):
+        self.directory = directory
+        self.stdout, self.stderr = captures
+        self.returncode = returncode
+        self.runtime = runtime # microseconds
+
+    def excerpt(self):
+        """Get the text added to the note's description."""
+        parts = []
+        for cap in (self.stdout, self.stderr):
+            if cap.size:
+                parts.append('\n\n{} ({} bytes):\n{}'.format(
+                    cap.name, cap.size, cap.excerpt().rstrip('\n')))
+        return ''.join(parts)
+
+async def pump(reader, out, cap, path):
+    """Copy a stream to out and to its log until it ends."""
+    with gzip.open(path, 'wb') as log:
+        while True:
+            data = await reader.read(CHUNK_SIZE)
+            if not data:
+                break
+            out.write(data)
+            out.flush()
+            cap.feed(data, log)
+
+async def tee(cmd, directory, limit):
+    """Run a shell command, teeing its output; return (captures, status)."""
+    proc = await asyncio.create_subprocess_shell(
+        cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    captures = [Capture(name, limit) for name in STREAMS]
+    await asyncio.gather(
+        pump(proc.stdout, sys.stdout.buffer, captures[0],
+             log_path(directory, STREAMS[0])),
+        pump(proc.stderr, sys.stderr.buffer, captures[1],
+             log_path(directory, STREAMS[1])))
+    return captures, await proc.wait()
+
+def run(cmd, directory, limit=LOG_LIMIT):
+    """Run a shell command, logging its output to the given directory.
+
+    Return a Result."""
+    os.makedirs(directory, exist_ok=True)
+    sys.stdout.flush()
+    start = time.perf_counter()
+    captures, returncode = asyncio.run(tee(cmd, directory, limit))
+    runtime = int((time.perf_counter() - start)*1e6)
+    return Result(directory, captures, returncode, runtime)
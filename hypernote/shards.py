@@ -0,0 +1,99 @@
+"""Store a notebook as a directory of shard files partitioned by UID.
+
+A sharded notebook is a '.hnote/' directory holding a small JSON manifest and
+N shard files. Each shard holds the encoded notes whose UID falls into it, in
+the same stream format as a single-file notebook. Only shards containing
+changed notes are rewritten on save."""
+from hypernote import fileio
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+
+MANIFEST = 'manifest.json'
+FORMAT_VERSION = 1
+DEFAULT_SHARDS = 16
+# below this many bytes, loading in a process pool costs more than it saves
+PARALLEL_MIN_BYTES = 8 << 20
+
+def is_sharded(path):
+    """Return whether the given path is a sharded notebook."""
+    return os.path.isfile(os.path.join(path, MANIFEST))
+
+def shard_of(uid, num_shards):
+    """Get the shard index that the given UID belongs to.
+
+    UIDs are random, so taking them modulo the shard count spreads notes
+    evenly."""
+    return uid % num_shards
+
+def shard_path(path, i):
+    """Get the path of the i-th shard of a sharded notebook."""
+    return os.path.join(path, 'shard-{:04d}.hnote'.format(i))
+
+def read_manifest(path):
+    """Read the manifest of a sharded notebook."""
+    with open(os.path.join(path, MANIFEST)) as fin:
+        manifest = json.load(fin)
+    if manifest.get('version') != FORMAT_VERSION:
+        raise RuntimeError('Unsupported sharded notebook version {}!'.format(
+            manifest.get('version')))
+    return manifest
+
+def write_atomic(path, data, mode='wb'):
+    """Write data to a temporary file, then move it over the given path."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, mode) as fout:
+        fout.write(data)
+    os.replace(tmp_path, path)
+
+def load_shard(path):
+    """Load all notes in a single shard file; return them as a list."""
+    with open(path, 'rb') as fin:
+        data = bytearray(fin.read())
+    notes = []
+    while data:
+        notes.append(fileio.load_object(data))
+    return notes
+
+def load_all(path, workers=None):
+    """Load every note in a sharded notebook.
+
+    Shards are decoded in parallel by a process pool when the notebook is
+    large enough for that to pay off."""
+    manifest = read_manifest(path)
+    paths = [shard_path(path, i) for i in range(manifest['shards'])]
+    paths = [p for p in paths if os.path.isfile(p)]
+    total = sum(os.path.getsize(p) for p in paths)
+    if workers == 1 or len(paths) < 2 or total < PARALLEL_MIN_BYTES:
+        for p in paths:
+            yield from load_shard(p)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for notes in pool.map(load_shard, paths):
+            yield from notes
+
+def save(path, notes, num_shards, dirty):
+    """Save the notes to a sharded notebook.
+
+    notes: dictionary (uid -> note) of every note in the notebook.
+    num_shards: number of shards; used only when creating a new notebook.
+    dirty: UIDs of the notes changed since loading; None rewrites all shards.
+    """
+    if is_sharded(path):
+        num_shards = read_manifest(path)['shards']
+    else:
+        os.makedirs(path, exist_ok=True)
+        manifest = dict(version=FORMAT_VERSION, shards=num_shards)
+        write_atomic(os.path.join(path, MANIFEST), json.dumps(manifest), 'w')
+        dirty = None
+    if dirty is None:
+        dirty_shards = set(range(num_shards))
+    else:
+        dirty_shards = {shard_of(uid, num_shards) for uid in dirty}
+    grouped = {i: [] for i in dirty_shards}
+    for uid in notes:
+        i = shard_of(uid, num_shards)
+        if i in grouped:
+            grouped[i].append(notes[uid])
+    for i in grouped:
+        write_atomic(shard_path(path, i), fileio.dump_objects(grouped[i]))
@@ -0,0 +1,266 @@
+"""Synchronize two notebooks by comparing Merkle trees of their contents.
+
+Two peers compare their trees (see merkle) top-down, only descending into
+nodes that differ, then exchange the contents of the differing buckets and
+only the notes that are missing or different. The data exchanged is
+therefore proportional to the difference, not the notebook, and the trees
+of notebooks are saved alongside them so that neither side hashes every note
+again on each sync.
+
+A peer is anything with the methods of Peer; notes cross between peers in
+their encoded form, as they would over a wire."""
+from hypernote import backends
+from hypernote import fileio
+from hypernote import merkle
+from hypernote import registry
+from hypernote import relations
+
+# conflict kinds
+DIFFERENT = 'different' # the same UID holds different contents
+DUPLICATE = 'duplicate' # a different note has the same searchable property
+
+class Peer:
+    """One side of a sync."""
+    def nodes(self, level, indices):
+        """Get the hashes of the given nodes of one level of the tree."""
+        raise NotImplementedError
+
+    def buckets(self, indices):
+        """Get the contents of buckets.
+
+        Return a dictionary (index -> (dictionary (uid -> note hash), set of
+        relation tuples))."""
+        raise NotImplementedError
+
+    def fetch(self, uids):
+        """Get the encoded notes with the given UIDs."""
+        raise NotImplementedError
+
+    def receive(self, data, rels, replace):
+        """Store encoded notes and relations sent by the other peer.
+
+        Notes whose UIDs are in replace overwrite the stored ones; other
+        notes are new. Return a list of (uid, DUPLICATE) conflicts for new
+        notes that could not be added."""
+        raise NotImplementedError
+
+    def close(self):
+        """Write any changes made to the peer."""
+
+class NotesPeer(Peer):
+    """A peer holding a dictionary of notes and a list of relations."""
+    def __init__(self, notes, rels, tree=None):
+        """tree: merkle.Tree of the notes and relations (default: hash
+        them)."""
+        self.notes = notes
+        self.rels = rels
+        self.tree = merkle.Tree(notes.values(), rels) if tree is None \
+            else tree
+        self.terms = None # lowercased searchable properties, built on demand
+
+    def nodes(self, level, indices):
+        self.tree.build()
+        return [self.tree.levels[level][i] for i in indices]
+
+    def buckets(self, indices):
+        return {i: (dict(self.tree.notes[i]), set(self.tree.rels[i]))
+                for i in indices}
+
+    def fetch(self, uids):
+        return bytes(fileio.dump_objects([self.notes[uid] for uid in uids]))
+
+    def receive(self, data, rels, replace):
+        conflicts = []
+        for n in decode_notes(data):
+            if n.uid in replace:
+                self.replace_note(n)
+            else:
+                try:
+                    self.add_note(n)
+                except RuntimeError:
+                    conflicts.append((n.uid, DUPLICATE))
+                    continue
+            self.tree.add_note(n)
+        for rel in rels:
+            rel = relations.Relation(*rel)
+            self.add_relation(rel)
+            self.tree.add_relation(rel)
+        return conflicts
+
+    def add_note(self, n):
+        """Store a new note; raise RuntimeError on a duplicate searchable."""
+        if self.terms is None:
+            self.terms = {str(getattr(other, attr)).lower()
+                          for other in self.notes.values()
+                          for attr in other.searchable}
+        new_terms = {str(getattr(n, attr)).lower() for attr in n.searchable}
+        if new_terms & self.terms:
+            raise RuntimeError('Duplicate searchable property.')
+        self.terms |= new_terms
+        self.notes[n.uid] = n
+
+    def replace_note(self, n):
+        """Overwrite a stored note."""
+        self.notes[n.uid] = n
+        self.terms = None
+
+    def add_relation(self, rel):
+        """Store a new relation."""
+        self.rels.append(rel)
+
+class RegistryPeer(NotesPeer):
+    """The notebook loaded into the registry.
+
+    Notes are only read from the registry when they are sent."""
+    def __init__(self):
+        tree = merkle.open_tree(registry.store.path, registry.store)
+        # changes not saved yet
+        for uid in registry.dirty:
+            tree.add_note(registry.get(uid))
+        for rel in relations.default.new:
+            tree.add_relation(rel)
+        super().__init__({}, [], tree)
+
+    def fetch(self, uids):
+        return bytes(fileio.dump_objects([registry.get(uid) for uid in uids]))
+
+    def add_note(self, n):
+        registry.add(n)
+
+    def replace_note(self, n):
+        registry.replace(n)
+
+    def add_relation(self, rel):
+        relations.add(rel)
+
+class LocalTransport(NotesPeer):
+    """Another notebook on a local path.
+
+    The notebook is opened with its own backend, independently of the
+    registry; its notes are only loaded when some are sent or received (and
+    never all of them, for lazy backends); backends with random access send
+    notes without loading the others. Changes are written back by close()."""
+    def __init__(self, path):
+        self.path = path
+        self.store = backends.open_backend(path)
+        self.dirty = set()
+        self.new_rels = []
+        self.loaded = self.store.lazy # whether the notes needed are in memory
+        super().__init__({}, [], merkle.open_tree(path, self.store))
+
+    def load_notes(self):
+        """Bring every note and relation into memory (once)."""
+        if not self.loaded:
+            self.notes.update((n.uid, n) for n in self.store.load())
+            self.rels[:0] = self.store.load_relations()
+            self.loaded = True
+
+    def fetch(self, uids):
+        if not self.loaded and not self.store.random_access:
+            self.load_notes()
+        return bytes(fileio.dump_objects(
+            [self.notes[uid] if uid in self.notes else self.store.get(uid)
+             for uid in uids]))
+
+    def receive(self, data, rels, replace):
+        self.load_notes()
+        return super().receive(data, rels, replace)
+
+    def add_note(self, n):
+        if self.store.lazy and any(self.store.search(str(getattr(n, attr)))
+                                   for attr in n.searchable):
+            raise RuntimeError('Duplicate searchable property.')
+        super().add_note(n)
+        self.dirty.add(n.uid)
+
+    def replace_note(self, n):
+        super().replace_note(n)
+        self.dirty.add(n.uid)
+
+    def add_relation(self, rel):
+        super().add_relation(rel)
+        self.new_rels.append(rel)
+
+    def close(self):
+        if self.dirty:
+            self.store.save(self.notes, self.dirty)
+        if self.new_rels:
+            self.store.save_relations(self.rels, self.new_rels)
+        if self.dirty or self.new_rels:
+            merkle.save(self.path, self.store, self.tree)
+
+def decode_notes(data):
+    """Decode a buffer of encoded notes."""
+    buf = bytearray(data)
+    found = []
+    while buf:
+        found.append(fileio.load_object(buf))
+    return found
+
+def differing_buckets(local, remote):
+    """Walk both trees from the root; return the indices of differing buckets."""
+    indices = [0]
+    for level in range(merkle.DEPTH + 1):
+        mine = local.nodes(level, indices)
+        theirs = remote.nodes(level, indices)
+        indices = [i for i, a, b in zip(indices, mine, theirs) if a != b]
+        if level < merkle.DEPTH:
+            indices = [i*merkle.FANOUT + j for i in indices
+                       for j in range(merkle.FANOUT)]
+    return indices
+
+class Result:
+    """What a sync did."""
+    def __init__(self):
+        self.buckets = 0 # differing buckets exchanged
+        self.pulled = [] # UIDs of notes copied from the remote
+        self.pushed = [] # UIDs of notes copied to the remote
+        self.pulled_relations = 0
+        self.pushed_relations = 0
+        self.conflicts = [] # (uid, kind)
+
+def sync(local, remote, prefer=None):
+    """Merge two peers so that both hold the union of their contents.
+
+    Notes whose contents differ between the peers are conflicts and are left
+    alone, unless prefer is 'local' or 'remote' (the side whose version
+    wins). Return a Result."""
+    result = Result()
+    indices = differing_buckets(local, remote)
+    result.buckets = len(indices)
+    if not indices:
+        return result
+    mine = local.buckets(indices)
+    theirs = remote.buckets(indices)
+    push, pull, replace_remote, replace_local = [], [], set(), set()
+    push_rels, pull_rels = [], []
+    for i in indices:
+        my_notes, my_rels = mine[i]
+        their_notes, their_rels = theirs[i]
+        for uid, h in my_notes.items():
+            if uid not in their_notes:
+                push.append(uid)
+            elif their_notes[uid] != h:
+                if prefer == 'local':
+                    push.append(uid)
+                    replace_remote.add(uid)
+                elif prefer == 'remote':
+                    pull.append(uid)
+                    replace_local.add(uid)
+                else:
+                    result.conflicts.append((uid, DIFFERENT))
+        pull.extend(uid for uid in their_notes if uid not in my_notes)
+        push_rels.extend(sorted(my_rels - their_rels))
+        pull_rels.extend(sorted(their_rels - my_rels))
+    if push or push_rels:
+        result.conflicts += remote.receive(local.fetch(push), push_rels,
+                                           replace_remote)
+    if pull or pull_rels:
+        result.conflicts += local.receive(remote.fetch(pull), pull_rels,
+                                          replace_local)
+    failed = {uid for uid, kind in result.conflicts if kind == DUPLICATE}
+    result.pushed = [uid for uid in push if uid not in failed]
+    result.pulled = [uid for uid in pull if uid not in failed]
+    result.pushed_relations = len(push_rels)
+    result.pulled_relations = len(pull_rels)
+    return result
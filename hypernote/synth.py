@@ -0,0 +1,157 @@
+"""Generate realistic synthetic notebooks for benchmarking.
+
+Generation is deterministic for a given seed. Notes are built directly
+(bypassing autofill, autolinking and path normalization), so even notebooks
+of a million notes can be generated quickly."""
+from hypernote import backends
+from hypernote import note
+from hypernote import relations
+from datetime import datetime, timedelta
+import random
+
+VOCABULARY = (
+    'the a of to and in for with from on by reads writes filters sorts '
+    'merges aligned reads sample samples reference genome output input '
+    'quality trimmed adapter index sorted unsorted batch run rerun step '
+    'pipeline config parameters default threads memory cluster node log '
+    'results table figure plot summary counts matrix normalized raw '
+    'filtered deduplicated compressed archive backup copy final draft '
+    'version fixed broken checked verified see also note todo').split()
+
+EXTENSIONS = ('txt', 'csv', 'tsv', 'bam', 'fastq.gz', 'vcf', 'json', 'png')
+
+def make_note(cls, **fields):
+    """Build a note from its final field values, bypassing the constructor."""
+    n = cls.__new__(cls)
+    n.__dict__.update(fields)
+    return n
+
+def linked(rng, words, targets, density):
+    """Build LinkedText from words, replacing some with links to targets.
+
+    targets: list of (text, uid) pairs that links may point to."""
+    lt = note.LinkedText()
+    pieces = []
+    links = []
+    pos = 0
+    for word in words:
+        if targets and rng.random() < density:
+            word, uid = rng.choice(targets)
+            links.append((note.Pos(pos, pos + len(word)), uid))
+        pieces.append(word)
+        pos += len(word) + 1
+    lt.text = ' '.join(pieces)
+    for pos, uid in links:
+        lt.link(pos, uid)
+    return lt
+
+def sentence(rng, mean_words):
+    """Pick a random number of vocabulary words around the given mean."""
+    count = max(1, int(rng.expovariate(1/mean_words))) if mean_words else 0
+    return rng.choices(VOCABULARY, k=count)
+
+def generate(tools=50, actions=550, data=400, desc_words=30,
+             link_density=0.05, num_relations=None, seed=0):
+    """Generate a synthetic notebook.
+
+    desc_words: mean number of words in a description.
+    link_density: fraction of description words that are links.
+    num_relations: number of relations (defaults to the number of actions).
+    Return (dictionary (uid -> note), list of relations)."""
+    rng = random.Random(seed)
+    uids = set()
+    def new_uid():
+        uid = rng.getrandbits(31)
+        while uid in uids:
+            uid = rng.getrandbits(31)
+        uids.add(uid)
+        return uid
+
+    notes = {}
+    tool_targets = []
+    for i in range(tools):
+        cmd = 'tool{}'.format(i)
+        n = make_note(note.ToolNote, uid=new_uid(), name=cmd, cmd=cmd,
+                      ver='{}.{}'.format(i % 4, i % 13),
+                      desc=linked(rng, sentence(rng, desc_words),
+                                  tool_targets, link_density))
+        notes[n.uid] = n
+        tool_targets.append((cmd, n.uid))
+
+    data_targets = []
+    data_notes = []
+    for i in range(data):
+        if i % 1000 == 0:
+            # recent data notes, refreshed in batches to keep generation fast
+            targets = tool_targets + data_targets[-1000:]
+        name = 'file{}.{}'.format(i, EXTENSIONS[i % len(EXTENSIONS)])
+        path = 'data/batch{}/{}'.format(i % 97, name)
+        n = make_note(note.DataNote, uid=new_uid(), name=name, path=path,
+                      src=linked(rng, sentence(rng, desc_words//4),
+                                 tool_targets, link_density),
+                      desc=linked(rng, sentence(rng, desc_words), targets,
+                                  link_density))
+        notes[n.uid] = n
+        data_targets.append((name, n.uid))
+        data_notes.append(n)
+
+    action_notes = []
+    targets = tool_targets + data_targets[-1000:]
+    time = datetime(2020, 1, 1)
+    for i in range(actions):
+        tool, tool_uid = rng.choice(tool_targets) if tool_targets else (
+            'sh', None)
+        toolcmd = note.LinkedText(tool)
+        if tool_uid is not None:
+            toolcmd.link(note.Pos(0, len(tool)), tool_uid)
+        args = [tool]
+        links = [(note.Pos(0, len(tool)), tool_uid)] if tool_uid else []
+        pos = len(tool) + 1
+        for flag in ('-i', '-o'):
+            args.append(flag)
+            pos += len(flag) + 1
+            if data_targets:
+                name, uid = rng.choice(data_targets)
+                args.append(name)
+                links.append((note.Pos(pos, pos + len(name)), uid))
+                pos += len(name) + 1
+        shellcmd = note.LinkedText(' '.join(args))
+        for p, uid in links:
+            shellcmd.link(p, uid)
+        time += timedelta(seconds=rng.randint(1, 3600),
+                          microseconds=rng.randint(0, 999999))
+        n = make_note(note.ActionNote, uid=new_uid(), shellcmd=shellcmd,
+                      toolcmd=toolcmd, time=time,
+                      desc=linked(rng, sentence(rng, desc_words), targets,
+                                  link_density))
+        notes[n.uid] = n
+        action_notes.append(n)
+
+    if num_relations is None:
+        num_relations = actions
+    rels = []
+    if action_notes and data_notes:
+        for i in range(num_relations):
+            a = rng.choice(action_notes)
+            d = rng.choice(data_notes)
+            if rng.random() < 0.5:
+                rels.append(relations.Relation(
+                    a.uid, d.uid, relations.RT_CREATED,
+                    relations.RT_CREATED_BY))
+            else:
+                rels.append(relations.Relation(
+                    a.uid, d.uid, relations.RT_USED, relations.RT_USED_BY))
+    return notes, rels
+
+def split_counts(total):
+    """Split a total note count into tool/action/data counts."""
+    tools = max(1, total//20)
+    data = total*2//5
+    return dict(tools=tools, data=data, actions=total - tools - data)
+
+def write(path, notes, rels, fmt='stream', **options):
+    """Write a generated notebook in the given storage format."""
+    store = backends.formats[fmt](path, **options)
+    store.save(notes, None)
+    store.save_relations(rels, None)
+    return store
@@ -3,7 +3,8 @@ import subprocess
 import time
 import datetime
 import os.path
-import string
+from hypernote import tokenizer
+from hypernote import profiling
 
 def get_process_info(cmd):
     """Get the stdout, stderr, and returnvalue of a command."""
@@ -16,6 +17,7 @@ def get_process_info(cmd):
     rv = p.returncode
     return o, e, rv
     
+@profiling.timed('utils.autodetect_version')
 def autodetect_version(cmd):
     """Try to autodetect the version of a command."""
     # try with --version...
@@ -43,34 +45,65 @@ def get_timestamp():
     """Get the current timestamp as a string."""
     return str(datetime.datetime.now())
 
+# naive datetimes are stored as local wall-clock time since this epoch
+EPOCH = datetime.datetime(1970, 1, 1)
+
+def to_micros(ts):
+    """Convert a datetime to integer microseconds since EPOCH."""
+    if ts.tzinfo is not None:
+        # store timezone-aware times in local time, like naive ones
+        ts = ts.astimezone().replace(tzinfo=None)
+    return (ts - EPOCH) // datetime.timedelta(microseconds=1)
+
+def from_micros(us):
+    """Convert integer microseconds since EPOCH to a datetime."""
+    return EPOCH + datetime.timedelta(microseconds=us)
+
 def find_word_boundaries(source):
     """Return a list of tuples containing [start, end) for each word."""
-    in_word = False
-    bounds = []
-    cur_bound_start = None
-    last_non_punctuation = None
-    breakchars = string.whitespace
-    nonwordchars = breakchars + string.punctuation
-    for i, ch in enumerate(source):
-        if not in_word and ch not in nonwordchars:
-            in_word = True
-            cur_bound_start = i
-        if in_word:
-            if ch in breakchars:
-                in_word = False
-                bounds.append((cur_bound_start, last_non_punctuation+1))
-            elif ch not in string.punctuation:
-                last_non_punctuation = i
-    if in_word:
-        bounds.append((cur_bound_start, last_non_punctuation+1))
-    return bounds
+    return tokenizer.find_word_boundaries(source)
+
+# (working directory, base) -> path of the registry found from there;
+# the registry does not move while the program runs
+registry_cache = {}
 
 def find_registry(base='.'):
-    """Find the registry."""
-    test_path = os.path.relpath('{}/.hnote'.format(base))
-    if os.path.isfile(test_path):
-        return test_path
-    # .hnote not found; go to parent if not at root already
-    if os.path.samefile(base, '/'): # at root; abort
-        return None
-    return find_registry('{}/..'.format(base))
+    """Find the registry.
+
+    The registry is either a single '.hnote' file or a sharded '.hnote/'
+    directory. If the HNOTE_ROOT environment variable is set, the registry
+    in that directory is used; otherwise the search starts at base and walks
+    up to the filesystem root. Found registries are cached. Return None if
+    there is no registry."""
+    root = os.environ.get('HNOTE_ROOT')
+    if root:
+        path = os.path.join(root, '.hnote')
+        return path if os.path.exists(path) else None
+    key = (os.getcwd(), base)
+    if key not in registry_cache:
+        path = search_registry(os.path.abspath(base))
+        if path is None:
+            # not cached; 'hnote init' may still create one
+            return None
+        registry_cache[key] = path
+    return registry_cache[key]
+
+def search_registry(directory):
+    """Walk up from the given absolute directory looking for '.hnote'."""
+    while True:
+        test_path = os.path.join(directory, '.hnote')
+        if os.path.isfile(test_path) or os.path.isdir(test_path):
+            return os.path.relpath(test_path)
+        parent = os.path.dirname(directory)
+        if parent == directory: # at root; abort
+            return None
+        directory = parent
+
+def sidecar_path(path, name):
+    """Get the path of a named file stored alongside the notebook.
+
+    For a sharded notebook directory the file lives inside it; otherwise it
+    sits next to the notebook file."""
+    if os.path.isdir(path):
+        return os.path.join(path, name)
+    return '{}.{}'.format(path, name)
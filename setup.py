@@ -6,6 +6,8 @@ setup(
     packages=['hypernote', 'hypernote.frontend', 'hypernote.input',
               'hypernote.output'],
     install_requires=['python-dateutil'],
+    # NumPy is needed by columnar export and deduplication
+    extras_require={'numpy': ['numpy']},
     entry_points={
         'console_scripts' : ['hnote = hypernote.frontend.main:main']},
 
@@ -0,0 +1,153 @@
+"""Round-trip and speed tests of the note encodings."""
+from hypernote import fileio
+from hypernote import note
+from datetime import datetime
+import time
+import unittest
+
+# exactly representable by the float32 seconds of version 1
+TIME = datetime.fromtimestamp(1600000000)
+
+TEXT = 'Ünïcødé tëxt — 日本語, and 🧪 outside the BMP'
+
+def linked(text, spans=()):
+    """Build LinkedText with (start, end, dest) links."""
+    return note.LinkedText.from_spans(text, spans)
+
+def make(dtype, uid, **fields):
+    """Build a note without going through the registry."""
+    n = dtype.__new__(dtype)
+    n.uid = uid
+    vars(n).update(fields)
+    return n
+
+def sample_notes():
+    """Get notes of every class, with non-ASCII text and links."""
+    return [
+        make(note.ToolNote, 1, name='tööl', cmd='tool --ø', ver='1.0',
+             desc=linked(TEXT, [(0, 7, 2), (40, 42, 3)])),
+        make(note.ActionNote, 2, shellcmd=linked('tool --ø 🧪', [(0, 4, 1)]),
+             toolcmd=linked('tool', [(0, 4, 1)]), time=TIME,
+             desc=linked(TEXT), stdout_bytes=12, stderr_bytes=1 << 40,
+             runtime=1500000, returncode=-2),
+        make(note.DataNote, 3, name='dätä', path='dir/fïle.txt',
+             src=linked('from 🧪', [(5, 6, 2)]), desc=linked(''))]
+
+def value(v):
+    """Get a comparable form of a stored value."""
+    if isinstance(v, note.LinkedText):
+        return v.text, [(l.pos.start, l.pos.end, l.dest) for l in v.links]
+    return v
+
+def stored(n, schema):
+    """Get the values of the given (attribute, kind) fields of a note."""
+    return [(attr, value(getattr(n, attr))) for attr, kind in schema]
+
+def v1_encode(n):
+    """Encode a note as version 1."""
+    return {note.ToolNote: fileio.e_T_1, note.ActionNote: fileio.e_A_1,
+            note.DataNote: fileio.e_D_1}[type(n)](n)
+
+def v1_schema(dtype):
+    """Get the fields stored by version 1."""
+    return fileio.note_schema(dtype, extras=False)
+
+class TestRoundTrip(unittest.TestCase):
+    def test_current(self):
+        for n in sample_notes():
+            data = bytearray(fileio.dump_objects([n]))
+            loaded = fileio.load_object(data)
+            self.assertEqual(data, b'')
+            self.assertIs(type(loaded), type(n))
+            self.assertEqual(stored(loaded, fileio.note_schema(type(n))),
+                             stored(n, fileio.note_schema(type(n))))
+
+    def test_every_version(self):
+        for n in sample_notes():
+            for (tc, ver), codec in fileio.codec_versions.items():
+                if codec.dtype != type(n):
+                    continue
+                loaded = fileio.load_object(bytearray(codec.encode(n)))
+                self.assertEqual(stored(loaded, codec.schema),
+                                 stored(n, codec.schema), (tc, ver))
+                # fields the version does not store keep their defaults
+                for attr, kind in fileio.note_schema(type(n)):
+                    if attr not in dict(codec.schema):
+                        self.assertEqual(getattr(loaded, attr),
+                                         getattr(type(n), attr))
+
+    def test_v1_to_v2(self):
+        for n in sample_notes():
+            old = fileio.load_object(bytearray(v1_encode(n)))
+            self.assertEqual(stored(old, v1_schema(type(n))),
+                             stored(n, v1_schema(type(n))))
+            new = fileio.load_object(fileio.dump_objects([old]))
+            self.assertEqual(stored(new, fileio.note_schema(type(n))),
+                             stored(old, fileio.note_schema(type(n))))
+
+    def test_v2_to_v1(self):
+        for n in sample_notes():
+            new = fileio.load_object(fileio.dump_objects([n]))
+            old = fileio.load_object(bytearray(v1_encode(new)))
+            self.assertEqual(stored(old, v1_schema(type(n))),
+                             stored(n, v1_schema(type(n))))
+
+    def test_stream(self):
+        notes = sample_notes()*3
+        data = fileio.dump_objects(notes)
+        loaded = []
+        while data:
+            loaded.append(fileio.load_object(data))
+        self.assertEqual(
+            [stored(n, fileio.note_schema(type(n))) for n in loaded],
+            [stored(n, fileio.note_schema(type(n))) for n in notes])
+
+class TestTruncated(unittest.TestCase):
+    def test_every_cut(self):
+        for n in sample_notes():
+            for (tc, ver), codec in fileio.codec_versions.items():
+                if codec.dtype != type(n):
+                    continue
+                data = codec.encode(n)
+                for end in range(len(codec.prefix), len(data)):
+                    with self.assertRaises(ValueError, msg=(tc, ver, end)):
+                        fileio.load_object(bytearray(data[:end]))
+
+    def test_stream(self):
+        data = bytes(fileio.dump_objects(sample_notes()))
+        buf = bytearray(data[:-1])
+        with self.assertRaises(ValueError):
+            while buf:
+                fileio.load_object(buf)
+
+class TestSpeed(unittest.TestCase):
+    COUNT = 3000
+
+    def best_time(self, fun, repeat=3):
+        """Get the fastest of several runs of a function."""
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fun()
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    def test_faster_than_v1(self):
+        notes = sample_notes()*(self.COUNT//3)
+        v1 = b''.join(v1_encode(n) for n in notes)
+        v2 = bytes(fileio.dump_objects(notes))
+
+        def decode(data):
+            data = bytearray(data)
+            while data:
+                fileio.load_object(data)
+
+        encode_v1 = self.best_time(lambda: [v1_encode(n) for n in notes])
+        encode_v2 = self.best_time(lambda: fileio.dump_objects(notes))
+        decode_v1 = self.best_time(lambda: decode(v1))
+        decode_v2 = self.best_time(lambda: decode(v2))
+        self.assertLess(encode_v2, encode_v1)
+        self.assertLess(decode_v2, decode_v1)
+
+if __name__ == '__main__':
+    unittest.main()
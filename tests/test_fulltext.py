@@ -0,0 +1,94 @@
+"""Tests of the full-text index against exhaustive BM25 ranking."""
+from hypernote import fulltext
+from collections import Counter
+import math
+import random
+import sqlite3
+import unittest
+
+def rank(scores):
+    """Sort (uid, score) pairs by score, then uid; scores this close are
+    equal (they were summed in a different order)."""
+    return sorted(scores, key=lambda s: (-round(s[1], 9), s[0]))
+
+def reference(docs, query):
+    """Rank documents (dictionary (uid -> text)) by scoring every one."""
+    counts = {uid: fulltext.text_terms(text) for uid, text in docs.items()}
+    avg_length = sum(sum(c.values()) for c in counts.values())/len(counts)
+    scores = Counter()
+    for term in set(t[2] for t in fulltext.tokenize(query)):
+        df = sum(1 for c in counts.values() if term in c)
+        idf = math.log(1 + (len(docs) - df + 0.5)/(df + 0.5))
+        for uid, c in counts.items():
+            if term in c:
+                length = sum(c.values())
+                scores[uid] += idf*c[term]*(fulltext.K1 + 1)/(
+                    c[term] + fulltext.K1*(1 - fulltext.B +
+                                           fulltext.B*length/avg_length))
+    return rank(scores.items())
+
+def new_index(docs):
+    """Build an in-memory index of documents."""
+    db = sqlite3.connect(':memory:')
+    fulltext.create_tables(db)
+    fulltext.build(db, docs.items())
+    return db
+
+class TestSearch(unittest.TestCase):
+    WORDS = ['w{}'.format(i) for i in range(30)]
+
+    def text(self, rng):
+        return ' '.join(rng.choices(self.WORDS, k=rng.randint(1, 12)))
+
+    def check(self, db, docs, rng):
+        for _ in range(20):
+            query = ' '.join(rng.choices(self.WORDS + ['none'],
+                                         k=rng.randint(1, 6)))
+            limit = rng.randint(1, 15)
+            found = rank(fulltext.search_db(db, query, limit))
+            expected = reference(docs, query)
+            self.assertEqual(len(found), min(limit, len(expected)))
+            for (_, a), (_, b) in zip(found, expected):
+                self.assertAlmostEqual(a, b)
+            # the last hits may be any of those tied with them
+            last = round(found[-1][1], 9) if found else None
+            self.assertEqual(
+                [uid for uid, score in found if round(score, 9) != last],
+                [uid for uid, score in expected[:limit]
+                 if round(score, 9) != last], query)
+            tied = set(uid for uid, score in expected
+                       if round(score, 9) == last)
+            self.assertLessEqual(
+                set(uid for uid, score in found if round(score, 9) == last),
+                tied)
+
+    def test_base(self):
+        rng = random.Random(0)
+        for _ in range(20):
+            docs = {uid: self.text(rng) for uid in
+                    rng.sample(range(1 << 30), rng.randint(1, 300))}
+            self.check(new_index(docs), docs, rng)
+
+    def test_delta_and_merge(self):
+        rng = random.Random(1)
+        for _ in range(20):
+            docs = {uid: self.text(rng) for uid in
+                    rng.sample(range(1 << 30), rng.randint(1, 300))}
+            db = new_index(docs)
+            # change some notes and add others
+            for uid in rng.sample(sorted(docs), min(len(docs), 20)) + \
+                    list(range(rng.randint(0, 5))):
+                docs[uid] = self.text(rng)
+                fulltext.index_note(db, uid, docs[uid])
+            self.check(db, docs, rng)
+            fulltext.merge(db)
+            self.assertFalse(fulltext.load_delta(db))
+            self.check(db, docs, rng)
+
+    def test_no_match(self):
+        db = new_index({1: 'some text', 2: 'other text'})
+        self.assertEqual(fulltext.search_db(db, 'missing', 10), [])
+        self.assertEqual(fulltext.search_db(db, '...', 10), [])
+
+if __name__ == '__main__':
+    unittest.main()
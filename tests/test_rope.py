@@ -0,0 +1,140 @@
+"""Tests of the link rope against a plain string and list of links."""
+from hypernote import rope
+import random
+import unittest
+
+class Model:
+    """Text with a sorted list of absolute (start, end, dest) links."""
+    def __init__(self, text, links=()):
+        self.text = text
+        self.links = sorted(links)
+
+    def join(self, other):
+        off = len(self.text)
+        return Model(self.text + other.text, self.links +
+                     [(s+off, e+off, d) for s, e, d in other.links])
+
+    def substring(self, start, end):
+        start = max(0, start)
+        end = min(len(self.text), end)
+        if end <= start:
+            return Model('')
+        return Model(self.text[start:end],
+                     [(s-start, e-start, d) for s, e, d in self.links
+                      if s >= start and e <= end])
+
+    def add_link(self, start, end, dest):
+        return Model(self.text, self.links + [(start, end, dest)])
+
+    def links_in(self, start, end):
+        return [l for l in self.links if l[0] >= start and l[1] <= end]
+
+    def links_at(self, offset):
+        return [l for l in self.links if l[0] <= offset < l[1]]
+
+class TestRope(unittest.TestCase):
+    def setUp(self):
+        # small leaves, so that short texts make deep trees
+        self.chunk = rope.CHUNK
+        rope.CHUNK = 8
+        self.rng = random.Random(0)
+
+    def tearDown(self):
+        rope.CHUNK = self.chunk
+
+    def random_text(self):
+        return ''.join(self.rng.choices('abcdé日 ', k=self.rng.randint(0, 40)))
+
+    def random_links(self, length, count):
+        links = []
+        for _ in range(count if length else 0):
+            start = self.rng.randrange(length)
+            links.append((start, self.rng.randint(start + 1, length),
+                          self.rng.randrange(100)))
+        return links
+
+    def random_model(self):
+        text = self.random_text()
+        return Model(text, self.random_links(len(text),
+                                              self.rng.randint(0, 6)))
+
+    def check_node(self, node):
+        """Check the recorded sizes of a tree against its contents."""
+        if not node.height:
+            self.assertEqual(node.length, len(node.text))
+            self.assertEqual(node.count, len(node.links))
+            self.assertEqual(list(node.links), sorted(node.links))
+            for s, e, d in node.links:
+                self.assertLessEqual(0, s)
+            return
+        self.check_node(node.left)
+        self.check_node(node.right)
+        self.assertEqual(node.length, node.left.length + node.right.length)
+        self.assertEqual(node.count, node.left.count + node.right.count)
+        self.assertEqual(node.height,
+                         max(node.left.height, node.right.height) + 1)
+        self.assertLessEqual(abs(node.left.height - node.right.height), 2)
+
+    def check(self, node, model):
+        self.check_node(node)
+        self.assertEqual(rope.text(node), model.text)
+        self.assertEqual(node.length, len(model.text))
+        self.assertEqual(list(rope.links(node)), model.links)
+        self.assertEqual(node.max_end,
+                         max([e for s, e, d in model.links], default=-1))
+        self.assertEqual(rope.is_empty(node),
+                         not model.text and not model.links)
+        length = len(model.text)
+        for _ in range(5):
+            start = self.rng.randint(-2, length + 2)
+            end = self.rng.randint(start, length + 4)
+            self.assertEqual(sorted(rope.links_in(node, start, end)),
+                             model.links_in(start, end))
+            offset = self.rng.randint(-1, length + 1)
+            self.assertEqual(sorted(rope.links_at(node, offset)),
+                             model.links_at(offset))
+
+    def test_from_text(self):
+        for _ in range(200):
+            model = self.random_model()
+            self.check(rope.from_text(model.text, model.links), model)
+
+    def test_random_operations(self):
+        pool = [(rope.EMPTY, Model(''))]
+        for _ in range(3000):
+            op = self.rng.randrange(4)
+            node, model = self.rng.choice(pool)
+            if op == 0:
+                model = self.random_model()
+                node = rope.from_text(model.text, model.links)
+            elif op == 1:
+                other, other_model = self.rng.choice(pool)
+                node = rope.join(node, other)
+                model = model.join(other_model)
+            elif op == 2:
+                start = self.rng.randint(-2, node.length + 2)
+                end = self.rng.randint(start - 2, node.length + 4)
+                node = rope.substring(node, start, end)
+                model = model.substring(start, end)
+            elif node.length:
+                link, = self.random_links(node.length, 1)
+                node = rope.add_link(node, *link)
+                model = model.add_link(*link)
+            self.check(node, model)
+            pool.append((node, model))
+            if len(pool) > 50:
+                pool.pop(self.rng.randrange(len(pool)))
+
+    def test_long_concatenation(self):
+        node, model = rope.EMPTY, Model('')
+        for _ in range(500):
+            piece = self.random_model()
+            node = rope.join(node, rope.from_text(piece.text, piece.links))
+            model = model.join(piece)
+        self.check(node, model)
+        # balanced: depth logarithmic in the number of leaves
+        self.assertLessEqual(node.height,
+                             2*(node.length // rope.CHUNK + 1).bit_length())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+"""Tests of the regex tokenizer against the original word scanner."""
+from hypernote import tokenizer
+import random
+import string
+import unittest
+
+# word characters, punctuation, every break character, and non-ASCII
+# characters that are neither (including non-breaking and em spaces)
+ALPHABET = (string.ascii_letters[:6] + string.digits[:3] +
+            string.punctuation + string.whitespace +
+            'éß日🧪  «»—')
+
+EDGE_CASES = [
+    '',
+    ' ',
+    string.whitespace,
+    string.punctuation,
+    '... !?',
+    'x',
+    '.x',
+    'x.',
+    '(x)',
+    'résumé',
+    '日本語',
+    'naïve café.',
+    '«quoted»',
+    '🧪 outside the BMP 🧪',
+    'a b',
+    # links start and end at the edges of their texts
+    'samtools',
+    'samtools sort',
+    'sort out.bam',
+    'out.bam,',
+    'path/to/file_1.txt',
+    '"path/to/file_1.txt"',
+    '--threads=8',
+    'see http://example.org/a.html.',
+    '\tindented\n',
+    'a\x0bb\x0cc\rd',
+]
+
+class TestWordBoundaries(unittest.TestCase):
+    def check(self, text):
+        self.assertEqual(tokenizer.find_word_boundaries(text),
+                         tokenizer.reference_word_boundaries(text),
+                         repr(text))
+
+    def test_edge_cases(self):
+        for text in EDGE_CASES:
+            self.check(text)
+
+    def test_random(self):
+        rng = random.Random(0)
+        for _ in range(5000):
+            self.check(''.join(rng.choices(ALPHABET,
+                                           k=rng.randint(0, 40))))
+
+    def test_random_words(self):
+        rng = random.Random(1)
+        words = EDGE_CASES + list(string.punctuation)
+        for _ in range(2000):
+            self.check(rng.choice(['', ' ', '\n']).join(
+                rng.choices(words, k=rng.randint(1, 8))))
+
+if __name__ == '__main__':
+    unittest.main()